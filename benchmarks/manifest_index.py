@@ -0,0 +1,91 @@
+"""Per-key lookup latency of the special remote manifest index
+
+Compares the linear scan over ``manifest['items']`` the special remote used
+to do for every request with lookups through
+:class:`datalad_dtool.manifest.ManifestIndex` for growing item counts, and
+the startup cost of parsing a manifest with opening a
+:class:`datalad_dtool.manifest.PersistentManifestIndex`.
+Run with ``python benchmarks/manifest_index.py``.
+"""
+
+import hashlib
+import json
+import os
+import random
+import tempfile
+import timeit
+
+from datalad_dtool.manifest import ManifestIndex, PersistentManifestIndex
+
+
+def synthetic_manifest(n_items):
+    items = {}
+    for i in range(n_items):
+        relpath = f"dir{i % 100}/item{i}.dat"
+        items[hashlib.sha1(relpath.encode()).hexdigest()] = {
+            'hash': hashlib.md5(str(i).encode()).hexdigest(),
+            'relpath': relpath,
+            'size_in_bytes': i,
+            'utc_timestamp': 0.0,
+        }
+    return {'hash_function': 'md5sum_hexdigest', 'items': items}
+
+
+def linear_scan(manifest, file_hash):
+    for uuid, entry in manifest['items'].items():
+        if entry['hash'] == file_hash:
+            return uuid
+
+
+def startup(manifest, tmpdir):
+    """Time from process start to first lookup, parsed vs. persistent."""
+    manifest_path = os.path.join(tmpdir, 'manifest.json')
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    index_path = os.path.join(tmpdir, 'index.sqlite')
+    if os.path.exists(index_path):
+        os.unlink(index_path)
+    PersistentManifestIndex.create(
+        index_path, manifest['hash_function'], manifest['items'].items())
+    file_hash = next(iter(manifest['items'].values()))['hash']
+
+    def parsed():
+        with open(manifest_path) as f:
+            ManifestIndex.from_manifest(json.load(f)).uuids_for_hash(file_hash)
+
+    def persistent():
+        PersistentManifestIndex(index_path).uuids_for_hash(file_hash)
+
+    return (timeit.timeit(parsed, number=1),
+            timeit.timeit(persistent, number=10) / 10)
+
+
+def _report(n, n_keys, tmpdir):
+    manifest = synthetic_manifest(n)
+    hashes = [e['hash'] for e in manifest['items'].values()]
+    keys = random.Random(0).sample(hashes, n_keys)
+
+    build = timeit.timeit(
+        lambda: ManifestIndex.from_manifest(manifest), number=1)
+    index = ManifestIndex.from_manifest(manifest)
+    t_index = timeit.timeit(
+        lambda: [index.uuids_for_hash(k) for k in keys], number=10)
+    t_scan = timeit.timeit(
+        lambda: [linear_scan(manifest, k) for k in keys[:20]], number=1)
+
+    t_parse, t_open = startup(manifest, tmpdir)
+
+    print(f"{n:>8} {build:>10.3f} {1e6 * t_index / (10 * n_keys):>15.2f} "
+          f"{1e6 * t_scan / 20:>14.1f} {t_parse:>10.3f} {1e3 * t_open:>10.2f}")
+
+
+
+def main(sizes=(1000, 10000, 100000, 200000), n_keys=200):
+    print(f"{'items':>8} {'build [s]':>10} {'index [us/key]':>15} "
+          f"{'scan [us/key]':>14} {'parse [s]':>10} {'open [ms]':>10}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in sizes:
+            _report(n, n_keys, tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Selection of dtool items by relpath patterns
+
+Times selecting items of growing manifests with
+:class:`datalad_dtool.select.PathSelector` as ``import-dtool --include`` and
+``--exclude`` do, compiling the patterns and testing every relpath, for
+subtree, glob and exclude selections.
+Run with ``python benchmarks/path_selection.py``.
+"""
+
+import timeit
+
+from datalad_dtool.select import PathSelector
+
+SELECTIONS = [
+    ('subtree', ['raw/2024-01'], None),
+    ('glob', ['raw/2024-*/**/*.h5'], None),
+    ('exclude', None, ['**/*.txt']),
+]
+
+
+def synthetic_relpaths(n_items):
+    for i in range(n_items):
+        kind = ('raw', 'processed')[i % 2]
+        month = f"{2020 + i % 5}-{1 + i % 12:02d}"
+        ext = ('h5', 'txt', 'json')[i % 3]
+        yield i, f"{kind}/{month}/run{i % 1000}/item{i}.{ext}"
+
+
+def select(relpaths, include, exclude):
+    selector = PathSelector(include, exclude)
+    return {i for i, relpath in relpaths if selector(relpath)}
+
+
+def _report(n):
+    relpaths = list(synthetic_relpaths(n))
+    for name, include, exclude in SELECTIONS:
+        t_select = timeit.timeit(
+            lambda: select(relpaths, include, exclude), number=1)
+        n_selected = len(select(relpaths, include, exclude))
+        print(f"{n:>8} {name:>8} {t_select:>10.3f} "
+              f"{t_select / n * 1e6:>13.2f} {n_selected:>9}")
+
+
+def main(sizes=(10000, 100000, 1000000)):
+    print(f"{'items':>8} {'select':>8} {'total [s]':>10} "
+          f"{'per item [us]':>13} {'selected':>9}")
+    for n in sizes:
+        _report(n)
+
+
+if __name__ == '__main__':
+    main()
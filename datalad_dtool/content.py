@@ -0,0 +1,84 @@
+"""Streaming enumeration of the files in a commit of a DataLad dataset"""
+
+__docformat__ = 'restructuredtext'
+
+import json
+import logging
+from collections import namedtuple
+from pathlib import PurePosixPath
+
+from datalad.support.annexrepo import AnnexRepo
+
+logger = logging.getLogger(__name__)
+
+ContentRecord = namedtuple('ContentRecord', [
+    'path', 'key', 'objloc', 'has_content', 'size'])
+ContentRecord.__doc__ = """File in a commit of a DataLad dataset.
+
+``path`` is the absolute path of the file in the worktree. ``key`` is the
+annex key of annexed files, None for files in git. ``objloc`` is the path of
+the annex object holding the content of an annexed file, None if the content
+is not present. ``size`` is the size of the content in bytes, None for
+annexed files whose key does not carry it.
+"""
+
+
+def _iter_tree(repo, ref):
+    # (path, size) of the blobs in the tree of `ref`, in git's order of
+    # paths, which is the order of their bytes
+    for line in repo.call_git_items_(
+            ['ls-tree', '-r', '-z', '--long', '--full-tree', ref],
+            sep='\0', read_only=True):
+        if not line:
+            continue
+        meta, path = line.split('\t', 1)
+        _, object_type, _, size = meta.split()
+        if object_type == 'blob':
+            yield path, int(size)
+
+
+def _iter_annexed(repo, ref):
+    # (path, key, size) of the annexed files in the tree of `ref`, as
+    # git-annex lists them along the tree
+    for line in repo.call_annex_items_(
+            ['findref', '--anything', '--json', ref]):
+        if not line:
+            continue
+        record = json.loads(line)
+        size = record.get('bytesize')
+        yield record['file'], record['key'], \
+            None if size in (None, '-') else int(size)
+
+
+def iter_content(repo, ref='HEAD'):
+    """Yield a :class:`ContentRecord` per file in commit `ref` of `repo`.
+
+    Files are listed by ``git ls-tree`` as they come, in the order of their
+    paths, merged with the annexed files listed by ``git annex findref``
+    along the same tree. The annex objects of these are looked up with a
+    batched ``git annex contentlocation``. Neither the tree nor the annex
+    information are held in memory at once, so that the first record is
+    available right away, whatever the size of the tree. Submodules are
+    skipped.
+    """
+    annexed = _iter_annexed(repo, ref) if isinstance(repo, AnnexRepo) \
+        else iter(())
+    pending = next(annexed, None)
+    for path, size in _iter_tree(repo, ref):
+        pathobj = repo.pathobj / PurePosixPath(path)
+        encoded = path.encode('utf-8', errors='surrogateescape')
+        while pending is not None \
+                and pending[0].encode('utf-8', errors='surrogateescape') \
+                < encoded:
+            logger.debug("Annexed file %s not in tree of %s",
+                         pending[0], ref)
+            pending = next(annexed, None)
+        if pending is None or pending[0] != path:
+            yield ContentRecord(pathobj, None, None, True, size)
+            continue
+        _, key, key_size = pending
+        pending = next(annexed, None)
+        objloc = repo.get_contentlocation(key, batch=True)
+        yield ContentRecord(
+            pathobj, key, repo.pathobj / objloc if objloc else None,
+            bool(objloc), key_size)
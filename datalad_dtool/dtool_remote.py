@@ -1,114 +1,208 @@
+import functools
 import logging
-import shutil
+import os
 
 from annexremote import Master
 from annexremote import ExportRemote
 from annexremote import RemoteError
 
-from dtoolcore import DataSet, ProtoDataSet, DtoolCoreTypeError
+from .keys import parse_key
+from .pool import DatasetHandle, DatasetPool
+from .timing import PhaseTimer
+from .transfer import DEFAULT_BUFFER_SIZE, RateLimitedProgress, copy_file
 
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_PREFETCH_BUDGET = 2 ** 30
+DEFAULT_POOL_SIZE = 16
 
-def extract_backend(key):
-    # Split the key by "--"
-    parts = key.split("-")
 
-    if len(parts) < 2:
-        return None  # Invalid key format
-
-    # Get the last part (hash + possible extension)
-    return parts[0]
-
-
-    return hash_only
-
-
-def extract_hash(key):
-    # Split the key by "--"
-    parts = key.split("--")
-
-    if len(parts) < 2:
-        return None  # Invalid key format
-
-    # Get the last part (hash + possible extension)
-    hash_part = parts[-1]
-
-    # Remove file extension if present
-    hash_only = hash_part.split('.')[0]
-
-    return hash_only
+class DtoolRemote(ExportRemote):
+    """A special remote for retrieving files from dtool datasets.
 
+    By default, a remote serves the single dtool dataset configured by
+    ``uri``. With ``multi=yes``, one remote serves the items of any dtool
+    dataset referenced by a ``dtool:`` URL and keeps a bounded pool of
+    datasets open.
 
-class DtoolRemote(ExportRemote):
-    """A read-only special remote for retrieving files from dtool datasets."""
+    Keys can only be retrieved. A remote initialized with ``exporttree=yes``
+    on a dtool proto dataset additionally accepts ``git annex export``, the
+    dataset is frozen separately afterwards.
+    """
     transfer_store = None
     remove = None
 
     def __init__(self, annex):
         super().__init__(annex)
+        self.timer = PhaseTimer()
         self.configs = {
-            'uri': "dtool dataset URI"
+            'uri': "dtool dataset URI",
+            'multi': "set to 'yes' to serve any dtool dataset referenced by "
+                     "a dtool: URL instead of a single uri",
+            'poolsize': "maximum number of dtool datasets kept open with "
+                        f"multi=yes, default {DEFAULT_POOL_SIZE}",
+            'cachedir': "directory for persistent manifest indexes, "
+                        "default .git/annex/dtool",
+            'buffersize': "size in bytes of the chunks item content is "
+                          f"retrieved in, default {DEFAULT_BUFFER_SIZE}",
+            'prefetch': "number of items of datasets in remote storage to "
+                        "download ahead of requests concurrently, default 0",
+            'prefetchbudget': "maximum number of bytes downloaded ahead of "
+                              f"requests, default {DEFAULT_PREFETCH_BUDGET}",
+            'crosshash': "comma-separated annex backends to hash all items "
+                         "of a dataset for once, if its hash function "
+                         "does not match, e.g. SHA256E",
         }
 
     def initremote(self) -> None:
         # initialize the remote, e.g. create the folders
         # raise RemoteError if the remote couldn't be initialized
+        if self._is_multi():
+            logger.debug("Serve any dtool dataset")
+            return
         self.uri = self.annex.getconfig("uri")
         if not self.uri:
-            raise RemoteError("You need to set uri=")
+            raise RemoteError("You need to set uri= or multi=yes")
         logger.debug("Set dtool dataset uri=%s", self.uri)
 
     def prepare(self) -> None:
         # prepare to be used, eg. open TCP connection, authenticate with the server etc.
         # raise RemoteError if not ready to use
-        self.uri = self.annex.getconfig("uri")
+        # datasets are only opened by the first request that needs them,
+        # many git-annex commands never do
+        with self.timer('prepare'):
+            self.multi = self._is_multi()
+            self.uri = None if self.multi else self.annex.getconfig("uri")
+            self.buffersize = self._get_int_config(
+                "buffersize", DEFAULT_BUFFER_SIZE)
+            self.pool = DatasetPool(
+                functools.partial(
+                    DatasetHandle,
+                    cache_dir=self._get_cache_dir(),
+                    prefetch=self._get_int_config("prefetch", 0),
+                    prefetch_budget=self._get_int_config(
+                        "prefetchbudget", DEFAULT_PREFETCH_BUDGET),
+                    cross_hash=tuple(
+                        b.strip() for b in self.annex.getconfig("crosshash").split(',')
+                        if b.strip()),
+                    timer=self.timer),
+                size=self._get_int_config("poolsize", DEFAULT_POOL_SIZE))
+
+    def _is_multi(self):
+        return self.annex.getconfig("multi").lower() in ('yes', 'true')
+
+    def _get_int_config(self, name, default):
+        value = self.annex.getconfig(name)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise RemoteError(f"Invalid {name}={value}")
+
+    def _get_cache_dir(self):
+        cache_dir = self.annex.getconfig("cachedir")
+        if not cache_dir:
+            cache_dir = os.path.join(self.annex.getgitdir(), 'annex', 'dtool')
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as exc:
+            logger.warning("Failed to use cache directory: %s", exc)
+            return None
+        return cache_dir
+
+    def _url_prefix(self):
+        return "dtool:" if self.multi else f"dtool:{self.uri}/"
+
+    def _parse_url(self, url):
+        """Return dataset URI and item UUID of a dtool: URL served by this remote."""
+        if not url.startswith(self._url_prefix()):
+            raise ValueError(f"URL {url} not served by this remote")
+        dataset_uri, item_uuid = url[len('dtool:'):].rsplit('/', 1)
+        if not dataset_uri or not item_uuid or (
+                not self.multi and dataset_uri != self.uri):
+            raise ValueError(f"Invalid dtool URL {url}")
+        return dataset_uri, item_uuid
+
+    def _hash_candidates(self):
+        # datasets to look up key hashes in, in multi mode only those already
+        # open, others are opened from the dtool: URLs of a key
+        return self.pool if self.multi else [self.pool.get(self.uri)]
+
+    def _retrieve(self, handle, uuid, filename):
+        with self.timer('fetch'):
+            fpath = handle.item_content_abspath(uuid)
+        logger.debug("Cached item content at %s", fpath)
+        with self.timer('retrieve'):
+            mode = copy_file(fpath, filename, bufsize=self.buffersize,
+                             progress=RateLimitedProgress(self.annex.progress))
+        logger.debug("Retrieved item %s from dataset %s via %s",
+                     uuid, handle.uri, mode)
+
+    def _parse_key(self, key):
         try:
-            self.dtool_dataset = DataSet.from_uri(self.uri)
-            logger.debug("Dataset uri=%s frozen, immutable.", self.uri)
-        except DtoolCoreTypeError as exc:
-            logger.warning(exc)
-            self.dtool_dataset = ProtoDataSet.from_uri(self.uri)
-        pass
+            return parse_key(key)
+        except ValueError as e:
+            raise RemoteError(e)
+
+    def _size_matches(self, handle, annex_key):
+        # keys without size field may match any item
+        return annex_key.size is None or handle.index.has_size(annex_key.size)
+
+    def _may_be_present(self, annex_key):
+        """Return False if no item of the served dataset has the key's size."""
+        if self.multi:
+            # datasets of a key's URLs are only known after GETURLS
+            return True
+        try:
+            # first request that needs the dataset opens it
+            if self._size_matches(self.pool.get(self.uri), annex_key):
+                return True
+        except Exception as e:
+            raise RemoteError(e)
+        logger.debug("No item of %s bytes in dataset %s",
+                     annex_key.size, self.uri)
+        return False
+
+    def _uuids_for_key(self, handle, annex_key):
+        if not self._size_matches(handle, annex_key):
+            return []
+        index = handle.index_for_backend(annex_key.backend)
+        if index is None:
+            return []
+        return index.uuids_for_hash(annex_key.hash)
 
     def transfer_retrieve(self, key, filename):
         # get the file identified by `key` and store it to `filename`
         # raise RemoteError if the file couldn't be retrieved
         exceptions = []
 
-        backend = self.annex.getconfig('keybackend_' + key)
-        logger.debug("Key %s uses backend %s", key, backend)
+        annex_key = self._parse_key(key)
+        logger.debug("Key %s uses backend %s", key, annex_key.backend)
 
-        file_hash = extract_backend(key)
+        if not self._may_be_present(annex_key):
+            raise RemoteError(
+                f"No item of {annex_key.size} bytes in dataset {self.uri}")
 
-        logger.debug("Try to locate file of chekcsum/hash %s in dataset %s", file_hash, self.uri)
-        manifest = self.dtool_dataset.generate_manifest()
-        if backend.startswith('MD5') and (manifest["hash_function"] == "md5sum_hexdigest"):
-            for uuid, entry in manifest['items'].items():
-                if entry["hash"] == file_hash:
-                    try:
-                        fpath = self.dtool_dataset.item_content_abspath(uuid)
-                        shutil.copyfile(fpath, filename)
-                        return
-                    except Exception as e:
-                        exceptions.append(e)
+        for handle in self._hash_candidates():
+            logger.debug("Try to locate file of checksum/hash %s in dataset %s", annex_key.hash, handle.uri)
+            for uuid in self._uuids_for_key(handle, annex_key):
+                try:
+                    self._retrieve(handle, uuid, filename)
+                    return
+                except Exception as e:
+                    exceptions.append(e)
 
-        urls = self.annex.geturls(key, f"dtool:{self.uri}")
+        urls = self.annex.geturls(key, self._url_prefix())
         logger.debug("Retrieve from %s", urls)
 
         for url in urls:
-            url = url[len('dtool:'):]
             try:
-                dataset_uri, item_uuid = url.rsplit('/', 1)
-
-                assert dataset_uri == self.uri
+                dataset_uri, item_uuid = self._parse_url(url)
 
                 logger.debug("Try to retrieve item %s from dataset %s", item_uuid, dataset_uri)
-                # dtool_dataset = DataSet.from_uri(dataset_uri)
-                fpath = self.dtool_dataset.item_content_abspath(item_uuid)
-                logger.debug("Cached item content at %s", fpath)
-                shutil.copyfile(fpath, filename)
+                self._retrieve(self.pool.get(dataset_uri), item_uuid, filename)
                 return
             except Exception as e:
                 exceptions.append(e)
@@ -120,42 +214,37 @@ class DtoolRemote(ExportRemote):
         # return False if the key is not present
         # raise RemoteError if the presence of the key couldn't be determined, eg. in case of connection error
 
+        annex_key = self._parse_key(key)
+        logger.debug("Key %s uses backend %s", key, annex_key.backend)
+
+        if not self._may_be_present(annex_key):
+            return False
+
         # first, try to identify file from actual md5 key
 
         exceptions = []
 
-        backend = extract_backend(key)
-        logger.debug("Key %s uses backend %s", key, backend)
-
         try:
-            file_hash = extract_hash(key)
-            logger.debug("Try to locate hash/checksum %s in dataset %s", file_hash, self.uri)
-
-            manifest = self.dtool_dataset.generate_manifest()
-            if backend.startswith('MD5') and (manifest["hash_function"] == "md5sum_hexdigest"):
-                for uuid, entry in manifest['items'].items():
-                    if entry["hash"] == file_hash:
-                        logger.debug("Located item %s in dataset %s", uuid, self.uri)
-                        return True
+            for handle in self._hash_candidates():
+                logger.debug("Try to locate hash/checksum %s in dataset %s", annex_key.hash, handle.uri)
+                uuids = self._uuids_for_key(handle, annex_key)
+                if uuids:
+                    logger.debug("Located item %s in dataset %s", uuids[0], handle.uri)
+                    return True
         except Exception as e:
             exceptions.append(e)
 
         # next, try to identify file from dtool URLs
 
-        urls = self.annex.geturls(key, f"dtool:{self.uri}")
+        urls = self.annex.geturls(key, self._url_prefix())
 
         for url in urls:
-            url = url[len('dtool:'):]
             try:
-                dataset_uri, item_uuid = url.rsplit('/', 1)
-
-                assert dataset_uri == self.uri
+                dataset_uri, item_uuid = self._parse_url(url)
 
                 logger.debug("Try to locate item %s in dataset %s", item_uuid, dataset_uri)
 
-                # dtool_dataset = DataSet.from_uri(dataset_uri)
-                manifest = self.dtool_dataset.generate_manifest()
-                if item_uuid in manifest['items']:
+                if item_uuid in self.pool.get(dataset_uri).index:
                     logger.debug("Located item %s in dataset %s", item_uuid, dataset_uri)
                     return True
 
@@ -169,10 +258,14 @@ class DtoolRemote(ExportRemote):
 
     def claimurl(self, url: str) -> bool:
         logger.debug("Check claim to URL %s", url)
-        return url.startswith(f"dtool:{self.uri}/")
+        try:
+            self._parse_url(url)
+        except ValueError:
+            return False
+        return True
 
     def checkurl(self, url: str) -> bool:
-        return url.startswith(f"dtool:{self.uri}/")
+        return self.claimurl(url)
         # TODO: implement more sophisticated checking on URL
 
     def getcost(self) -> int:
@@ -183,33 +276,65 @@ class DtoolRemote(ExportRemote):
         return "global"
 
     ## Export methods
+    def _export_handle(self):
+        if self.multi:
+            raise RemoteError("Export not supported with multi=yes")
+        return self.pool.get(self.uri)
+
     def transferexport_store(self, key, local_file, remote_file):
-        pass
+        handle = self._export_handle()
+        try:
+            handle.put_item(local_file, remote_file, bufsize=self.buffersize,
+                            progress=RateLimitedProgress(self.annex.progress))
+        except Exception as e:
+            raise RemoteError(e)
 
     def transferexport_retrieve(self, key, local_file, remote_file):
-        manifest = self.dtool_dataset.generate_manifest()
-        for uuid, entry in manifest['items'].items():
-            if entry["relpath"] == remote_file:
-                try:
-                    fpath = self.dtool_dataset.item_content_abspath(uuid)
-                    shutil.copyfile(fpath, local_file)
-                except Exception as e:
-                    raise RemoteError(e)
-
-        pass
+        handle = self._export_handle()
+        try:
+            with self.timer('fetch'):
+                fpath = handle.relpath_content_abspath(remote_file)
+        except Exception as e:
+            raise RemoteError(e)
+        if fpath is None:
+            raise RemoteError(f"No item {remote_file} in dataset {self.uri}")
+        try:
+            with self.timer('retrieve'):
+                mode = copy_file(fpath, local_file, bufsize=self.buffersize,
+                                 progress=RateLimitedProgress(
+                                     self.annex.progress))
+        except Exception as e:
+            raise RemoteError(e)
+        logger.debug("Retrieved item %s from dataset %s via %s",
+                     remote_file, handle.uri, mode)
 
     def checkpresentexport(self, key, remote_file):
-        pass
+        handle = self._export_handle()
+        try:
+            return handle.has_item(remote_file)
+        except Exception as e:
+            raise RemoteError(e)
 
     def removeexport(self, key, remote_file):
-        pass
+        handle = self._export_handle()
+        try:
+            handle.remove_item(remote_file)
+        except Exception as e:
+            raise RemoteError(e)
 
     def removeexportdirectory(self, remote_directory):
-        pass
+        handle = self._export_handle()
+        try:
+            handle.remove_directory(remote_directory)
+        except Exception as e:
+            raise RemoteError(e)
 
 
 def main() -> None:
      master = Master()
      remote = DtoolRemote(master)
      master.LinkRemote(remote)
-     master.Listen()
\ No newline at end of file
+     master.Listen()
+     if getattr(remote, 'pool', None) is not None:
+         remote.pool.close()
+     logger.debug("Time per phase: %s", remote.timer.summary())
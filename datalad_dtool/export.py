@@ -2,7 +2,12 @@
 
 __docformat__ = 'restructuredtext'
 
+import heapq
+import itertools
 import os.path
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from os.path import curdir
 from os.path import abspath
 
@@ -12,15 +17,31 @@ from datalad.support.param import Parameter
 from datalad.distribution.dataset import datasetmethod
 from datalad.interface.base import eval_results
 from datalad.distribution.dataset import EnsureDataset
-from datalad.support.constraints import EnsureNone, EnsureStr, EnsureChoice
+from datalad.support.constraints import EnsureNone, EnsureStr, EnsureChoice, EnsureInt
 
 from datalad.interface.results import get_status_dict
 
 from datalad.distribution.dataset import require_dataset
-from datalad.support.annexrepo import AnnexRepo
 
-from dtoolcore.utils import sanitise_uri
-from dtoolcore import DataSetCreator
+from dtoolcore.utils import (
+    IS_WINDOWS,
+    generate_identifier,
+    handle_to_osrelpath,
+    mkdir_parents,
+    sanitise_uri,
+)
+from dtoolcore import ProtoDataSet, create_proto_dataset
+
+from datalad_dtool.content import iter_content
+from datalad_dtool.hashes import backend_matches
+from datalad_dtool.keys import parse_key
+from datalad_dtool.manifest import (
+    freeze,
+    item_content_abspath,
+    manifest_hash_function,
+)
+from datalad_dtool.snapshots import changed_paths, find_previous_snapshot
+from datalad_dtool.transfer import LINK_MODES, link_file
 
 import logging
 lgr = logging.getLogger('datalad.dtool.export')
@@ -77,6 +98,45 @@ class DtoolExport(Interface):
                    the fields 'datalad-uuid' and 'datalad-commit'. This option
                    suppresses this behavior.
                    """),
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            metavar="N",
+            doc="""Number of items to put into the dtool dataset concurrently.
+                   With more than one job, the largest files are put first.
+                   Speeds up exports to base URIs in remote storage, e.g. S3,
+                   that are bound by latency rather than bandwidth. By
+                   default, items are put one at a time.""",
+            constraints=EnsureInt() | EnsureNone()),
+        link_mode=Parameter(
+            args=("--link-mode",),
+            doc="""How to put the content of annexed files into a dtool
+                   dataset on local disk, i.e. at a file:// base URI. 'copy'
+                   copies content as dtool does. 'reflink' shares the extents
+                   of annex objects on copy-on-write filesystems, e.g. btrfs
+                   or XFS, and copies otherwise. 'hardlink' and 'symlink'
+                   link items to the annex objects, and fall back to
+                   'reflink' where links are not possible, e.g. across
+                   filesystems. git-annex write-protects annex objects and
+                   never modifies them in place, so linked items do not
+                   change with the DataLad dataset. Symlinked items break
+                   once their annex object is dropped, though, and hardlinked
+                   items change with unlocked files in annex.thin mode.
+                   Files in git are always copied, content at other base
+                   URIs is always put by dtool.""",
+            constraints=EnsureChoice(*LINK_MODES)),
+        incremental=Parameter(
+            args=("--incremental",),
+            action="store_true",
+            doc="""Reuse the items of the previous export of the same DataLad
+                   dataset to BASE_URI, the dtool dataset whose
+                   'datalad-commit' annotation is the closest ancestor of the
+                   exported commit. Files unchanged since that commit are
+                   hardlinked from the previous dtool dataset, which is
+                   immutable once frozen, or reflinked or symlinked with the
+                   respective link mode. Neither are they hashed again, nor
+                   need their content be present. Only new and changed files
+                   are read from the DataLad dataset. Items are reused
+                   between dtool datasets on local disk only."""),
     )
 
     @staticmethod
@@ -91,7 +151,10 @@ class DtoolExport(Interface):
                  name=None,
                  dataset=None,
                  missing_content='error',
-                 suppress_provenance_annotations=False):
+                 suppress_provenance_annotations=False,
+                 jobs=None,
+                 link_mode='copy',
+                 incremental=False):
         # commands should be implemented as generators and should
         # report any results by yielding status dictionaries
         if base_uri is None:
@@ -116,24 +179,84 @@ class DtoolExport(Interface):
         lgr.debug("Export to dtool dataset of name '%s' at base URI '%s'",
                   name, sanitised_base_uri)
 
-        repo_files = repo.get_content_info(ref='HEAD', untracked='no')
-        if isinstance(repo, AnnexRepo):
-            # add availability (has_content) info
-            repo_files = repo.get_content_annexinfo(ref='HEAD',
-                                                    init=repo_files,
-                                                    eval_availability=True)
+        previous = None
+        if incremental:
+            previous, previous_commit = find_previous_snapshot(
+                repo, sanitised_base_uri, datalad_uuid, datalad_commit)
+            if previous is None:
+                lgr.info("No previous export of %s at %s, export all files",
+                         dataset, sanitised_base_uri)
+            elif previous._storage_broker.key != 'file':
+                lgr.info("Cannot reuse items of %s, not on local disk",
+                         previous.uri)
+                previous = None
+            else:
+                changed = changed_paths(repo, previous_commit, datalad_commit)
+                lgr.info("Reuse items of %s, %d files changed since %s",
+                         previous.uri, len(changed), previous_commit)
+        n_reused = 0
+
+        proto_dataset = create_proto_dataset(
+            name=name, base_uri=sanitised_base_uri)
+        uri = proto_dataset.uri
+        lgr.debug("Created dataset will be available at '%s'", uri)
+
+        if not suppress_provenance_annotations:
+            proto_dataset.put_annotation("datalad-uuid", datalad_uuid)
+            proto_dataset.put_annotation("datalad-commit", datalad_commit)
 
-        with DataSetCreator(name=name, base_uri=sanitised_base_uri) as dtool_dataset_creator:
+        hash_function = manifest_hash_function(proto_dataset)
+        # relpath -> (hash, size) of files whose annex key carries the
+        # hash the dtool dataset uses, not hashed again on freeze
+        known_items = {}
+        put_item = proto_dataset.put_item
+        if proto_dataset._storage_broker.key == 'file':
+            # source directory -> link mode of the items from there
+            link_dirs = {str(repo.dot_git / 'annex' / 'objects'): link_mode}
+            if previous is not None:
+                link_dirs[previous._storage_broker._data_abspath] = \
+                    'hardlink' if link_mode == 'copy' else link_mode
+            if link_mode != 'copy' or previous is not None:
+                put_item = ItemLinker(proto_dataset, link_dirs)
+        else:
+            if link_mode != 'copy':
+                lgr.warning("Cannot link items into dtool dataset at %s, "
+                            "copy them instead", uri)
+            if previous is not None:
+                lgr.info("Cannot reuse items in dtool dataset at %s, not "
+                         "on local disk", uri)
+                previous = None
+            if jobs and jobs > 1:
+                put_item = ItemPutter(proto_dataset)
+        if previous is not None:
+            previous_items = previous._manifest['items']
+            same_hash_function = \
+                manifest_hash_function(previous) == hash_function
 
-            uri = dtool_dataset_creator.proto_dataset.uri
-            lgr.debug("Created dataset will be available at '%s'", uri)
+        def iter_items():
+            # (source path, relpath, size) of the items, as the files
+            # of the commit are listed
+            nonlocal n_reused
+            for record in iter_content(repo, ref=datalad_commit):
+                p = record.path
+                # repath in the dtool dataset
+                relpath = str(p.relative_to(repo.pathobj))
 
-            if not suppress_provenance_annotations:
-                dtool_dataset_creator.put_annotation("datalad-uuid", datalad_uuid)
-                dtool_dataset_creator.put_annotation("datalad-commit", datalad_commit)
+                reused = None
+                if previous is not None and relpath not in changed:
+                    identifier = generate_identifier(relpath)
+                    reused = previous_items.get(identifier)
+                if reused is not None:
+                    yield (
+                        item_content_abspath(previous, identifier, relpath),
+                        relpath, reused['size_in_bytes'])
+                    if same_hash_function:
+                        known_items[relpath] = (
+                            reused['hash'], reused['size_in_bytes'])
+                    n_reused += 1
+                    continue
 
-            for p, props in repo_files.items():
-                if 'key' in props and not props.get('has_content', False):
+                if not record.has_content:
                     if missing_content in ('ignore', 'continue'):
                         (lgr.warning if missing_content == 'continue' else lgr.debug)(
                             'File %s has no content available, skipped', p)
@@ -141,18 +264,29 @@ class DtoolExport(Interface):
                     else:
                         raise IOError('File %s has no content available' % p)
 
-                # repath in the dtool dataset
-                relpath = str(p.relative_to(repo.pathobj))
+                in_fpath = p if record.key is None else record.objloc
 
-                in_fpath = p if 'key' not in props else props['objloc']
+                size = record.size
+                if size is None:
+                    size = os.path.getsize(in_fpath)
+                yield in_fpath, relpath, size
 
-                lgr.debug(f"Write content of '%s' physically located at '%s'.",
-                          relpath, in_fpath)
+                if record.key is not None:
+                    key = parse_key(record.key)
+                    if key.size is not None \
+                            and backend_matches(hash_function, key.backend):
+                        known_items[relpath] = (key.hash, key.size)
 
-                handle = dtool_dataset_creator.put_item(in_fpath, relpath)
+        for handle in put_items(put_item, iter_items(), jobs=jobs):
+            lgr.debug("Added item '%s' to dtool dataset '%s'.",
+                      handle, uri)
+        if isinstance(put_item, ItemLinker):
+            lgr.info("Put items into dtool dataset by %s",
+                     ', '.join(f'{mode} ({n})' for mode, n
+                               in sorted(put_item.modes.items())))
 
-                lgr.debug("Added item '%s' to dtool dataset '%s'.",
-                          handle, uri)
+        # an interrupted export leaves the proto dataset unfrozen
+        freeze(proto_dataset, known_items)
 
         yield get_status_dict(
             # an action label must be defined, the command name make a good
@@ -168,4 +302,127 @@ class DtoolExport(Interface):
             # case string expansion with arguments is delayed until the
             # message actually needs to be rendered (analog to exception
             # messages)
-            message=f"Created and froze dtool dataset '{uri}'.")
\ No newline at end of file
+            message=f"Created and froze dtool dataset '{uri}'." + (
+                f" Reused {n_reused} items of '{previous.uri}'."
+                if previous is not None else ''))
+
+
+class ItemLinker:
+    """Put items into a dtool proto dataset on local disk, linking them to
+    their source by the mode of its directory.
+
+    Stands in for :meth:`dtoolcore.ProtoDataSet.put_item`. Items whose
+    source lies below one of `link_dirs`, e.g. annex objects or items of a
+    frozen dtool dataset, are linked or reflinked to it with
+    :func:`link_file`. All others are copied, so that the dtool dataset
+    never shares content with files in the worktree.
+
+    :param proto_dataset: :class:`dtoolcore.ProtoDataSet` at a file:// URI
+    :param link_dirs: dict of one of :data:`LINK_MODES` by source directory
+    """
+
+    def __init__(self, proto_dataset, link_dirs):
+        self.data_abspath = proto_dataset._storage_broker._data_abspath
+        self.link_dirs = [(os.path.join(d, ''), mode)
+                          for d, mode in link_dirs.items()]
+        #: number of items put by mode used
+        self.modes = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, in_fpath, relpath):
+        dest_path = os.path.join(self.data_abspath,
+                                 handle_to_osrelpath(relpath, IS_WINDOWS))
+        mkdir_parents(os.path.dirname(dest_path))
+        in_fpath = str(in_fpath)
+        for link_dir, mode in self.link_dirs:
+            if in_fpath.startswith(link_dir):
+                break
+        else:
+            mode = 'copy'
+        used = link_file(in_fpath, dest_path, mode=mode)
+        with self._lock:
+            self.modes[used] += 1
+        return relpath
+
+
+class ItemPutter:
+    """Put items into a dtool proto dataset with one storage broker per
+    thread.
+
+    Stands in for :meth:`dtoolcore.ProtoDataSet.put_item` with more than
+    one job. Storage brokers of remote storage, e.g. S3 or Azure, hold
+    clients that must not be shared between threads, so that each thread
+    opens the proto dataset again. Brokers are opened one at a time.
+
+    :param proto_dataset: :class:`dtoolcore.ProtoDataSet`
+    """
+
+    def __init__(self, proto_dataset):
+        self.uri = proto_dataset.uri
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __call__(self, in_fpath, relpath):
+        proto_dataset = getattr(self._local, 'proto_dataset', None)
+        if proto_dataset is None:
+            with self._lock:
+                proto_dataset = ProtoDataSet.from_uri(self.uri)
+            self._local.proto_dataset = proto_dataset
+        return proto_dataset.put_item(in_fpath, relpath)
+
+
+def put_items(put_item, items, jobs=None, window=None):
+    """Put items into a dtool dataset, up to `jobs` at a time.
+
+    Items are consumed as they come, the first item is put before the last
+    one is known. With more than one job, items are put on a thread pool,
+    the largest of up to `window` items read ahead first, so that the
+    export does not end waiting for a single large upload. The first error
+    cancels all items not started yet and is raised once the running
+    uploads finished.
+
+    :param put_item: callable putting an item into the dtool dataset as
+      ``put_item(source path, relpath)`` and returning its handle, e.g.
+      :meth:`dtoolcore.ProtoDataSet.put_item`. With more than one job, it
+      is called from several threads at once, see :class:`ItemPutter`.
+    :param items: iterable of (source path, relpath, size in bytes) of the
+      items
+    :param jobs: number of concurrent uploads
+    :param window: number of items read ahead with more than one job,
+      defaults to 64 per job
+    :returns: generator of the handles of the items put, as they finish
+    """
+    def put(in_fpath, relpath):
+        lgr.debug("Write content of '%s' physically located at '%s'.",
+                  relpath, in_fpath)
+        return put_item(in_fpath, relpath)
+
+    if not jobs or jobs < 2:
+        for in_fpath, relpath, _ in items:
+            yield put(in_fpath, relpath)
+        return
+
+    window = max(window or 64 * jobs, jobs)
+    items = iter(items)
+    # heap of (-size, number, item) of the items read ahead, not put yet
+    pending = []
+    order = itertools.count()
+    futures = set()
+    with ThreadPoolExecutor(max_workers=jobs,
+                            thread_name_prefix='dtool-export') as executor:
+        try:
+            while True:
+                for item in itertools.islice(
+                        items, max(window - len(pending) - len(futures), 0)):
+                    heapq.heappush(pending, (-item[2], next(order), item))
+                while pending and len(futures) < jobs:
+                    in_fpath, relpath, _ = heapq.heappop(pending)[2]
+                    futures.add(executor.submit(put, in_fpath, relpath))
+                if not futures:
+                    break
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
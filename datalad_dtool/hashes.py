@@ -0,0 +1,52 @@
+"""Correspondence of dtool hash functions and git-annex key backends"""
+
+__docformat__ = 'restructuredtext'
+
+import hashlib
+
+#: dtool item hash function name -> (hashlib algorithm, git-annex backends
+#: whose keys carry the same hash)
+HASH_FUNCTIONS = {
+    'md5sum_hexdigest': ('md5', ('MD5', 'MD5E')),
+    'sha1sum_hexdigest': ('sha1', ('SHA1', 'SHA1E')),
+    'sha256sum_hexdigest': ('sha256', ('SHA256', 'SHA256E')),
+    'sha512sum_hexdigest': ('sha512', ('SHA512', 'SHA512E')),
+}
+
+
+def register_hash_function(hash_function, algorithm, backends):
+    """Declare that items hashed by dtool `hash_function` carry the
+    `algorithm` hexdigest, the same hash as keys of the annex `backends`."""
+    HASH_FUNCTIONS[hash_function] = (algorithm, tuple(backends))
+
+
+def backend_matches(hash_function, backend):
+    """Return True if keys of `backend` carry item hashes of `hash_function`."""
+    return backend in HASH_FUNCTIONS.get(hash_function, (None, ()))[1]
+
+
+def hash_function_for_backend(backend):
+    """Return name of the hash function matching annex `backend`, or None."""
+    for hash_function, (_, backends) in HASH_FUNCTIONS.items():
+        if backend in backends:
+            return hash_function
+    return None
+
+
+def key_backend_for_hash_function(hash_function):
+    """Return the annex backend to create keys with from item hashes of
+    `hash_function`, preferring one that keeps file extensions, or None."""
+    backends = HASH_FUNCTIONS.get(hash_function, (None, ()))[1]
+    for backend in backends:
+        if backend.endswith('E'):
+            return backend
+    return backends[0] if backends else None
+
+
+def file_hexdigest(path, hash_function, bufsize=2 ** 20):
+    """Return hash of the content of file `path` as computed by `hash_function`."""
+    hasher = hashlib.new(HASH_FUNCTIONS[hash_function][0])
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(bufsize), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
@@ -1,9 +1,12 @@
 """DataLad extension for the Climate Data Store"""
 
 __docformat__ = "restructuredtext"
+import functools
 import logging
+import posixpath
+import time
 
-from typing import Literal, Optional
+from typing import List, Literal, Optional
 
 from datalad.distribution.dataset import (
     EnsureDataset,
@@ -13,13 +16,44 @@ from datalad.distribution.dataset import (
 from datalad.interface.base import Interface, build_doc, eval_results
 from datalad.interface.common_opts import nosave_opt, save_message_opt
 from datalad.interface.results import get_status_dict
+from datalad.log import log_progress
 from datalad.support.annexrepo import AnnexRepo
-from datalad.support.constraints import EnsureNone, EnsureStr, EnsureChoice
+from datalad.support.constraints import (
+    EnsureChoice,
+    EnsureInt,
+    EnsureListOf,
+    EnsureNone,
+    EnsureStr,
+)
+from datalad.support.exceptions import AnnexBatchCommandError, CommandError
 from datalad.support.param import Parameter
 
 from dtoolcore import DataSet
 from dtoolcore.utils import sanitise_uri
 
+from datalad_dtool.hashes import key_backend_for_hash_function
+from datalad_dtool.import_state import (
+    StateWriter,
+    STATE_ATTRIBUTES,
+    diff_items,
+    iter_state_items,
+    partial_state_path,
+    read_state,
+    state_attributes_path,
+    state_path,
+)
+from datalad_dtool.keys import format_key, key_extension
+from datalad_dtool.metadata import AnnexMetadataWriter
+from datalad_dtool.plan import ImportPlan
+from datalad_dtool.remotes import RemoteRegistry, remote_name
+from datalad_dtool.select import PathSelector
+from datalad_dtool.tree import TreeWriter
+from datalad_dtool.manifest import (
+    iter_manifest_items,
+    iter_sorted_manifest_items,
+    manifest_hash_function,
+)
+
 logger = logging.getLogger("datalad.dtool.import")
 
 
@@ -48,6 +82,67 @@ class DtoolImport(Interface):
             doc="""Relative target path to import to within datalad dataset.""",
             constraints=EnsureStr() | EnsureNone(),
         ),
+        metadata_only=Parameter(
+            args=("--metadata-only",),
+            action="store_true",
+            doc="""register items under keys built from the hashes and sizes
+            in the dtool manifest, e.g. MD5E keys, instead of downloading
+            their content. Items are recorded as present in the dtool special
+            remote, items of identical content share a key."""),
+        include=Parameter(
+            args=("--include",),
+            action="append",
+            metavar="PATTERN",
+            doc="""only import items whose relpath in the dtool dataset
+            matches PATTERN, or lies below a directory matching it. Patterns
+            may contain shell wildcards per path component and ``**`` for
+            any number of directories, e.g. ``raw/2024-*/**/*.h5``. Can be
+            given multiple times.""",
+            constraints=EnsureListOf(str) | EnsureNone()),
+        exclude=Parameter(
+            args=("--exclude",),
+            action="append",
+            metavar="PATTERN",
+            doc="""do not import items matching PATTERN, see
+            [CMD: --include CMD][PY: `include` PY]. Can be given multiple
+            times.""",
+            constraints=EnsureListOf(str) | EnsureNone()),
+        annex_metadata=Parameter(
+            args=("--annex-metadata",),
+            action="store_true",
+            doc="""record the values of dtool overlays as git-annex metadata
+            of the imported files, in fields named after the overlays. dtool
+            annotations are recorded as metadata of all imported files."""),
+        chunk_items=Parameter(
+            args=("--chunk-items",),
+            metavar="N",
+            doc="""save the dataset after every N registered items. An
+            interrupted import resumes after the last saved chunk when run
+            again.""",
+            constraints=EnsureInt() | EnsureNone()),
+        chunk_bytes=Parameter(
+            args=("--chunk-bytes",),
+            metavar="BYTES",
+            doc="""save the dataset whenever registered items add up to
+            BYTES of content.""",
+            constraints=EnsureInt() | EnsureNone()),
+        dry_run=Parameter(
+            args=("--dry-run",),
+            action="store_true",
+            doc="""only report the number of items and bytes to import,
+            duplicate hashes, paths colliding with files in the dataset and
+            the git objects to write, from a single pass over the dtool
+            manifest. Neither the dataset nor the special remote are
+            modified."""),
+        tree_only=Parameter(
+            args=("--tree-only",),
+            action="store_true",
+            doc="""write the annex symlinks of the items straight into a new
+            commit with git fast-import, instead of creating them in the
+            worktree and saving the dataset, then let git check out the
+            files that changed. Implies [CMD: --metadata-only CMD][PY:
+            `metadata_only` PY]. All items are committed at once, chunk
+            options do not apply. Not supported on adjusted branches."""),
         save=nosave_opt,
         message=save_message_opt,
     )
@@ -60,6 +155,14 @@ class DtoolImport(Interface):
         *,
         dataset: Optional[str] = None,
         path: Optional[str] = None,
+        metadata_only: bool = False,
+        include: Optional[List[str]] = None,
+        exclude: Optional[List[str]] = None,
+        annex_metadata: bool = False,
+        chunk_items: Optional[int] = None,
+        chunk_bytes: Optional[int] = None,
+        dry_run: bool = False,
+        tree_only: bool = False,
         message: Optional[str] = None,
         save: bool = True):
 
@@ -67,58 +170,435 @@ class DtoolImport(Interface):
         logger.debug("Sanitized dtool dataset URI: %s", sanitised_uri)
 
         ds = require_dataset(dataset, check_installed=True)
-        ensure_special_remote_exists_and_is_enabled(
-            repo=ds.repo, uri=sanitised_uri)
-
+        if tree_only and (not save or ds.repo.is_managed_branch()):
+            yield get_status_dict(
+                action="import-dtool", ds=ds, status="impossible",
+                message="tree-only import requires saving to a branch that "
+                        "is not adjusted")
+            return
+        metadata_only = metadata_only or tree_only
+        dtool_dataset = DataSet.from_uri(sanitised_uri)
         if path is None:
             pathobj = ds.pathobj
         else:
             pathobj = ds.pathobj / path
 
-        dtool_dataset = DataSet.from_uri(sanitised_uri)
-        manifest = dtool_dataset.generate_manifest()
-        for uuid, entry in manifest['items'].items():
-            relpath = entry["relpath"]
+        state_file = state_path(ds.pathobj, pathobj)
+        try:
+            previous_uuid, previous_uri = read_state(state_file)
+        except ValueError as exc:
+            yield get_status_dict(
+                action="import-dtool", ds=ds, path=str(state_file),
+                status="impossible", message=str(exc))
+            return
+
+        if dry_run:
+            chunked = save and not tree_only
+            yield from _plan_import(
+                ds, pathobj, _select_items(dtool_dataset, include, exclude)[0],
+                chunk_items=chunk_items if chunked else None,
+                chunk_bytes=chunk_bytes if chunked else None,
+                state_changed=(previous_uuid, previous_uri)
+                != (dtool_dataset.uuid, sanitised_uri))
+            return
+
+        ensure_special_remote_exists_and_is_enabled(
+            repo=ds.repo, uri=sanitised_uri, dtool_uuid=dtool_dataset.uuid)
+
+        msg = (
+            message
+            if message is not None
+            else "[DATALAD] import from dtool dataset '{}'".format(uri)
+        )
+        tree = None
+        if metadata_only:
+            hash_function = manifest_hash_function(dtool_dataset)
+            backend = key_backend_for_hash_function(hash_function)
+            if backend is None:
+                yield get_status_dict(
+                    action="import-dtool", ds=ds, status="impossible",
+                    message=("no annex backend for dtool hash function %s",
+                             hash_function))
+                return
+            if tree_only:
+                try:
+                    tree = TreeWriter(ds.repo, msg)
+                except ValueError as exc:
+                    yield get_status_dict(
+                        action="import-dtool", ds=ds, status="impossible",
+                        message=str(exc))
+                    return
+            register_item = KeyRegistrar(ds.repo, backend, tree=tree)
+            register_url = register_item.register_url
+        else:
+            register_item = functools.partial(_add_url, ds.repo)
+            register_url = functools.partial(_register_url, ds.repo)
+        set_metadata = AnnexMetadataWriter(ds.repo, dtool_dataset) \
+            if annex_metadata else None
+        if previous_uuid is not None:
+            logger.debug("Update import of dtool dataset %s from %s",
+                         previous_uuid, previous_uri)
+        state = StateWriter(
+            str(state_file), partial_state_path(ds.repo.dot_git, state_file),
+            dtool_dataset.uuid, sanitised_uri)
+        # chunks can only be resumed from if they are saved
+        chunked = save and (chunk_items or chunk_bytes) and not tree_only
+        resume_after = state.open(resume=save)
+        if state.resumed:
+            logger.info("Resume interrupted import of dtool dataset %s",
+                        sanitised_uri)
+
+        items, n_items = _select_items(dtool_dataset, include, exclude)
+        pid = f"import_dtool_{dtool_dataset.uuid}"
+        log_progress(logger.info, pid,
+                     "Register URLs of %d items", n_items,
+                     label="Registering URLs", total=n_items, unit=" Items")
+        counts = dict.fromkeys(
+            ('added', 'updated', 'removed', 'unchanged', 'resumed'), 0)
+        # paths changed since the last saved chunk
+        chunk_paths = []
+        chunk_size = 0
+        start = time.monotonic()
+        # only items that changed since the recorded import are touched,
+        # all of them go through long-running batched git-annex sessions
+        for uuid, old, new in diff_items(
+                iter_state_items(state_file),
+                items):
+            if resume_after is not None and uuid <= resume_after:
+                # saved by the interrupted import
+                counts['resumed'] += 1
+                log_progress(logger.info, pid, "Resumed item %s", uuid,
+                             update=1, increment=True)
+                continue
+            if old is not None and new is not None \
+                    and old['hash'] == new['hash'] \
+                    and old['relpath'] == new['relpath']:
+                state.write(uuid, new['hash'], new['relpath'])
+                counts['unchanged'] += 1
+                if previous_uuid != dtool_dataset.uuid:
+                    # the item is available from the newer dtool dataset
+                    # as well, also once the older one is gone
+                    try:
+                        register_url(pathobj / new['relpath'],
+                                     f'dtool:{sanitised_uri}/{uuid}', new)
+                    except (AnnexBatchCommandError, CommandError) as exc:
+                        yield get_status_dict(
+                            action="import-dtool", ds=ds,
+                            path=str(pathobj / new['relpath']),
+                            status="error", message=str(exc), logger=logger)
+                if set_metadata is not None \
+                        and previous_uuid != dtool_dataset.uuid:
+                    # overlays and annotations of the newer dtool dataset
+                    yield from _set_annex_metadata(
+                        ds, set_metadata, pathobj / new['relpath'], uuid)
+                log_progress(logger.info, pid, "Unchanged item %s", uuid,
+                             update=1, increment=True)
+                continue
+            if old is not None:
+                old_pathobj = pathobj / old['relpath']
+                if tree is None:
+                    _unlink(old_pathobj)
+                else:
+                    tree.remove(old_pathobj)
+                if chunked:
+                    chunk_paths.append(old_pathobj)
+                if new is None:
+                    logger.debug("Removed item '%s' at '%s'",
+                                 uuid, old_pathobj)
+                    counts['removed'] += 1
+                    continue
+
+            relpath = new["relpath"]
             file_pathobj = pathobj / relpath
+            if state.resumed and old is None:
+                # left behind unsaved by the interrupted import
+                _unlink(file_pathobj)
             dtool_item_uri = f'dtool:{sanitised_uri}/{uuid}'
             logger.debug(
                 "Import dtool dataset URI '%s' item '%s' to path '%s' within '%s'",
                 sanitised_uri, uuid, relpath, pathobj)
-            ds.repo.add_url_to_file(file_pathobj, dtool_item_uri)
+            try:
+                key = register_item(file_pathobj, dtool_item_uri, new)
+            except (AnnexBatchCommandError, CommandError) as exc:
+                # not recorded, retried by the next import
+                yield get_status_dict(
+                    action="import-dtool", ds=ds, path=str(file_pathobj),
+                    status="error", message=str(exc), logger=logger)
+            else:
+                state.write(uuid, new['hash'], relpath)
+                counts['added' if old is None else 'updated'] += 1
+                if set_metadata is not None:
+                    yield from _set_annex_metadata(
+                        ds, set_metadata, file_pathobj, uuid, key)
+                if chunked:
+                    chunk_paths.append(file_pathobj)
+                    chunk_size += new['size_in_bytes']
+            log_progress(logger.info, pid,
+                         "Registered item %s", uuid,
+                         update=1, increment=True)
+
+            if chunked and chunk_paths and (
+                    (chunk_items and len(chunk_paths) >= chunk_items)
+                    or (chunk_bytes and chunk_size >= chunk_bytes)):
+                ds.repo.precommit()
+                yield ds.save(chunk_paths, message=msg)
+                state.checkpoint()
+                logger.debug("Saved chunk of %d paths, %d bytes",
+                             len(chunk_paths), chunk_size)
+                chunk_paths = []
+                chunk_size = 0
+        log_progress(logger.info, pid, "Finished registering URLs")
+        # flush the batched sessions before saving
+        ds.repo.precommit()
+        elapsed = time.monotonic() - start
+        n_registered = counts['added'] + counts['updated']
+        rate = n_registered / elapsed if elapsed > 0 else float(n_registered)
+        logger.info("Registered %d items in %.1fs (%.1f items/s)",
+                    n_registered, elapsed, rate)
+
+        changed = previous_uuid != dtool_dataset.uuid or state.resumed or \
+            counts['added'] or counts['updated'] or counts['removed']
+        attributes_file = state_attributes_path(ds.pathobj)
+        if tree is not None and changed:
+            # the state is committed along with the items
+            state.flush()
+            if not attributes_file.exists():
+                tree.add_content(attributes_file,
+                                 STATE_ATTRIBUTES.encode('utf-8'))
+            tree.add_file(state_file, state.partial_path)
+            try:
+                commit = tree.close()
+            except CommandError as exc:
+                state.discard()
+                yield get_status_dict(
+                    action="import-dtool", ds=ds, status="error",
+                    message=str(exc), logger=logger)
+                return
+            # only once committed, a resumed import skips the items
+            state.checkpoint()
+            try:
+                tree.update_worktree(commit)
+            except CommandError as exc:
+                yield get_status_dict(
+                    action="save", ds=ds, status="error", logger=logger,
+                    message=("committed %s, but failed to check it out: %s",
+                             commit, exc))
+            else:
+                yield get_status_dict(
+                    action="save", ds=ds, status="ok", logger=logger,
+                    message=("committed %d changes as %s",
+                             tree.n_changes, commit))
+        elif tree is not None:
+            tree.abort()
+        if not changed:
+            state.discard()
+        else:
+            state.commit()
+            if not attributes_file.exists():
+                attributes_file.write_text(STATE_ATTRIBUTES)
 
-        if save:
-            msg = (
-                message
-                if message is not None
-                else "[DATALAD] import from dtool dataset '{}'".format(uri)
-            )
-            yield ds.save(pathobj, message=msg)
+        if save and changed and tree is None:
+            # with chunks, only the paths of the last chunk are left to save
+            yield ds.save(
+                (chunk_paths if chunked else [pathobj])
+                + [attributes_file, state_file],
+                message=msg)
 
-        yield get_status_dict(action="import-dtool", ds=ds, status="ok")
+        yield get_status_dict(
+            action="import-dtool", ds=ds, status="ok" if changed else "notneeded",
+            message=("added %d, updated %d, removed %d, unchanged %d, "
+                     "resumed %d items, registered %.1f items/s",
+                     counts['added'], counts['updated'], counts['removed'],
+                     counts['unchanged'], counts['resumed'], rate))
+
+
+def _select_items(dtool_dataset, include, exclude):
+    """Return iterator over the (identifier, properties) of the items
+    selected by `include` and `exclude` patterns, sorted by identifier, and
+    their number."""
+    items = iter_sorted_manifest_items(dtool_dataset)
+    n_items = len(dtool_dataset.identifiers)
+    if not include and not exclude:
+        return items, n_items
+    select_start = time.monotonic()
+    selector = PathSelector(include, exclude)
+    selected = {identifier
+                for identifier, props in iter_manifest_items(dtool_dataset)
+                if selector(props['relpath'])}
+    logger.info("Selected %d of %d items in %.2fs",
+                len(selected), n_items, time.monotonic() - select_start)
+    # previously imported items no longer selected are removed
+    items = ((identifier, props) for identifier, props in items
+             if identifier in selected)
+    return items, len(selected)
+
+
+def _plan_import(ds, pathobj, items, chunk_items=None, chunk_bytes=None,
+                 state_changed=False):
+    """Yield path collisions and the projected cost of importing `items`
+    to `pathobj` within `ds`, without modifying anything.
+
+    Collisions are "ok" results flagged as ``collision``, a dry run does
+    not fail on them.
+    """
+    target = pathobj.relative_to(ds.pathobj).as_posix()
+    target = '' if target == '.' else target
+    state_file = state_path(ds.pathobj, pathobj)
+    existing = set()
+    if ds.repo.get_hexsha() is not None:
+        existing.update(ds.repo.call_git_items_(
+            ['ls-tree', '-r', '-z', '--name-only', 'HEAD', '--',
+             target or '.'],
+            sep='\0', read_only=True))
+    # files of the previous import are replaced, not collided with
+    for _, props in iter_state_items(state_file):
+        existing.discard(posixpath.join(target, props['relpath']))
+    plan = ImportPlan(target, existing,
+                      chunk_items=chunk_items, chunk_bytes=chunk_bytes)
+    for _, old, new in diff_items(iter_state_items(state_file), items):
+        plan.add(old, new)
+    plan.finish(state_file.relative_to(ds.pathobj).as_posix(),
+                state_changed=state_changed)
+
+    for path in plan.collisions:
+        yield get_status_dict(
+            action="import-dtool", ds=ds, path=str(ds.pathobj / path),
+            status="ok", dry_run=True, collision=True,
+            message="path exists in the dataset, but was not imported "
+                    "from dtool")
+    yield get_status_dict(
+        action="import-dtool", ds=ds, status="ok", dry_run=True,
+        items=plan.n_items, bytes=plan.n_bytes,
+        duplicate_hashes=plan.n_duplicate_hashes,
+        duplicate_items=plan.n_duplicate_items,
+        collisions=len(plan.collisions),
+        git_objects=plan.n_git_objects, git_commits=plan.n_commits,
+        **plan.counts,
+        message=("would add %d, update %d, remove %d items, register %d "
+                 "bytes, %d duplicate hashes, %d path collisions, write %d "
+                 "git objects in %d commits",
+                 plan.counts['added'], plan.counts['updated'],
+                 plan.counts['removed'], plan.n_bytes,
+                 plan.n_duplicate_hashes, len(plan.collisions),
+                 plan.n_git_objects, plan.n_commits))
+
+
+def _set_annex_metadata(ds, set_metadata, file_pathobj, uuid, key=None):
+    try:
+        set_metadata(file_pathobj, uuid, key=key)
+    except (AnnexBatchCommandError, CommandError) as exc:
+        yield get_status_dict(
+            action="import-dtool", ds=ds, path=str(file_pathobj),
+            status="error", message=str(exc), logger=logger)
+
+
+def _unlink(pathobj):
+    if pathobj.is_symlink() or pathobj.exists():
+        pathobj.unlink()
+
+
+def _add_url(repo, file_pathobj, url, entry):
+    # git-annex downloads the item to compute its key, the file is not
+    # recorded before the batched session is flushed
+    return repo.add_url_to_file(file_pathobj, url, batch=True).get('key')
+
+
+def _register_url(repo, file_pathobj, url, entry):
+    # the key of a file imported before is looked up, not recomputed
+    filename = str(file_pathobj.relative_to(repo.pathobj))
+    key = repo._batched.get('lookupkey', path=repo.path)(filename)
+    if not key:
+        raise AnnexBatchCommandError(
+            cmd="lookupkey", msg=f"No annex key for file {filename}")
+    repo._batched.get('registerurl', path=repo.path, output_proc=_ignore)(
+        (key, url))
+
+
+class KeyRegistrar:
+    """Register dtool items under annex keys built from their manifest entry.
+
+    Keys are formed from the item hash, size and file extension, e.g.
+    ``MD5E-s<size>--<md5><ext>``, so that no content is transferred. The
+    dtool URL is registered with ``registerurl``, which records the key as
+    present in the special remote claiming it, the file is created with
+    ``fromkey``. Both run as batched git-annex sessions. With a `tree`, the
+    file is written as annex symlink into its commit instead.
+
+    :param repo: :class:`AnnexRepo` to register items in
+    :param backend: annex backend whose keys carry the item hashes
+    :param tree: :class:`TreeWriter` to add files to, or None
+    """
+
+    def __init__(self, repo, backend, tree=None):
+        self.repo = repo
+        self.backend = backend
+        self.tree = tree
+        # item hash -> key, items of identical content share one key
+        self._keys = {}
+
+    def __call__(self, file_pathobj, url, entry):
+        """Register item of manifest `entry` at `url` as `file_pathobj`,
+        return its key."""
+        key = self.register_url(file_pathobj, url, entry)
+        if self.tree is not None:
+            self.tree.annex_link(file_pathobj, key)
+            return key
+        filename = str(file_pathobj.relative_to(self.repo.pathobj))
+        # --force: the key's content is not present locally
+        out_json = self._batch('fromkey', (key, filename), json=True,
+                               annex_options=['--force'])
+        if not out_json or not out_json.get('success', False):
+            raise AnnexBatchCommandError(
+                cmd="fromkey",
+                msg="Failed to create file %s for key %s: %s"
+                    % (filename, key, out_json))
+        return key
+
+    def register_url(self, file_pathobj, url, entry):
+        """Register `url` of the item of manifest `entry`, without creating
+        a file, and return its key."""
+        key = self._keys.get(entry['hash'])
+        if key is None:
+            name = entry['hash']
+            if self.backend.endswith('E'):
+                name += key_extension(entry['relpath'])
+            key = format_key(self.backend, name, size=entry['size_in_bytes'])
+            self._keys[entry['hash']] = key
+            self._batch('registerurl', (key, url), output_proc=_ignore)
+        return key
+
+    def _batch(self, command, batch_input, **kwargs):
+        bcmd = self.repo._batched.get(command, path=self.repo.path, **kwargs)
+        return bcmd(batch_input)
+
+
+def _ignore(stdout):
+    # registerurl --batch does not respond to a line
+    return
 
 
 def ensure_special_remote_exists_and_is_enabled(
-    repo: AnnexRepo, uri: str,
-) -> None:
+    repo: AnnexRepo, uri: str, dtool_uuid: str,
+) -> str:
     """Initialize and enable the dtool special remote, if it isn't already.
 
-    Very similar to datalad.customremotes.base.ensure_datalad_remote.
-    """
+    A dtool special remote initialized with ``multi=yes`` serves any dtool
+    dataset and is used instead of a new remote for `uri`, if present. New
+    remotes are named after the UUID `dtool_uuid` of the dtool dataset.
 
-    special_remotes = repo.get_special_remotes()
+    Very similar to datalad.customremotes.base.ensure_datalad_remote.
 
-    special_remote_candidate = None
-    for uuid, special_remote in special_remotes.items():
-        if special_remote.get('externaltype', None) == 'dtool':
-            if special_remote.get('uri', None) == uri:
-                special_remote_candidate = special_remote
-                break
+    :returns: name of the special remote
+    """
+    registry = RemoteRegistry(repo)
+    name = registry.lookup(uri)
 
-    if special_remote_candidate is None:
-        uri_hash = hash(uri)
-        hex_uri_hash = hex(uri_hash)[2:]
-        name = f"dtool-{hex_uri_hash}"
-        logger.debug("no suitable special remote found, initialize dtool remote")
+    if name is None:
+        name = remote_name(dtool_uuid)
+        if name in registry.names():
+            # a remote for a copy of the dtool dataset at another URI
+            name = remote_name(dtool_uuid, uri)
+        logger.debug("no suitable special remote found, initialize dtool remote %s", name)
         repo.init_remote(
             name,
             [
@@ -129,8 +609,10 @@ def ensure_special_remote_exists_and_is_enabled(
                 "uri={}".format(uri)
             ],
         )
-    elif repo.is_special_annex_remote(special_remote_candidate["name"], check_if_known=False):
-        logger.debug("special remote %s is enabled", special_remote_candidate["name"])
+        registry.add(uri, name)
+    elif repo.is_special_annex_remote(name, check_if_known=False):
+        logger.debug("special remote %s is enabled", name)
     else:
-        logger.debug("special remote %s found, enabling", special_remote_candidate["name"])
-        repo.enable_remote(special_remote_candidate["name"])
+        logger.debug("special remote %s found, enabling", name)
+        repo.enable_remote(name)
+    return name
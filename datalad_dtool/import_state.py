@@ -0,0 +1,201 @@
+"""Record of the dtool items imported into a DataLad dataset"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+import os
+import shutil
+import tempfile
+
+from dtoolcore.utils import generate_identifier
+
+logger = logging.getLogger(__name__)
+
+_HEADER_PREFIX = '# dtool-import'
+_COLUMNS = 'identifier\thash\trelpath'
+#: git attributes of the import states, committed to git instead of the
+#: annex so that they are available in every clone
+STATE_ATTRIBUTES = '* annex.largefiles=nothing\n'
+
+
+def state_path(ds_pathobj, target_pathobj):
+    """Return path of the import state of the import to `target_pathobj`.
+
+    State files are kept in ``.datalad/dtool`` of the DataLad dataset at
+    `ds_pathobj`, one per import target directory.
+    """
+    relpath = target_pathobj.relative_to(ds_pathobj).as_posix()
+    return ds_pathobj / '.datalad' / 'dtool' / \
+        f'import-{generate_identifier(relpath)}.tsv'
+
+
+def state_attributes_path(ds_pathobj):
+    """Return path of the ``.gitattributes`` holding
+    :data:`STATE_ATTRIBUTES` next to the import states."""
+    return ds_pathobj / '.datalad' / 'dtool' / '.gitattributes'
+
+
+def partial_state_path(dot_git, state_file):
+    """Return path of the partial state of an import in progress, kept in
+    the git directory `dot_git` until the import completes."""
+    return os.path.join(dot_git, 'dtool', os.path.basename(state_file) + '.part')
+
+
+def _open_state(path):
+    try:
+        return open(path)
+    except FileNotFoundError:
+        if os.path.lexists(path):
+            # annexed by an earlier version, content not present
+            raise ValueError(
+                f"Content of import state {path} not available, "
+                "get it with 'datalad get' first")
+        return None
+
+
+def read_state(path):
+    """Return (dtool dataset UUID, URI) of the last import recorded at `path`.
+
+    Returns (None, None) if nothing was imported yet.
+
+    :raises: ValueError if the state is invalid or its content not present
+    """
+    f = _open_state(path)
+    if f is None:
+        return None, None
+    with f:
+        header = f.readline()
+    if not header.startswith(_HEADER_PREFIX):
+        raise ValueError(f"Invalid import state {path}")
+    fields = dict(
+        field.split('=', 1) for field in header.rstrip('\n').split('\t')[1:])
+    return fields.get('uuid'), fields.get('uri')
+
+
+def iter_state_items(path):
+    """Yield (identifier, properties) of imported items, sorted by identifier,
+    read line by line from the state at `path`. Properties are the ``hash``
+    and ``relpath`` of the item's manifest entry."""
+    f = _open_state(path)
+    if f is None:
+        return
+    with f:
+        for line in f:
+            if line.startswith('#') or line.startswith('identifier\t'):
+                continue
+            identifier, file_hash, relpath = line.rstrip('\n').split('\t', 2)
+            yield identifier, {'hash': file_hash, 'relpath': relpath}
+
+
+def diff_items(old_items, new_items):
+    """Merge-join two streams of (identifier, properties), both sorted by
+    identifier.
+
+    Yields (identifier, old, new) for the union of identifiers, with old or
+    new None if the item is missing on that side.
+    """
+    old_items = iter(old_items)
+    new_items = iter(new_items)
+    old = next(old_items, None)
+    new = next(new_items, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield old[0], old[1], None
+            old = next(old_items, None)
+        elif old is None or new[0] < old[0]:
+            yield new[0], None, new[1]
+            new = next(new_items, None)
+        else:
+            yield old[0], old[1], new[1]
+            old = next(old_items, None)
+            new = next(new_items, None)
+
+
+class StateWriter:
+    """Write an import state, sorted by identifier, to `path`.
+
+    Rows go to a partial state at `partial_path`, outside the worktree, that
+    replaces the state on :meth:`commit`. An interrupted import leaves the
+    previous state in place, and the partial state up to its last
+    :meth:`checkpoint` lets the next import of the same dtool dataset resume.
+    """
+
+    def __init__(self, path, partial_path, uuid, uri):
+        self.path = path
+        self.partial_path = partial_path
+        self.resumed = False
+        self._cursor_path = partial_path + '.cursor'
+        self._header = (f'{_HEADER_PREFIX}\tuuid={uuid}\turi={uri}\n'
+                        f'{_COLUMNS}\n').encode('utf-8')
+        self._f = None
+
+    def open(self, resume=True):
+        """Start writing the state.
+
+        If `resume` and an interrupted import of the same dataset left a
+        partial state, continue it from its last checkpoint.
+
+        :returns: identifier of the last item recorded by the interrupted
+          import, or None
+        """
+        os.makedirs(os.path.dirname(self.partial_path), exist_ok=True)
+        last = self._resume() if resume else None
+        if not self.resumed:
+            self._f = open(self.partial_path, 'wb')
+            self._f.write(self._header)
+            self.checkpoint()
+        return last
+
+    def _resume(self):
+        try:
+            with open(self._cursor_path) as f:
+                offset = int(f.read())
+            f = open(self.partial_path, 'r+b')
+        except (OSError, ValueError):
+            return None
+        if f.read(len(self._header)) != self._header:
+            logger.debug("Discard partial state %s of another import",
+                         self.partial_path)
+            f.close()
+            return None
+        # drop rows written after the checkpoint
+        f.truncate(offset)
+        f.seek(offset)
+        self._f = f
+        self.resumed = True
+        last = None
+        for last, _ in iter_state_items(self.partial_path):
+            pass
+        logger.debug("Resume import after item %s", last)
+        return last
+
+    def write(self, identifier, file_hash, relpath):
+        self._f.write(f'{identifier}\t{file_hash}\t{relpath}\n'.encode('utf-8'))
+
+    def flush(self):
+        """Write all rows written so far to the partial state."""
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def checkpoint(self):
+        """Mark all rows written so far as committed to the dataset."""
+        self.flush()
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self._cursor_path), suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(self._f.tell()))
+        os.replace(tmp_path, self._cursor_path)
+
+    def commit(self):
+        """Replace the state by the rows written."""
+        self._f.close()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.move(self.partial_path, self.path)
+        os.unlink(self._cursor_path)
+        logger.debug("Recorded import state %s", self.path)
+
+    def discard(self):
+        """Drop the rows written, keep the previous state."""
+        self._f.close()
+        os.unlink(self.partial_path)
+        os.unlink(self._cursor_path)
@@ -0,0 +1,125 @@
+"""Parsing of git-annex keys"""
+
+__docformat__ = 'restructuredtext'
+
+import functools
+import hashlib
+from collections import namedtuple
+
+AnnexKey = namedtuple('AnnexKey', [
+    'backend', 'size', 'mtime', 'chunk_size', 'chunk_number', 'name', 'hash'])
+AnnexKey.__doc__ = """Fields of a git-annex key.
+
+``size``, ``mtime``, ``chunk_size`` and ``chunk_number`` are None if the key
+does not carry them. ``hash`` is the key name without the file extension
+that backends ending in ``E`` append.
+"""
+
+# key field tags, see https://git-annex.branchable.com/internals/key_format/
+_FIELDS = {
+    's': 'size',
+    'm': 'mtime',
+    'S': 'chunk_size',
+    'C': 'chunk_number',
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_key(key):
+    """Parse git-annex `key` of the form ``BACKEND[-sSIZE][-mMTIME]--NAME``.
+
+    :raises: ValueError if `key` is malformed
+    """
+    fields, sep, name = key.partition('--')
+    if not sep or not name:
+        raise ValueError(f"Invalid annex key {key}")
+    backend, *tagged = fields.split('-')
+    if not backend:
+        raise ValueError(f"Invalid annex key {key}")
+    values = dict.fromkeys(_FIELDS.values())
+    for field in tagged:
+        if field[:1] not in _FIELDS:
+            raise ValueError(f"Invalid field {field} in annex key {key}")
+        try:
+            values[_FIELDS[field[0]]] = int(field[1:])
+        except ValueError:
+            raise ValueError(f"Invalid field {field} in annex key {key}")
+    file_hash = name.split('.', 1)[0] if backend.endswith('E') else name
+    return AnnexKey(backend=backend, name=name, hash=file_hash, **values)
+
+
+def format_key(backend, name, size=None):
+    """Return git-annex key of `backend` for key `name`, e.g. a hash."""
+    size_field = '' if size is None else f'-s{size}'
+    return f'{backend}{size_field}--{name}'
+
+
+def _valid_in_extension(byte):
+    # ASCII letters and digits, any non-ASCII byte
+    return byte > 127 or chr(byte).isalnum()
+
+
+def key_extension(relpath, maxlen=4, maxextensions=2):
+    """Return extension of `relpath` as appended to keys of ``*E`` backends.
+
+    Follows git-annex with its default ``annex.maxextensionlength`` and
+    ``annex.maxextensions``: up to `maxextensions` trailing extensions of
+    at most `maxlen` bytes, of letters and digits only.
+    """
+    filename = relpath.rsplit('/', 1)[-1].encode('utf-8')
+    # a file ".foo" does not have its whole name as extension
+    if filename.startswith(b'.'):
+        filename = filename[1:]
+    extensions = filename.split(b'.')[1:]
+    selected = []
+    for extension in reversed(extensions):
+        if len(extension) > maxlen:
+            break
+        if all(_valid_in_extension(b) for b in extension):
+            selected.append(extension)
+    selected = [e for e in reversed(selected[:maxextensions]) if e]
+    return ''.join('.' + e.decode('utf-8') for e in selected)
+
+
+# digits of the hash directories, see Annex/DirHashes.hs of git-annex
+_HASHDIR_CHARS = '0123456789zqjxkmvwgpfZQJXKMVWGPF'
+
+
+def _hashdir_digits(word):
+    digits = [_HASHDIR_CHARS[(word >> (6 * i)) & 31] for i in range(8)]
+    # pairs swapped, the last pair is always 00
+    return ''.join(digits[i + 1] + digits[i] for i in range(0, 6, 2))
+
+
+def key_hashdir(key, lower=False, levels=2):
+    """Return hash directories of git-annex `key` below
+    ``.git/annex/objects``, e.g. ``PQ/x9/``.
+
+    By default ``hashdirmixed`` of non-bare repositories, ``hashdirlower``
+    if `lower`, as used by repositories with ``annex.tune.objecthashlower``.
+    `levels` is 1 in repositories with ``annex.tune.objecthash1``.
+    """
+    if lower:
+        digits = hashlib.md5(key.encode('utf-8')).hexdigest()
+        dirs = [digits[:3], digits[3:6]]
+    else:
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        words = (int.from_bytes(digest[i:i + 4], 'little')
+                 for i in range(0, 16, 4))
+        digits = ''.join(_hashdir_digits(w) for w in words)
+        dirs = [digits[:2], digits[2:4]]
+    return ''.join(d + '/' for d in dirs[:levels])
+
+
+def key_file(key):
+    """Return name of the file holding the content of `key`, escaped as
+    ``keyFile`` of git-annex does."""
+    return key.replace('&', '&a').replace('%', '&s').replace(':', '&c') \
+        .replace('/', '%')
+
+
+def key_object_path(key, lower=False, levels=2):
+    """Return path of the content of `key` relative to
+    ``.git/annex/objects``, with hash directories as by :func:`key_hashdir`."""
+    name = key_file(key)
+    return f'{key_hashdir(key, lower=lower, levels=levels)}{name}/{name}'
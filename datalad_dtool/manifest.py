@@ -0,0 +1,386 @@
+"""Lookup tables over the items of a dtool dataset manifest"""
+
+__docformat__ = 'restructuredtext'
+
+import bisect
+import datetime
+import logging
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+from collections import Counter
+from operator import itemgetter
+from pathlib import Path
+
+import dtoolcore
+from dtoolcore import DataSet
+from dtoolcore.utils import IS_WINDOWS, generate_identifier, handle_to_osrelpath
+
+logger = logging.getLogger(__name__)
+
+
+def manifest_hash_function(dataset):
+    """Return name of the hash function used for the items of `dataset`."""
+    if isinstance(dataset, DataSet):
+        # stored manifest, read only once and cached by the dataset
+        return dataset._manifest['hash_function']
+    return dataset._storage_broker.hasher.name
+
+
+def iter_manifest_items(dataset):
+    """Yield (identifier, properties) for all items of a dtool dataset.
+
+    Items of a frozen :class:`dtoolcore.DataSet` are read from the manifest
+    stored at freeze time, which already holds the content hash of every item.
+    ``generate_manifest()`` would hash the content of all items again. The
+    manifest is not streamed: dtoolcore parses the whole JSON document on
+    first access and keeps it with the dataset, items are yielded from
+    there. Only items of a :class:`dtoolcore.ProtoDataSet` are hashed, one
+    at a time as they are consumed.
+    """
+    if isinstance(dataset, DataSet):
+        # DataSet.item_properties formats a log message per call, iterate
+        # the stored manifest directly
+        yield from dataset._manifest['items'].items()
+    else:
+        logger.debug("Dataset %s not frozen, hash items", dataset.uri)
+        storage_broker = dataset._storage_broker
+        for handle in storage_broker.iter_item_handles():
+            yield (generate_identifier(handle),
+                   storage_broker.item_properties(handle))
+
+
+def iter_sorted_manifest_items(dataset):
+    """Yield (identifier, properties) for all items, sorted by identifier.
+
+    dtoolcore stores manifests with sorted keys, so the items of a frozen
+    dataset are usually in order already and are yielded from the parsed
+    manifest without a sorted copy.
+    """
+    if isinstance(dataset, DataSet):
+        previous = ''
+        for identifier in dataset._manifest['items']:
+            if identifier < previous:
+                logger.debug("Manifest of %s not sorted", dataset.uri)
+                break
+            previous = identifier
+        else:
+            return iter_manifest_items(dataset)
+    return iter(sorted(iter_manifest_items(dataset), key=itemgetter(0)))
+
+
+def generate_manifest(proto_dataset, known_items, progressbar=None):
+    """Return manifest of `proto_dataset` as generated when freezing it,
+    without hashing the content of items whose hash is known.
+
+    All other items are hashed by ``DTOOL_NUM_PROCESSES`` processes on
+    local disk, as :meth:`dtoolcore.ProtoDataSet.generate_manifest` does.
+
+    :param known_items: dict of (hash, size in bytes) by item handle, for
+      items whose content is known to hash to `hash` with the hash function
+      of the dataset, e.g. from the annex key of an exported file
+    """
+    storage_broker = proto_dataset._storage_broker
+    items = {}
+    unknown = []
+    for handle in storage_broker.iter_item_handles():
+        known = known_items.get(handle)
+        if known is None:
+            unknown.append(handle)
+            continue
+        items[generate_identifier(handle)] = {
+            'size_in_bytes': known[1],
+            'utc_timestamp': storage_broker.get_utc_timestamp(handle),
+            'hash': known[0],
+            'relpath': storage_broker.get_relpath(handle),
+        }
+        if progressbar:
+            progressbar.update(1)
+    n_processes = int(dtoolcore.utils.get_config_value(
+        'DTOOL_NUM_PROCESSES', default=1))
+    if n_processes > 1 and len(unknown) > 1 \
+            and is_local_dataset(proto_dataset):
+        with multiprocessing.Pool(n_processes) as pool:
+            hashed = pool.imap_unordered(
+                dtoolcore._get_identifier_and_item_properties,
+                [(proto_dataset, handle) for handle in unknown])
+            for identifier, properties in hashed:
+                items[identifier] = properties
+                if progressbar:
+                    progressbar.update(1)
+    else:
+        for handle in unknown:
+            items[generate_identifier(handle)] = \
+                storage_broker.item_properties(handle)
+            if progressbar:
+                progressbar.update(1)
+    logger.debug("Reused known hashes of %d of %d items of %s",
+                 len(items) - len(unknown), len(items), proto_dataset.uri)
+    return {
+        'items': items,
+        'dtoolcore_version': dtoolcore.__version__,
+        'hash_function': storage_broker.hasher.name,
+    }
+
+
+def freeze(proto_dataset, known_items, progressbar=None):
+    """Freeze `proto_dataset` as :meth:`dtoolcore.ProtoDataSet.freeze` does,
+    with the manifest of :func:`generate_manifest`."""
+    storage_broker = proto_dataset._storage_broker
+    storage_broker.pre_freeze_hook()
+    storage_broker.put_manifest(
+        generate_manifest(proto_dataset, known_items, progressbar=progressbar))
+    for name, overlay in proto_dataset._generate_overlays().items():
+        proto_dataset._put_overlay(name, overlay)
+    metadata_update = {'type': 'dataset'}
+    if 'frozen_at' not in proto_dataset._admin_metadata:
+        metadata_update['frozen_at'] = dtoolcore.utils.timestamp(
+            datetime.datetime.utcnow())
+    proto_dataset._admin_metadata.update(metadata_update)
+    storage_broker.put_admin_metadata(proto_dataset._admin_metadata)
+    storage_broker.post_freeze_hook()
+
+
+def is_local_dataset(dataset):
+    """Return True if item content of `dataset` is on local disk."""
+    return dataset._storage_broker.key in ('file', 'symlink')
+
+
+def item_content_abspath(dataset, identifier, relpath):
+    """Return absolute path at which item content can be accessed.
+
+    The disk storage broker re-reads the stored manifest on every
+    ``get_item_abspath`` call, for file:// datasets the path is derived from
+    the already known item `relpath` instead.
+    """
+    storage_broker = dataset._storage_broker
+    if storage_broker.key == 'file':
+        return os.path.join(storage_broker._data_abspath,
+                            handle_to_osrelpath(relpath, IS_WINDOWS))
+    return dataset.item_content_abspath(identifier)
+
+
+class ManifestIndex:
+    """In-memory index over the items of a dtool dataset.
+
+    Built once from a manifest, the index answers lookups of items by content
+    hash, item UUID, relpath and size in constant time instead of scanning
+    ``manifest['items']`` for every request.
+    """
+
+    def __init__(self, hash_function, items=()):
+        self.hash_function = hash_function
+        self._items = {}
+        self._by_hash = {}
+        self._by_relpath = {}
+        # size in bytes -> number of items
+        self._sizes = Counter()
+        self._relpath_order = None
+        for uuid, props in items:
+            self.add(uuid, props)
+
+    @classmethod
+    def from_manifest(cls, manifest):
+        """Build an index from a manifest dictionary as generated by dtoolcore."""
+        index = cls(manifest['hash_function'], manifest['items'].items())
+        logger.debug("Indexed %d items with hash function %s",
+                     len(index), index.hash_function)
+        return index
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        """Build an index over the items of a dtool dataset."""
+        index = cls(manifest_hash_function(dataset),
+                    iter_manifest_items(dataset))
+        logger.debug("Indexed %d items of dataset %s with hash function %s",
+                     len(index), dataset.uri, index.hash_function)
+        return index
+
+    def add(self, uuid, props):
+        """Add item of identifier `uuid` with manifest properties `props`."""
+        self._items[uuid] = props
+        self._by_hash.setdefault(props['hash'], []).append(uuid)
+        self._by_relpath[props['relpath']] = uuid
+        self._sizes[props['size_in_bytes']] += 1
+        self._relpath_order = None
+
+    def remove(self, uuid):
+        """Remove item of identifier `uuid`, if indexed."""
+        props = self._items.pop(uuid, None)
+        if props is None:
+            return
+        uuids = self._by_hash[props['hash']]
+        uuids.remove(uuid)
+        if not uuids:
+            del self._by_hash[props['hash']]
+        del self._by_relpath[props['relpath']]
+        self._sizes[props['size_in_bytes']] -= 1
+        if not self._sizes[props['size_in_bytes']]:
+            del self._sizes[props['size_in_bytes']]
+        self._relpath_order = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        """Iterate over (identifier, properties) of all items."""
+        return iter(self._items.items())
+
+    def __contains__(self, uuid):
+        return uuid in self._items
+
+    def item_properties(self, uuid):
+        """Return manifest properties of item `uuid`, raise KeyError if unknown."""
+        return self._items[uuid]
+
+    def uuids_for_hash(self, file_hash):
+        """Return identifiers of all items with content hash `file_hash`."""
+        return self._by_hash.get(file_hash, [])
+
+    def uuid_for_relpath(self, relpath):
+        """Return identifier of the item at `relpath` or None."""
+        return self._by_relpath.get(relpath)
+
+    def has_size(self, size):
+        """Return True if any item is `size` bytes large."""
+        return self._sizes[size] > 0
+
+    def iter_after(self, uuid):
+        """Yield (identifier, size in bytes) of the items following item
+        `uuid` in the order of their relpaths."""
+        if self._relpath_order is None:
+            self._relpath_order = sorted(self._by_relpath)
+        relpath = self._items[uuid]['relpath']
+        start = bisect.bisect_right(self._relpath_order, relpath)
+        for relpath in self._relpath_order[start:]:
+            next_uuid = self._by_relpath[relpath]
+            yield next_uuid, self._items[next_uuid]['size_in_bytes']
+
+
+# item properties stored in a persistent index
+_PROPERTIES = ('hash', 'relpath', 'size_in_bytes', 'utc_timestamp')
+
+
+class PersistentManifestIndex:
+    """On-disk index over the items of a frozen dtool dataset.
+
+    Frozen datasets never change, so an index built once is kept as an SQLite
+    database named after the dataset UUID and shared by all special remote
+    processes. The database is memory-mapped on open, lookups neither read
+    nor parse the manifest. Provides the same lookups as
+    :class:`ManifestIndex`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._con = sqlite3.connect(
+            Path(path).absolute().as_uri() + '?mode=ro', uri=True)
+        self._con.execute(f"PRAGMA mmap_size={os.path.getsize(path)}")
+        self.hash_function, = self._con.execute(
+            "SELECT value FROM meta WHERE name = 'hash_function'").fetchone()
+
+    @classmethod
+    def create(cls, path, hash_function, items):
+        """Write index of (identifier, properties) `items` to `path`.
+
+        The database is written to a temporary file and moved into place, a
+        concurrent reader never sees a partial index.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), suffix='.part')
+        os.close(fd)
+        try:
+            con = sqlite3.connect(tmp_path)
+            with con:
+                con.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+                con.execute(
+                    "CREATE TABLE items (uuid TEXT PRIMARY KEY, hash TEXT, "
+                    "relpath TEXT, size_in_bytes INTEGER, utc_timestamp REAL) "
+                    "WITHOUT ROWID")
+                con.execute("INSERT INTO meta VALUES ('hash_function', ?)",
+                            (hash_function,))
+                con.executemany(
+                    "INSERT INTO items VALUES (?, ?, ?, ?, ?)",
+                    ((uuid, props['hash'], props['relpath'],
+                      props['size_in_bytes'], props['utc_timestamp'])
+                     for uuid, props in items))
+                con.execute("CREATE INDEX items_hash ON items (hash)")
+                con.execute("CREATE INDEX items_relpath ON items (relpath)")
+                con.execute(
+                    "CREATE INDEX items_size ON items (size_in_bytes)")
+            con.close()
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return cls(path)
+
+    @classmethod
+    def from_dataset(cls, dataset, cache_dir, hash_function=None, items=None):
+        """Open the cached index of frozen `dataset`, build it if missing.
+
+        By default, the index holds the item hashes of the manifest. Indexes
+        of item hashes computed by another `hash_function` are cached
+        separately, built from (identifier, properties) `items`.
+        """
+        name = dataset.uuid if hash_function is None \
+            else f"{dataset.uuid}.{hash_function}"
+        path = os.path.join(cache_dir, f"{name}.sqlite")
+        if os.path.exists(path):
+            logger.debug("Use cached index %s of dataset %s", path, dataset.uri)
+            return cls(path)
+        logger.debug("Write index of dataset %s to %s", dataset.uri, path)
+        if hash_function is None:
+            hash_function = manifest_hash_function(dataset)
+            items = iter_manifest_items(dataset)
+        return cls.create(path, hash_function, items)
+
+    def __len__(self):
+        n, = self._con.execute("SELECT count(*) FROM items").fetchone()
+        return n
+
+    def __iter__(self):
+        """Iterate over (identifier, properties) of all items."""
+        for uuid, *row in self._con.execute(
+                "SELECT uuid, hash, relpath, size_in_bytes, utc_timestamp "
+                "FROM items"):
+            yield uuid, dict(zip(_PROPERTIES, row))
+
+    def __contains__(self, uuid):
+        return self._con.execute(
+            "SELECT 1 FROM items WHERE uuid = ?", (uuid,)).fetchone() is not None
+
+    def item_properties(self, uuid):
+        """Return manifest properties of item `uuid`, raise KeyError if unknown."""
+        row = self._con.execute(
+            "SELECT hash, relpath, size_in_bytes, utc_timestamp FROM items "
+            "WHERE uuid = ?", (uuid,)).fetchone()
+        if row is None:
+            raise KeyError(uuid)
+        return dict(zip(_PROPERTIES, row))
+
+    def uuids_for_hash(self, file_hash):
+        """Return identifiers of all items with content hash `file_hash`."""
+        return [uuid for uuid, in self._con.execute(
+            "SELECT uuid FROM items WHERE hash = ?", (file_hash,))]
+
+    def uuid_for_relpath(self, relpath):
+        """Return identifier of the item at `relpath` or None."""
+        row = self._con.execute(
+            "SELECT uuid FROM items WHERE relpath = ?", (relpath,)).fetchone()
+        return row[0] if row else None
+
+    def has_size(self, size):
+        """Return True if any item is `size` bytes large."""
+        return self._con.execute(
+            "SELECT 1 FROM items WHERE size_in_bytes = ? LIMIT 1",
+            (size,)).fetchone() is not None
+
+    def iter_after(self, uuid):
+        """Yield (identifier, size in bytes) of the items following item
+        `uuid` in the order of their relpaths."""
+        relpath = self.item_properties(uuid)['relpath']
+        yield from self._con.execute(
+            "SELECT uuid, size_in_bytes FROM items WHERE relpath > ? "
+            "ORDER BY relpath", (relpath,))
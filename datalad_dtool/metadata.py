@@ -0,0 +1,95 @@
+"""git-annex metadata from dtool overlays and annotations"""
+
+__docformat__ = 'restructuredtext'
+
+import json
+import logging
+import re
+
+from datalad.support.exceptions import AnnexBatchCommandError
+
+logger = logging.getLogger(__name__)
+
+# git-annex metadata field names consist of letters, digits and _-.
+_ILLEGAL_FIELD_CHARS = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def field_name(name):
+    """Return git-annex metadata field for dtool overlay or annotation `name`."""
+    return _ILLEGAL_FIELD_CHARS.sub('_', name)
+
+
+def field_values(value):
+    """Return list of git-annex metadata values for an overlay or annotation
+    `value`, empty if there is nothing to record."""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return [v for item in value for v in field_values(item)]
+    if isinstance(value, bool):
+        return ['true' if value else 'false']
+    if isinstance(value, dict):
+        return [json.dumps(value, sort_keys=True)]
+    value = str(value)
+    return [value] if value else []
+
+
+class AnnexMetadataWriter:
+    """Record dtool overlays and annotations as git-annex metadata of files.
+
+    Each item's overlay values become fields of its file, named after the
+    overlay. The annotations of the dtool dataset apply to all of its items
+    and are recorded on every file, unless an overlay of the same name
+    takes precedence. All files are updated through a single
+    ``git annex metadata --batch --json`` session, so that files can be
+    filtered by overlay value with git-annex views later on.
+
+    :param repo: :class:`AnnexRepo` the files are in
+    :param dataset: :class:`dtoolcore.DataSet` the files were imported from
+    """
+
+    def __init__(self, repo, dataset):
+        self.repo = repo
+        self._annotation_fields = {}
+        for name in dataset.list_annotation_names():
+            values = field_values(dataset.get_annotation(name))
+            if values:
+                self._annotation_fields[field_name(name)] = values
+        self._overlays = {
+            field_name(name): dataset.get_overlay(name)
+            for name in dataset.list_overlay_names()}
+        logger.debug("Record %d annotations and %d overlays of %s",
+                     len(self._annotation_fields), len(self._overlays),
+                     dataset.uri)
+
+    def fields(self, identifier):
+        """Return metadata fields of item `identifier`."""
+        fields = dict(self._annotation_fields)
+        for name, overlay in self._overlays.items():
+            values = field_values(overlay.get(identifier))
+            if values:
+                fields[name] = values
+        return fields
+
+    def __call__(self, file_pathobj, identifier, key=None):
+        """Set metadata fields of item `identifier` on its imported file.
+
+        If the `key` of the file is given, metadata is set on the key, so
+        that the file need not be in the worktree.
+        """
+        fields = self.fields(identifier)
+        if not fields:
+            return
+        filename = str(file_pathobj.relative_to(self.repo.pathobj))
+        request = {'fields': fields}
+        if key is None:
+            request['file'] = filename
+        else:
+            request['key'] = key
+        res = self.repo._batched.get(
+            'metadata', json=True, path=self.repo.path,
+        ).proc1(json.dumps(request))
+        if not res or not res.get('success', False):
+            raise AnnexBatchCommandError(
+                cmd="metadata",
+                msg="Failed to set metadata of %s: %s" % (filename, res))
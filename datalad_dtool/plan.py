@@ -0,0 +1,144 @@
+"""Projected cost of importing a dtool dataset"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+import posixpath
+
+from datalad_dtool.keys import key_extension
+
+logger = logging.getLogger(__name__)
+
+
+def _parents(path):
+    """Yield the directories `path` lies in, innermost first, '' last."""
+    while path:
+        path = posixpath.dirname(path)
+        yield path
+
+
+class ImportPlan:
+    """Projected cost of an import into a DataLad dataset.
+
+    Items are fed one at a time as (old, new) pairs of manifest entries,
+    as the import walks the merge of the dtool manifest with its import
+    state, so that only the hashes of the items are kept in memory.
+
+    Git objects are counted for the branch of the DataLad dataset: one
+    symlink blob per key and directory depth, one tree per directory with
+    changes in each commit, and one commit per saved chunk. Blobs and
+    trees the repository holds already are counted too, the projection is
+    an upper bound.
+
+    :param target: path of the import target relative to the dataset, ''
+      for the dataset root
+    :param existing: paths in the dataset, relative to it, that were not
+      imported to `target` before. New items at these paths, or below or
+      above them, are path collisions.
+    :param chunk_items: number of items saved per commit, or None
+    :param chunk_bytes: bytes of content saved per commit, or None
+    """
+
+    def __init__(self, target, existing=(), chunk_items=None,
+                 chunk_bytes=None):
+        self.target = target
+        self.chunk_items = chunk_items
+        self.chunk_bytes = chunk_bytes
+        self.counts = dict.fromkeys(
+            ('added', 'updated', 'removed', 'unchanged'), 0)
+        self.n_bytes = 0
+        self.n_duplicate_hashes = 0
+        self.n_duplicate_items = 0
+        self.n_blobs = 0
+        self.n_trees = 0
+        self.n_commits = 0
+        self.collisions = []
+        self._existing = set(existing)
+        self._existing_dirs = {
+            parent for path in self._existing for parent in _parents(path)}
+        # item hash -> number of items
+        self._hashes = {}
+        # (item hash, directory depth, extension) of the symlinks written
+        self._links = set()
+        self._chunk_dirs = set()
+        self._chunk_items = 0
+        self._chunk_size = 0
+
+    def _path(self, relpath):
+        return posixpath.join(self.target, relpath) if self.target \
+            else relpath
+
+    def add(self, old, new):
+        """Account for an item imported before as `old` and now as `new`,
+        either None if the item is missing on that side."""
+        if new is not None:
+            n = self._hashes.get(new['hash'], 0) + 1
+            self._hashes[new['hash']] = n
+            if n > 1:
+                self.n_duplicate_items += 1
+                if n == 2:
+                    self.n_duplicate_hashes += 1
+        if old is not None and new is not None \
+                and old['hash'] == new['hash'] \
+                and old['relpath'] == new['relpath']:
+            self.counts['unchanged'] += 1
+            return
+        if old is not None:
+            self._change(self._path(old['relpath']))
+            if new is None:
+                self.counts['removed'] += 1
+                return
+        path = self._path(new['relpath'])
+        if (old is None or old['relpath'] != new['relpath']) \
+                and self._collides(path):
+            self.collisions.append(path)
+        self.counts['added' if old is None else 'updated'] += 1
+        self.n_bytes += new['size_in_bytes']
+        self._links.add((new['hash'], path.count('/'),
+                         key_extension(new['relpath'])))
+        self._change(path)
+        self._chunk_items += 1
+        self._chunk_size += new['size_in_bytes']
+        if (self.chunk_items and self._chunk_items >= self.chunk_items) \
+                or (self.chunk_bytes and self._chunk_size >= self.chunk_bytes):
+            self._commit()
+
+    def _collides(self, path):
+        return path in self._existing or path in self._existing_dirs \
+            or any(parent in self._existing for parent in _parents(path))
+
+    def _change(self, path):
+        self._chunk_dirs.update(_parents(path))
+
+    def _commit(self):
+        self.n_trees += len(self._chunk_dirs)
+        self.n_commits += 1
+        self._chunk_dirs = set()
+        self._chunk_items = 0
+        self._chunk_size = 0
+
+    def finish(self, state_path, state_changed=False):
+        """Account for the final commit, which records the import state at
+        `state_path`, relative to the dataset.
+
+        The state changes with any item added, updated or removed, and with
+        `state_changed`, if the dtool dataset it records is another one.
+        Without changes, there is no commit.
+        """
+        changed = state_changed or any(
+            self.counts[change] for change in ('added', 'updated', 'removed'))
+        self.n_blobs = len(self._links) + (1 if changed else 0)
+        if changed:
+            self._change(state_path)
+        if self._chunk_dirs:
+            self._commit()
+
+    @property
+    def n_items(self):
+        """Number of items to register."""
+        return self.counts['added'] + self.counts['updated']
+
+    @property
+    def n_git_objects(self):
+        """Projected number of git objects written."""
+        return self.n_blobs + self.n_trees + self.n_commits
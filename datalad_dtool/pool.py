@@ -0,0 +1,342 @@
+"""Open dtool datasets served by the dtool special remote"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+from dtoolcore import DataSet, ProtoDataSet, DtoolCoreTypeError
+from dtoolcore.utils import (
+    IS_WINDOWS,
+    generate_identifier,
+    handle_to_osrelpath,
+    mkdir_parents,
+)
+
+from .hashes import backend_matches, file_hexdigest, hash_function_for_backend
+from .manifest import (
+    ManifestIndex,
+    PersistentManifestIndex,
+    is_local_dataset,
+    item_content_abspath,
+)
+from .prefetch import Prefetcher
+from .timing import PhaseTimer
+from .transfer import copy_file
+
+logger = logging.getLogger(__name__)
+
+
+class ItemFetcher:
+    """Fetch item content of a frozen dtool dataset with one opened dataset
+    per thread.
+
+    Storage brokers of remote storage, e.g. S3 or Azure, hold clients that
+    must not be shared between threads, so that each prefetch thread opens
+    the dataset again. The thread creating the fetcher uses `dataset`.
+    Datasets are opened one at a time.
+
+    :param dataset: :class:`dtoolcore.DataSet`
+    """
+
+    def __init__(self, dataset):
+        self.uri = dataset.uri
+        self._local = threading.local()
+        self._local.dataset = dataset
+        self._lock = threading.Lock()
+
+    def __call__(self, uuid):
+        dataset = getattr(self._local, 'dataset', None)
+        if dataset is None:
+            with self._lock:
+                dataset = DataSet.from_uri(self.uri)
+            self._local.dataset = dataset
+        return dataset.item_content_abspath(uuid)
+
+
+class DatasetHandle:
+    """A dtool dataset opened by the special remote, with its item index.
+
+    Nothing is read from storage until a request needs it: the dataset with
+    its admin metadata is opened on first access of :attr:`dataset`, the
+    index is loaded on first access of :attr:`index`.
+
+    :param uri: dtool dataset URI
+    :param cache_dir: directory of persistent indexes of frozen datasets, or
+        None to only index in memory
+    :param prefetch: number of concurrent downloads ahead of requests for
+        datasets in remote storage, 0 to disable
+    :param prefetch_budget: maximum number of bytes downloaded ahead
+    :param cross_hash: annex backends to compute item hashes for on first
+        lookup, if they do not match the hash function of the dataset
+    :param timer: :class:`PhaseTimer` to account time spent opening and
+        indexing to
+    """
+
+    def __init__(self, uri, cache_dir=None, prefetch=0, prefetch_budget=2 ** 30,
+                 cross_hash=(), timer=None):
+        self.uri = uri
+        self.cache_dir = cache_dir
+        self.prefetch = prefetch
+        self.prefetch_budget = prefetch_budget
+        self.cross_hash = cross_hash
+        self.timer = timer if timer is not None else PhaseTimer()
+        self.prefetcher = None
+        self._dataset = None
+        self._index = None
+        self._relpaths = None
+        self._cross_indexes = {}
+
+    @property
+    def dataset(self):
+        """The dtool dataset, opened on first access."""
+        if self._dataset is None:
+            with self.timer('open'):
+                self._dataset = self._open()
+        return self._dataset
+
+    def _open(self):
+        try:
+            dataset = DataSet.from_uri(self.uri)
+            logger.debug("Dataset uri=%s frozen, immutable.", self.uri)
+        except DtoolCoreTypeError as exc:
+            logger.warning(exc)
+            # items of proto datasets are only hashed once a lookup needs it
+            dataset = ProtoDataSet.from_uri(self.uri)
+        return dataset
+
+    @property
+    def frozen(self):
+        return isinstance(self.dataset, DataSet)
+
+    @property
+    def index(self):
+        """Index over the items of the dataset."""
+        if self._index is None:
+            # build lookup tables once per session, all requests query these
+            with self.timer('index'):
+                self._index = self._load_index()
+        return self._index
+
+    def _load_index(self):
+        # frozen datasets never change, share their index across processes
+        if self.frozen and self.cache_dir is not None:
+            try:
+                return PersistentManifestIndex.from_dataset(
+                    self.dataset, self.cache_dir)
+            except (OSError, sqlite3.Error) as exc:
+                logger.warning("Failed to use persistent index: %s", exc)
+        return ManifestIndex.from_dataset(self.dataset)
+
+    def index_for_backend(self, backend):
+        """Return index of item hashes that keys of annex `backend` carry.
+
+        Returns the index of manifest hashes if they match `backend`. If not,
+        and `backend` is among the cross hash backends, an index of item
+        hashes computed by the matching hash function is returned, built
+        from the item content once per dataset. Otherwise returns None.
+        """
+        if backend_matches(self.index.hash_function, backend):
+            return self.index
+        if backend not in self.cross_hash:
+            return None
+        hash_function = hash_function_for_backend(backend)
+        if hash_function is None:
+            return None
+        if hash_function not in self._cross_indexes:
+            self._cross_indexes[hash_function] = self._cross_hash_index(
+                hash_function)
+        return self._cross_indexes[hash_function]
+
+    def _cross_hash_index(self, hash_function):
+        logger.debug("Index %s of items in dataset %s", hash_function, self.uri)
+
+        def iter_items():
+            for uuid, props in self.index:
+                fpath = item_content_abspath(self.dataset, uuid, props['relpath'])
+                yield uuid, dict(props, hash=file_hexdigest(fpath, hash_function))
+
+        if self.cache_dir is not None and self.frozen:
+            try:
+                return PersistentManifestIndex.from_dataset(
+                    self.dataset, self.cache_dir, hash_function, iter_items())
+            except (OSError, sqlite3.Error) as exc:
+                logger.warning("Failed to use persistent index: %s", exc)
+        return ManifestIndex(hash_function, iter_items())
+
+    def item_content_abspath(self, uuid):
+        """Return absolute path at which content of item `uuid` can be accessed."""
+        if self.prefetcher is None and self.prefetch > 0 and self.frozen \
+                and not is_local_dataset(self.dataset):
+            logger.debug("Prefetch with %d concurrent downloads", self.prefetch)
+            # git-annex requests the files of a tree in path order
+            self.prefetcher = Prefetcher(
+                ItemFetcher(self.dataset),
+                self.index.iter_after,
+                jobs=self.prefetch,
+                budget=self.prefetch_budget)
+        if self.prefetcher is not None:
+            return self.prefetcher.get(uuid)
+        relpath = self.index.item_properties(uuid)['relpath']
+        return item_content_abspath(self.dataset, uuid, relpath)
+
+    def relpath_content_abspath(self, relpath):
+        """Return absolute path at which content of the item at `relpath`
+        can be accessed, or None if the dataset has no such item.
+
+        Items of proto datasets are located by the identifier derived from
+        `relpath`, without hashing the dataset's items.
+        """
+        if self.frozen:
+            uuid = self.index.uuid_for_relpath(relpath)
+            return None if uuid is None else self.item_content_abspath(uuid)
+        if not self.has_item(relpath):
+            return None
+        if self.dataset._storage_broker.key == 'file':
+            return self._local_item_path(relpath)
+        return self.dataset._storage_broker.get_item_abspath(
+            generate_identifier(relpath))
+
+    def has_item(self, relpath):
+        """Return True if the dataset has an item at `relpath`."""
+        if self.frozen:
+            return self.index.uuid_for_relpath(relpath) is not None
+        if self._relpaths is None:
+            # listing items of a proto dataset does not hash their content
+            self._relpaths = set(
+                self.dataset._storage_broker.iter_item_handles())
+        return relpath in self._relpaths
+
+    def put_item(self, fpath, relpath, bufsize, progress=None):
+        """Store content of file `fpath` as item `relpath` of a proto dataset.
+
+        On local disk, the content is copied to a temporary file next to
+        the items and moved into place once complete, so that a partial item
+        is never found by :meth:`has_item`.
+        """
+        self._check_writable()
+        storage_broker = self.dataset._storage_broker
+        if storage_broker.key == 'file':
+            dest_path = self._local_item_path(relpath)
+            mkdir_parents(os.path.dirname(dest_path))
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(storage_broker.get_admin_metadata_key()),
+                prefix='.datalad-dtool-', suffix='.part')
+            os.close(fd)
+            try:
+                mode = copy_file(fpath, tmp_path, bufsize=bufsize,
+                                 progress=progress)
+                os.replace(tmp_path, dest_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            logger.debug("Stored item %s in dataset %s via %s",
+                         relpath, self.uri, mode)
+        else:
+            self.dataset.put_item(fpath, relpath)
+        self._removed(lambda props: props['relpath'] == relpath)
+        self._added(relpath)
+        if self._relpaths is not None:
+            self._relpaths.add(relpath)
+
+    def remove_item(self, relpath):
+        """Remove item `relpath` from a proto dataset on local disk."""
+        self._check_writable(local=True)
+        path = self._local_item_path(relpath)
+        if os.path.lexists(path):
+            os.unlink(path)
+        self._removed(lambda props: props['relpath'] == relpath)
+        if self._relpaths is not None:
+            self._relpaths.discard(relpath)
+
+    def remove_directory(self, relpath):
+        """Remove all items below `relpath` from a proto dataset on local disk."""
+        self._check_writable(local=True)
+        shutil.rmtree(self._local_item_path(relpath), ignore_errors=True)
+        prefix = relpath.rstrip('/') + '/'
+        self._removed(lambda props: props['relpath'].startswith(prefix))
+        self._relpaths = None
+
+    def _check_writable(self, local=False):
+        if self.frozen:
+            raise ValueError(f"Dataset {self.uri} frozen, immutable")
+        if local and self.dataset._storage_broker.key != 'file':
+            raise ValueError(
+                f"Removing items not supported for dataset {self.uri}")
+
+    def _local_item_path(self, relpath):
+        return os.path.join(self.dataset._storage_broker._data_abspath,
+                            handle_to_osrelpath(relpath, IS_WINDOWS))
+
+    def _indexes(self):
+        if self._index is not None:
+            yield None, self._index
+        yield from self._cross_indexes.items()
+
+    def _added(self, relpath):
+        # keep indexes of a proto dataset up to date by hashing the new item
+        # only, instead of rebuilding them on the next lookup
+        indexes = list(self._indexes())
+        if not indexes:
+            return
+        uuid = generate_identifier(relpath)
+        # item handles of proto datasets are relpaths
+        props = self.dataset._storage_broker.item_properties(relpath)
+        for hash_function, index in indexes:
+            if hash_function is None:
+                index.add(uuid, props)
+            else:
+                fpath = self.relpath_content_abspath(relpath)
+                index.add(uuid, dict(
+                    props, hash=file_hexdigest(fpath, hash_function)))
+
+    def _removed(self, matches):
+        for _, index in self._indexes():
+            for uuid in [uuid for uuid, props in index if matches(props)]:
+                index.remove(uuid)
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+
+class DatasetPool:
+    """Bounded pool of open datasets, least recently used ones are closed.
+
+    :param open_dataset: callable returning a :class:`DatasetHandle` for a
+        dtool dataset URI
+    :param size: maximum number of datasets kept open
+    """
+
+    def __init__(self, open_dataset, size=16):
+        self.open_dataset = open_dataset
+        self.size = size
+        self._handles = OrderedDict()
+
+    def get(self, uri):
+        """Return handle of dataset `uri`, open it if not in the pool."""
+        handle = self._handles.get(uri)
+        if handle is not None:
+            self._handles.move_to_end(uri)
+            return handle
+        handle = self.open_dataset(uri)
+        self._handles[uri] = handle
+        while len(self._handles) > self.size:
+            evicted_uri, evicted = self._handles.popitem(last=False)
+            logger.debug("Close dataset %s", evicted_uri)
+            evicted.close()
+        return handle
+
+    def __iter__(self):
+        """Iterate over open datasets, most recently used first."""
+        return reversed(list(self._handles.values()))
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
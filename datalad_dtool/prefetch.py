@@ -0,0 +1,115 @@
+"""Background prefetching of item content from remote dtool datasets"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """Fetch item content ahead of requests on a bounded thread pool.
+
+    For datasets not on local disk, dtool downloads an item into its cache
+    when its content path is requested. Served one at a time, network and
+    disk take turns at idling. Whenever an item is requested, the prefetcher
+    predicts the items requested next and downloads them in the background,
+    so that subsequent requests find their content local.
+
+    :param fetch: callable returning the local content path of an item
+    :param lookahead: callable yielding (identifier, size in bytes) of the
+        items expected to be requested after a given item, in order
+    :param jobs: number of concurrent downloads
+    :param budget: maximum number of bytes prefetched but not yet requested
+    """
+
+    def __init__(self, fetch, lookahead, jobs=2, budget=2 ** 30):
+        self.fetch = fetch
+        self.lookahead = lookahead
+        self.jobs = jobs
+        self.budget = budget
+        self._executor = ThreadPoolExecutor(
+            max_workers=jobs, thread_name_prefix='dtool-prefetch')
+        self._lock = threading.Lock()
+        # identifier -> (future, size) of scheduled downloads
+        self._pending = {}
+        # identifier -> (future, size) of discarded downloads that were
+        # running already
+        self._discarded = {}
+        self._pending_bytes = 0
+
+    def get(self, identifier):
+        """Return local content path of item `identifier`.
+
+        The item is fetched before downloads ahead of it are scheduled, so
+        that these do not compete with the request. A prefetched item is
+        waited for, if its download failed, it is fetched again.
+        """
+        with self._lock:
+            future, size = self._pending.pop(identifier, None) \
+                or self._discarded.pop(identifier, (None, 0))
+            self._pending_bytes -= size
+        path = None
+        if future is not None:
+            logger.debug("Use prefetched item %s", identifier)
+            try:
+                path = future.result()
+            except Exception as exc:
+                logger.debug("Prefetching item %s failed, fetch it again: %s",
+                             identifier, exc)
+        if path is None:
+            path = self.fetch(identifier)
+        self._schedule_after(identifier)
+        return path
+
+    def _schedule_after(self, identifier):
+        window = []
+        for next_identifier, size in self.lookahead(identifier):
+            if len(window) >= 2 * self.jobs:
+                break
+            window.append((next_identifier, size))
+
+        with self._lock:
+            self._release_discarded()
+            # mispredicted downloads must not block the budget
+            expected = {i for i, _ in window}
+            for stale in [i for i in self._pending if i not in expected]:
+                self._discard(stale)
+
+            for next_identifier, size in window:
+                if next_identifier in self._pending:
+                    continue
+                if next_identifier in self._discarded:
+                    # still running, expected again
+                    self._pending[next_identifier] = \
+                        self._discarded.pop(next_identifier)
+                    continue
+                if self._pending_bytes + size > self.budget:
+                    break
+                logger.debug("Prefetch item %s", next_identifier)
+                self._pending[next_identifier] = (
+                    self._executor.submit(self.fetch, next_identifier), size)
+                self._pending_bytes += size
+
+    def _discard(self, identifier):
+        future, size = self._pending.pop(identifier)
+        if future.cancel() or future.done():
+            self._pending_bytes -= size
+        else:
+            # a running download cannot be cancelled and its content still
+            # lands in the cache, it counts against the budget until done
+            self._discarded[identifier] = (future, size)
+
+    def _release_discarded(self):
+        for identifier in [i for i, (future, _) in self._discarded.items()
+                           if future.done()]:
+            self._pending_bytes -= self._discarded.pop(identifier)[1]
+
+    def close(self):
+        """Cancel all downloads not started yet."""
+        with self._lock:
+            for identifier in list(self._pending):
+                self._discard(identifier)
+        self._executor.shutdown(wait=False)
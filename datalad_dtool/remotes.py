@@ -0,0 +1,115 @@
+"""Registry of the dtool special remotes of a git-annex repository"""
+
+__docformat__ = 'restructuredtext'
+
+import hashlib
+import logging
+import os
+import tempfile
+
+from datalad.support.exceptions import CommandError
+
+logger = logging.getLogger(__name__)
+
+# stands in for the URI of a remote initialized with multi=yes
+_MULTI = '*'
+
+
+def remote_name(dtool_uuid, uri=None):
+    """Return name of the special remote for dtool dataset `dtool_uuid`.
+
+    Copies of a dtool dataset share its UUID, a remote for a copy at another
+    `uri` is told apart by a short hash of the URI.
+    """
+    name = f"dtool-{dtool_uuid}"
+    if uri is not None:
+        name += '-' + hashlib.sha1(uri.encode('utf-8')).hexdigest()[:8]
+    return name
+
+
+class RemoteRegistry:
+    """Names of the dtool special remotes of `repo` by the URI they serve.
+
+    Listing the special remotes reads the remote log of the git-annex
+    branch. The result is cached in ``.git/dtool/remotes.tsv`` along with
+    the blob of the remote log it was read from, and only listed again once
+    the remotes changed. Other changes of the git-annex branch, e.g. URLs
+    registered by an import, keep the cache. While git-annex holds changes
+    of the remote log in its journal, nothing is cached.
+
+    :param repo: :class:`AnnexRepo`
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = os.path.join(repo.dot_git, 'dtool', 'remotes.tsv')
+        self._remotes = None
+
+    def lookup(self, uri):
+        """Return name of the remote serving `uri`, a remote initialized with
+        ``multi=yes`` if there is none for `uri` only, or None."""
+        remotes = self._load()
+        return remotes.get(uri) or remotes.get(_MULTI)
+
+    def names(self):
+        """Return names of all dtool special remotes."""
+        return set(self._load().values())
+
+    def add(self, uri, name):
+        """Record remote `name` as serving `uri`, e.g. after initializing it."""
+        remotes = self._load()
+        remotes[uri] = name
+        self._write(remotes, self._remote_log())
+
+    def _load(self):
+        if self._remotes is not None:
+            return self._remotes
+        remote_log = self._remote_log()
+        try:
+            with open(self.path) as f:
+                if remote_log is not None and \
+                        f.readline().rstrip('\n') == f'# remote.log {remote_log}':
+                    self._remotes = dict(
+                        line.rstrip('\n').split('\t', 1) for line in f)
+                    return self._remotes
+        except (OSError, ValueError):
+            pass
+        logger.debug("List dtool special remotes of %s", self.repo)
+        remotes = {}
+        for special_remote in self.repo.get_special_remotes().values():
+            if special_remote.get('externaltype') != 'dtool':
+                continue
+            if special_remote.get('multi', '').lower() in ('yes', 'true'):
+                remotes.setdefault(_MULTI, special_remote['name'])
+            elif special_remote.get('uri'):
+                remotes.setdefault(special_remote['uri'], special_remote['name'])
+        self._write(remotes, remote_log)
+        return remotes
+
+    def _remote_log(self):
+        # blob of the remote log, '' without one, None if not committed
+        if os.path.exists(os.path.join(
+                self.repo.dot_git, 'annex', 'journal', 'remote.log')):
+            return None
+        try:
+            return self.repo.call_git_oneline(
+                ['rev-parse', '--verify', '--quiet', 'git-annex:remote.log'],
+                read_only=True)
+        except CommandError:
+            return ''
+
+    def _write(self, remotes, remote_log):
+        self._remotes = remotes
+        if remote_log is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.path), suffix='.part')
+            with os.fdopen(fd, 'w') as f:
+                f.write(f'# remote.log {remote_log}\n')
+                for uri, name in sorted(remotes.items()):
+                    f.write(f'{uri}\t{name}\n')
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            logger.debug("Failed to cache dtool special remotes: %s", exc)
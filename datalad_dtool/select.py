@@ -0,0 +1,84 @@
+"""Selection of dtool items by relpath patterns"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+class PathSelector:
+    """Select relpaths of dtool items by `include` and `exclude` patterns.
+
+    Patterns are relpaths with the wildcards of :mod:`fnmatch` per path
+    component, and ``**`` matching any number of directories, e.g.
+    ``raw/2024-*/**/*.h5``. A pattern matching a directory selects
+    everything below it. Each pattern is compiled to a single regular
+    expression once, every relpath is then tested against these.
+
+    :param include: patterns of the relpaths to select, all if None
+    :param exclude: patterns of the relpaths not to select
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self._include = [_pattern_regex(p) for p in include] \
+            if include else None
+        self._exclude = [_pattern_regex(p) for p in exclude or ()]
+
+    def __call__(self, relpath):
+        """Return True if `relpath` is selected."""
+        if self._include is not None \
+                and not any(r(relpath) for r in self._include):
+            return False
+        return not any(r(relpath) for r in self._exclude)
+
+
+def _pattern_regex(pattern):
+    """Return match function of the regular expression of `pattern`."""
+    components = [c for c in pattern.strip('/').split('/')
+                  if c not in ('', '.')]
+    # a trailing ** selects what the directory before it selects
+    while components and components[-1] == '**':
+        components.pop()
+    if not components:
+        return re.compile('', re.DOTALL).match
+    regex = ''.join('(?:[^/]+/)*' if c == '**' else _translate(c) + '/'
+                    for c in components[:-1])
+    regex += _translate(components[-1]) + r'(?:/.*)?\Z'
+    return re.compile(regex, re.DOTALL).match
+
+
+def _translate(component):
+    """Return regular expression of path `component` with the wildcards of
+    :func:`fnmatch.translate`, none of them matching a slash."""
+    res = []
+    i, n = 0, len(component)
+    while i < n:
+        c = component[i]
+        i += 1
+        if c == '*':
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and component[j] == '!':
+                j += 1
+            if j < n and component[j] == ']':
+                j += 1
+            while j < n and component[j] != ']':
+                j += 1
+            if j >= n:
+                res.append(r'\[')
+                continue
+            stuff = component[i:j].replace('\\', '\\\\')
+            i = j + 1
+            if stuff[0] == '!':
+                stuff = '^' + stuff[1:]
+            elif stuff[0] in ('^', '['):
+                stuff = '\\' + stuff
+            res.append(f'(?!/)[{stuff}]')
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
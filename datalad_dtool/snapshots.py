@@ -0,0 +1,57 @@
+"""dtool snapshots of a DataLad dataset"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+
+from dtoolcore import iter_datasets_in_base_uri
+
+logger = logging.getLogger(__name__)
+
+
+def iter_snapshots(base_uri, datalad_uuid):
+    """Yield (dataset, commit) of the dtool datasets at `base_uri` exported
+    from DataLad dataset `datalad_uuid`, as recorded by the ``datalad-uuid``
+    and ``datalad-commit`` annotations of export-dtool."""
+    for dataset in iter_datasets_in_base_uri(base_uri):
+        names = dataset.list_annotation_names()
+        if 'datalad-uuid' not in names or 'datalad-commit' not in names:
+            continue
+        if dataset.get_annotation('datalad-uuid') != datalad_uuid:
+            continue
+        yield dataset, dataset.get_annotation('datalad-commit')
+
+
+def find_previous_snapshot(repo, base_uri, datalad_uuid, commit):
+    """Return (dataset, commit) of the snapshot at `base_uri` closest to
+    `commit`, among the snapshots of ancestors of `commit`, or (None, None).
+
+    Snapshots are ranked by the number of commits between theirs and
+    `commit`, the most recently frozen one wins among snapshots of the same
+    commit.
+    """
+    best = None
+    for dataset, snapshot_commit in iter_snapshots(base_uri, datalad_uuid):
+        if not repo.is_ancestor(snapshot_commit, commit):
+            logger.debug("Snapshot %s of %s not in the history of %s",
+                         dataset.uri, snapshot_commit, commit)
+            continue
+        distance = int(repo.call_git_oneline(
+            ['rev-list', '--count', f'{snapshot_commit}..{commit}'],
+            read_only=True))
+        rank = (distance, -dataset._admin_metadata.get('frozen_at', 0))
+        if best is None or rank < best[0]:
+            best = (rank, dataset, snapshot_commit)
+    if best is None:
+        return None, None
+    logger.debug("Previous snapshot %s of %s, %d commits before %s",
+                 best[1].uri, best[2], best[0][0], commit)
+    return best[1], best[2]
+
+
+def changed_paths(repo, old, new):
+    """Return set of the paths of files that differ between commits `old`
+    and `new`, relative to the repository."""
+    return set(repo.call_git_items_(
+        ['diff-tree', '-r', '-z', '--no-renames', '--name-only', old, new],
+        sep='\0', read_only=True))
@@ -0,0 +1,56 @@
+"""Test streaming enumeration of the files in a commit"""
+
+import os
+
+from datalad.support.annexrepo import AnnexRepo
+from datalad.support.gitrepo import GitRepo
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    with_tempfile,
+)
+
+from datalad_dtool.content import ContentRecord, iter_content
+
+
+@with_tempfile(mkdir=True)
+def test_iter_content(path=None):
+    repo = GitRepo(path, create=True)
+    os.mkdir(os.path.join(path, 'sub dir'))
+    with open(os.path.join(path, 'sub dir', 'a.txt'), 'w') as f:
+        f.write('content')
+    with open(os.path.join(path, 'b.txt'), 'w') as f:
+        f.write('b')
+    repo.add(['sub dir', 'b.txt'])
+    repo.commit('first')
+    with open(os.path.join(path, 'b.txt'), 'w') as f:
+        f.write('uncommitted')
+
+    records = iter_content(repo)
+    assert_equal(next(records),
+                 ContentRecord(repo.pathobj / 'b.txt', None, None, True, 1))
+    assert_equal(list(records), [
+        ContentRecord(repo.pathobj / 'sub dir' / 'a.txt', None, None, True, 7)])
+
+
+@with_tempfile(mkdir=True)
+def test_iter_content_annex(path=None):
+    repo = AnnexRepo(path, create=True)
+    for name, content in (('a.txt', 'annexed'), ('b.txt', 'in git'),
+                          ('c.txt', 'dropped')):
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(content)
+    repo.add(['a.txt', 'c.txt'])
+    repo.add('b.txt', git=True)
+    repo.commit('first')
+    repo.drop('c.txt', options=['--force'])
+
+    records = list(iter_content(repo))
+    assert_equal([r.path.name for r in records], ['a.txt', 'b.txt', 'c.txt'])
+    a, b, c = records
+    assert_equal((a.key, a.has_content, a.size),
+                 (repo.get_file_annexinfo('a.txt')['key'], True, 7))
+    with open(a.objloc) as f:
+        assert_equal(f.read(), 'annexed')
+    assert_equal(b, ContentRecord(repo.pathobj / 'b.txt', None, None, True, 6))
+    assert_equal((c.key is not None, c.objloc, c.has_content, c.size),
+                 (True, None, False, 7))
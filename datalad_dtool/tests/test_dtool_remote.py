@@ -0,0 +1,294 @@
+"""Test the dtool special remote"""
+
+import hashlib
+import os
+from os.path import join as opj
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_is_none,
+    assert_raises,
+    assert_true,
+    with_tempfile,
+)
+
+from annexremote import RemoteError
+from dtoolcore import (
+    DataSet,
+    DataSetCreator,
+    ProtoDataSet,
+    create_proto_dataset,
+)
+
+from datalad_dtool.dtool_remote import DtoolRemote
+from datalad_dtool.hashes import (
+    backend_matches,
+    hash_function_for_backend,
+    key_backend_for_hash_function,
+)
+
+
+class FakeAnnex:
+    """Stand-in for the git-annex side of the special remote protocol"""
+
+    def __init__(self, gitdir, config=None, urls=None):
+        self.gitdir = gitdir
+        self.config = config or {}
+        self.urls = urls or {}
+        self.progress_reports = []
+
+    def getconfig(self, name):
+        return self.config.get(name, '')
+
+    def getgitdir(self):
+        return self.gitdir
+
+    def geturls(self, key, prefix):
+        return [u for u in self.urls.get(key, []) if u.startswith(prefix)]
+
+    def progress(self, nbytes):
+        self.progress_reports.append(nbytes)
+
+
+def _create_dtool_dataset(base_uri, name, content):
+    with DataSetCreator(name=name, base_uri=base_uri) as creator:
+        for relpath, text in content.items():
+            with open(creator.prepare_staging_abspath_promise(relpath), 'w') as f:
+                f.write(text)
+        return creator.uri
+
+
+def _items(remote, uri):
+    manifest = remote.pool.get(uri).dataset.generate_manifest()
+    return {props['relpath']: (uuid, props)
+            for uuid, props in manifest['items'].items()}
+
+
+def _md5e_key(props, ext=''):
+    return f"MD5E-s{props['size_in_bytes']}--{props['hash']}{ext}"
+
+
+@with_tempfile(mkdir=True)
+def test_single_dataset(path=None):
+    uri = _create_dtool_dataset(path, 'ds', {
+        'file_up': 'some_content', 'dir/file1_down': 'one'})
+    annex = FakeAnnex(path, {'uri': uri})
+    remote = DtoolRemote(annex)
+    remote.prepare()
+
+    items = _items(remote, uri)
+    uuid, props = items['dir/file1_down']
+    key = _md5e_key(props, '.txt')
+    assert_true(remote.checkpresent(key))
+    remote.transfer_retrieve(key, opj(path, 'retrieved'))
+    with open(opj(path, 'retrieved')) as f:
+        assert_equal(f.read(), 'one')
+    assert_equal(annex.progress_reports[-1], 3)
+
+    # unknown hash, resolved from its dtool URL
+    other_key = 'SHA256E-s12--0123'
+    assert_false(remote.checkpresent(other_key))
+    annex.urls[other_key] = [f"dtool:{uri}/{items['file_up'][0]}"]
+    assert_true(remote.checkpresent(other_key))
+    remote.transfer_retrieve(other_key, opj(path, 'retrieved'))
+    with open(opj(path, 'retrieved')) as f:
+        assert_equal(f.read(), 'some_content')
+
+    # no item of the key's size, rejected without looking at its URLs
+    sized_key = 'SHA256E-s5--0123'
+    annex.urls[sized_key] = [f"dtool:{uri}/{items['file_up'][0]}"]
+    assert_false(remote.checkpresent(sized_key))
+    assert_raises(RemoteError, remote.transfer_retrieve,
+                  sized_key, opj(path, 'retrieved'))
+    assert_raises(RemoteError, remote.checkpresent, 'MD5E-sx--0123')
+
+    assert_true(remote.claimurl(f"dtool:{uri}/{uuid}"))
+    assert_false(remote.claimurl(f"dtool:{uri}x/{uuid}"))
+
+    remote.transferexport_retrieve(key, opj(path, 'exported'), 'dir/file1_down')
+    with open(opj(path, 'exported')) as f:
+        assert_equal(f.read(), 'one')
+    assert_raises(RemoteError, remote.transferexport_retrieve,
+                  key, opj(path, 'exported'), 'nothere')
+
+    # persistent index of the frozen dataset
+    assert_equal(os.listdir(opj(path, 'annex', 'dtool')),
+                 [f"{remote.pool.get(uri).dataset.uuid}.sqlite"])
+    # opened and indexed once for all requests
+    assert_equal(remote.timer.counts['open'], 1)
+    assert_equal(remote.timer.counts['index'], 1)
+
+
+@with_tempfile(mkdir=True)
+def test_lazy_prepare(path=None):
+    uri = _create_dtool_dataset(path, 'ds', {'file': 'content'})
+    annex = FakeAnnex(path, {'uri': uri})
+    remote = DtoolRemote(annex)
+    remote.prepare()
+    assert_true(remote.claimurl(f"dtool:{uri}/0123"))
+    # URL checks do not need the dataset
+    assert_is_none(remote.pool.get(uri)._dataset)
+    assert_false(remote.checkpresent('MD5E-s7--0123'))
+    assert_true(remote.pool.get(uri).frozen)
+
+    # unreachable datasets only fail requests that need them
+    annex = FakeAnnex(path, {'uri': opj(path, 'nothere')})
+    remote = DtoolRemote(annex)
+    remote.prepare()
+    assert_true(remote.claimurl(f"dtool:{opj(path, 'nothere')}/0123"))
+    assert_raises(RemoteError, remote.checkpresent, 'MD5E-s7--0123')
+
+
+@with_tempfile(mkdir=True)
+def test_multi_dataset(path=None):
+    uris = [_create_dtool_dataset(path, f'ds{i}', {'file': f'content{i}'})
+            for i in range(3)]
+    annex = FakeAnnex(path, {'multi': 'yes', 'poolsize': '2'})
+    remote = DtoolRemote(annex)
+    remote.initremote()
+    remote.prepare()
+
+    for i, uri in enumerate(uris):
+        uuid, props = _items(remote, uri)['file']
+        url = f"dtool:{uri}/{uuid}"
+        assert_true(remote.claimurl(url))
+        key = f"SHA256E-s{props['size_in_bytes']}--{i}"
+        annex.urls[key] = [url]
+        assert_true(remote.checkpresent(key))
+        remote.transfer_retrieve(key, opj(path, 'retrieved'))
+        with open(opj(path, 'retrieved')) as f:
+            assert_equal(f.read(), f'content{i}')
+    # least recently used dataset closed
+    assert_equal([h.uri for h in remote.pool], uris[:0:-1])
+    assert_false(remote.claimurl('http://example.com/file'))
+    assert_raises(RemoteError, remote.transferexport_retrieve,
+                  key, opj(path, 'exported'), 'file')
+
+
+def test_initremote_requires_uri():
+    assert_raises(RemoteError, DtoolRemote(FakeAnnex(None)).initremote)
+
+
+@with_tempfile(mkdir=True)
+def test_hash_backends(path=None):
+    uri = _create_dtool_dataset(path, 'ds', {'file.txt': 'some_content'})
+    sha256 = hashlib.sha256(b'some_content').hexdigest()
+    sha256_key = f'SHA256E-s12--{sha256}.txt'
+
+    # md5 dataset, no cross hashes: SHA256E keys are not resolved by hash
+    annex = FakeAnnex(path, {'uri': uri})
+    remote = DtoolRemote(annex)
+    remote.prepare()
+    (uuid, props), = _items(remote, uri).values()
+    assert_true(remote.checkpresent(_md5e_key(props)))
+    assert_true(remote.checkpresent(f"MD5-s12--{props['hash']}"))
+    assert_false(remote.checkpresent(sha256_key))
+
+    annex.config['crosshash'] = 'SHA256E, SHA1E'
+    remote.prepare()
+    assert_true(remote.checkpresent(sha256_key))
+    remote.transfer_retrieve(sha256_key, opj(path, 'retrieved'))
+    with open(opj(path, 'retrieved')) as f:
+        assert_equal(f.read(), 'some_content')
+    # computed once, cached next to the index
+    dtool_uuid = remote.pool.get(uri).dataset.uuid
+    assert_equal(sorted(os.listdir(opj(path, 'annex', 'dtool'))),
+                 [f'{dtool_uuid}.sha256sum_hexdigest.sqlite',
+                  f'{dtool_uuid}.sqlite'])
+    remote.prepare()
+    assert_true(remote.checkpresent(sha256_key))
+
+
+def test_hash_functions():
+    assert_true(backend_matches('md5sum_hexdigest', 'MD5E'))
+    assert_true(backend_matches('sha256sum_hexdigest', 'SHA256'))
+    assert_false(backend_matches('md5sum_hexdigest', 'SHA256E'))
+    assert_false(backend_matches('unknown', 'MD5E'))
+    assert_equal(hash_function_for_backend('SHA1E'), 'sha1sum_hexdigest')
+    assert_is_none(hash_function_for_backend('WORM'))
+    assert_equal(key_backend_for_hash_function('md5sum_hexdigest'), 'MD5E')
+    assert_is_none(key_backend_for_hash_function('unknown'))
+
+
+@with_tempfile(mkdir=True)
+def test_export(path=None):
+    proto_dataset = create_proto_dataset(name='export', base_uri=path)
+    annex = FakeAnnex(path, {'uri': proto_dataset.uri})
+    remote = DtoolRemote(annex)
+    remote.prepare()
+
+    for relpath, content in (('file_up', 'some_content'),
+                             ('dir/file1_down', 'one'),
+                             ('dir/file2_down', 'two')):
+        with open(opj(path, 'local'), 'w') as f:
+            f.write(content)
+        assert_false(remote.checkpresentexport('KEY', relpath))
+        remote.transferexport_store('KEY', opj(path, 'local'), relpath)
+        assert_true(remote.checkpresentexport('KEY', relpath))
+
+    remote.transferexport_retrieve('KEY', opj(path, 'retrieved'), 'dir/file1_down')
+    with open(opj(path, 'retrieved')) as f:
+        assert_equal(f.read(), 'one')
+
+    remote.removeexport('KEY', 'file_up')
+    assert_false(remote.checkpresentexport('KEY', 'file_up'))
+    remote.removeexportdirectory('dir')
+    assert_false(remote.checkpresentexport('KEY', 'dir/file2_down'))
+
+    remote.transferexport_store('KEY', opj(path, 'local'), 'final')
+    # a new process sees the same items, no staging leftovers
+    remote.prepare()
+    assert_true(remote.checkpresentexport('KEY', 'final'))
+    assert_false(remote.checkpresentexport('KEY', 'dir/file1_down'))
+
+    # freezing is a separate step, afterwards the dataset is immutable
+    ProtoDataSet.from_uri(proto_dataset.uri).freeze()
+    remote.prepare()
+    assert_true(remote.checkpresentexport('KEY', 'final'))
+    assert_raises(RemoteError, remote.transferexport_store,
+                  'KEY', opj(path, 'local'), 'other')
+    assert_raises(RemoteError, remote.removeexport, 'KEY', 'final')
+    dataset = DataSet.from_uri(proto_dataset.uri)
+    assert_equal([p['relpath'] for p in dataset._manifest['items'].values()],
+                 ['final'])
+
+
+
+def test_export_hashing(tmp_path, monkeypatch):
+    from dtoolcore.storagebroker import DiskStorageBroker
+    path = str(tmp_path)
+    proto_dataset = create_proto_dataset(name='export', base_uri=path)
+    remote = DtoolRemote(FakeAnnex(path, {'uri': proto_dataset.uri}))
+    remote.prepare()
+    hashed = []
+    get_hash = DiskStorageBroker.get_hash
+
+    def counting_get_hash(self, handle):
+        hashed.append(handle)
+        return get_hash(self, handle)
+
+    monkeypatch.setattr(DiskStorageBroker, 'get_hash', counting_get_hash)
+    for relpath in ('a', 'b'):
+        with open(opj(path, 'local'), 'w') as f:
+            f.write(relpath)
+        remote.transferexport_store('KEY', opj(path, 'local'), relpath)
+        # retrieving an item by its relpath hashes nothing
+        remote.transferexport_retrieve('KEY', opj(path, 'retrieved'), relpath)
+        with open(opj(path, 'retrieved')) as f:
+            assert_equal(f.read(), relpath)
+    assert_equal(hashed, [])
+
+    # an index built once is updated with the items stored afterwards
+    index = remote.pool.get(proto_dataset.uri).index
+    assert_equal(sorted(hashed), ['a', 'b'])
+    with open(opj(path, 'local'), 'w') as f:
+        f.write('changed')
+    remote.transferexport_store('KEY', opj(path, 'local'), 'a')
+    remote.removeexport('KEY', 'b')
+    assert_equal(hashed[2:], ['a'])
+    assert_true(remote.pool.get(proto_dataset.uri).index is index)
+    assert_equal(index.uuids_for_hash(hashlib.md5(b'changed').hexdigest()),
+                 [index.uuid_for_relpath('a')])
+    assert_is_none(index.uuid_for_relpath('b'))
+    assert_equal(len(index), 1)
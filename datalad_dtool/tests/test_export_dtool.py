@@ -9,10 +9,12 @@ from os.path import isabs
 from os.path import join as opj
 
 from datalad.api import Dataset
+from datalad.cmd import StdOutCapture, WitlessRunner
 
 from datalad.tests.utils_pytest import (
     assert_equal,
     assert_false,
+    assert_in,
     assert_not_equal,
     assert_raises,
     assert_result_count,
@@ -39,6 +41,12 @@ def test_export_dtool_api():
     assert hasattr(da, 'export_dtool')
 
 
+def test_export_dtool_cli():
+    out = WitlessRunner().run(['datalad', 'export-dtool', '--help'],
+                              protocol=StdOutCapture)
+    assert_in('--incremental', out['stdout'])
+
+
 @with_tree(_dataset_template)
 def test_failure(path=None):
     # non-existing dataset
@@ -82,4 +90,107 @@ def test_archive(path=None):
     ds.drop('file_up', reckless='kill')
     assert_raises(IOError, ds.export_dtool, base_uri=path, name='my')
     ds.export_dtool(base_uri=path, name='partial', missing_content='ignore')
-    assert_true(os.path.exists(opj(path, 'partial')))
\ No newline at end of file
+    assert_true(os.path.exists(opj(path, 'partial')))
+
+class _RecordingCreator:
+    """Stand-in for a DataSetCreator recording the items put"""
+
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.put = []
+
+    def put_item(self, fpath, relpath):
+        if relpath in self.fail:
+            raise OSError(f"Failed to put {relpath}")
+        time.sleep(0.01)
+        self.put.append(relpath)
+        return relpath
+
+
+def test_put_items():
+    from datalad_dtool.export import put_items
+    items = [('/src/a', 'a', 1), ('/src/b', 'b', 30), ('/src/c', 'c', 20)]
+
+    creator = _RecordingCreator()
+    assert_equal(list(put_items(creator.put_item, items)), ['a', 'b', 'c'])
+    assert_equal(creator.put, ['a', 'b', 'c'])
+
+    creator = _RecordingCreator()
+    assert_equal(sorted(put_items(creator.put_item, items, jobs=2)),
+                 ['a', 'b', 'c'])
+    # largest first
+    assert_equal(set(creator.put[:2]), {'b', 'c'})
+
+    # errors are raised as in the serial loop, remaining items not put
+    creator = _RecordingCreator(fail=('b',))
+    with assert_raises(OSError):
+        list(put_items(creator.put_item, items * 10, jobs=2))
+    assert_true(len(creator.put) < 20)
+
+    # items are read ahead by no more than the window
+    read = []
+
+    def iter_items():
+        for i in range(100):
+            read.append(i)
+            yield f'/src/{i}', str(i), i
+
+    creator = _RecordingCreator()
+    handles = put_items(creator.put_item, iter_items(), jobs=2, window=4)
+    next(handles)
+    assert_true(len(read) <= 5)
+    assert_equal(len(list(handles)), 99)
+
+
+@with_tree({'a': 'a', 'b': 'b', 'c': 'c', 'd': 'd'})
+def test_item_putter(path=None):
+    import threading
+    from dtoolcore import DataSet, create_proto_dataset
+    from datalad_dtool.export import ItemPutter, put_items
+    proto_dataset = create_proto_dataset(name='put', base_uri=path)
+    putter = ItemPutter(proto_dataset)
+    # (storage broker, thread) pairs used
+    used = set()
+    lock = threading.Lock()
+
+    def put_item(in_fpath, relpath):
+        handle = putter(in_fpath, relpath)
+        with lock:
+            used.add((putter._local.proto_dataset._storage_broker,
+                      threading.get_ident()))
+        return handle
+
+    items = [(opj(path, name), name, 1) for name in 'abcd']
+    assert_equal(sorted(put_items(put_item, items, jobs=2)),
+                 ['a', 'b', 'c', 'd'])
+    # no broker shared between threads
+    brokers = [broker for broker, _ in used]
+    assert_equal(len(brokers), len(set(brokers)))
+    assert_false(proto_dataset._storage_broker in brokers)
+
+    proto_dataset.freeze()
+    dataset = DataSet.from_uri(proto_dataset.uri)
+    assert_equal(sorted(dataset.item_properties(i)['relpath']
+                        for i in dataset.identifiers),
+                 ['a', 'b', 'c', 'd'])
+
+
+@with_tree({'annex': {'object': 'annexed'}, 'worktree': 'in git'})
+def test_item_linker(path=None):
+    from dtoolcore import DataSet, create_proto_dataset
+    from datalad_dtool.export import ItemLinker
+    proto_dataset = create_proto_dataset(name='linked', base_uri=path)
+    linker = ItemLinker(proto_dataset, {opj(path, 'annex'): 'hardlink'})
+    assert_equal(linker(opj(path, 'annex', 'object'), 'dir/annexed'),
+                 'dir/annexed')
+    linker(opj(path, 'worktree'), 'in_git')
+    assert_equal(linker.modes['hardlink'], 1)
+    # files in git are never linked
+    assert_equal(os.stat(opj(path, 'worktree')).st_nlink, 1)
+    assert_equal(os.stat(opj(path, 'annex', 'object')).st_nlink, 2)
+
+    proto_dataset.freeze()
+    dataset = DataSet.from_uri(proto_dataset.uri)
+    assert_equal(sorted(dataset.item_properties(i)['relpath']
+                        for i in dataset.identifiers),
+                 ['dir/annexed', 'in_git'])
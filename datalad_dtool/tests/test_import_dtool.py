@@ -0,0 +1,263 @@
+"""Test dtool dataset importer"""
+
+import importlib
+from os.path import join as opj
+
+from datalad.api import Dataset
+from datalad.cmd import StdOutCapture, WitlessRunner
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_in,
+    assert_raises,
+    assert_result_count,
+    assert_true,
+    with_tempfile,
+)
+from dtoolcore import DataSet, DataSetCreator
+
+from datalad_dtool.remotes import RemoteRegistry
+
+
+def test_import_dtool_cli():
+    out = WitlessRunner().run(['datalad', 'import-dtool', '--help'],
+                              protocol=StdOutCapture)
+    for flag in ('--metadata-only', '--annex-metadata', '--dry-run',
+                 '--tree-only'):
+        assert_in(flag, out['stdout'])
+
+
+def _create_dtool_dataset(base_uri, name, content):
+    with DataSetCreator(name, base_uri) as creator:
+        for relpath, text in content.items():
+            with open(creator.prepare_staging_abspath_promise(relpath),
+                      'w') as f:
+                f.write(text)
+    return opj(base_uri, name)
+
+
+@with_tempfile(mkdir=True)
+def test_import_batched(path=None):
+    uri = _create_dtool_dataset(
+        path, 'source', {'a.txt': 'a', 'dir/b.txt': 'b', 'clash': 'c'})
+    ds = Dataset(opj(path, 'ds')).create()
+    # a directory at the path of an item fails that item only
+    (ds.pathobj / 'imported' / 'clash').mkdir(parents=True)
+    (ds.pathobj / 'imported' / 'clash' / 'file').write_text('in git')
+    ds.save()
+
+    res = ds.import_dtool(uri=uri, path='imported', on_failure='ignore',
+                          result_renderer='disabled')
+    assert_result_count(res, 1, action='import-dtool', status='error',
+                        path=str(ds.pathobj / 'imported' / 'clash'))
+    summary = [r for r in res
+               if r['action'] == 'import-dtool' and r['status'] == 'ok']
+    assert_equal(len(summary), 1)
+    assert_equal(summary[0]['message'][1:6], (2, 0, 0, 0, 0))
+    # the items registered through the batched session are usable
+    assert_equal((ds.pathobj / 'imported' / 'a.txt').read_text(), 'a')
+    assert_equal((ds.pathobj / 'imported' / 'dir' / 'b.txt').read_text(),
+                 'b')
+    whereis = ds.repo.whereis(str(ds.pathobj / 'imported' / 'a.txt'),
+                              output='full')
+    assert_in('dtool:file://',
+              ' '.join(url for remote in whereis.values()
+                       for url in remote['urls']))
+    assert_false(ds.repo.dirty)
+
+
+@with_tempfile(mkdir=True)
+def test_import_annex_metadata(path=None):
+    uri = _create_dtool_dataset(path, 'source', {'a.txt': 'a', 'b.txt': 'b'})
+    dtool_dataset = DataSet.from_uri(uri)
+    ids = {dtool_dataset.item_properties(i)['relpath']: i
+           for i in dtool_dataset.identifiers}
+    dtool_dataset.put_overlay('kind', {ids['a.txt']: 'raw', ids['b.txt']: 2})
+    dtool_dataset.put_annotation('project', 'demo')
+
+    for metadata_only in (False, True):
+        ds = Dataset(opj(path, f'ds{metadata_only}')).create()
+        res = ds.import_dtool(uri=uri, path='imported', annex_metadata=True,
+                              metadata_only=metadata_only,
+                              result_renderer='disabled')
+        assert_result_count(res, 0, status='error')
+        metadata = {
+            r['file']: r['fields'] for r in ds.repo.call_annex_records(
+                ['metadata', '--json', 'imported'])}
+        assert_equal(metadata['imported/a.txt']['kind'], ['raw'])
+        assert_equal(metadata['imported/b.txt']['kind'], ['2'])
+        assert_equal(metadata['imported/a.txt']['project'], ['demo'])
+        assert_false(ds.repo.dirty)
+
+
+def _summary(res):
+    """Return counts reported by the final import-dtool result."""
+    summary = [r for r in res if r['action'] == 'import-dtool'][-1]
+    if summary.get('dry_run'):
+        return summary
+    return dict(zip(('added', 'updated', 'removed', 'unchanged', 'resumed'),
+                    summary['message'][1:6]), status=summary['status'])
+
+
+def _files(ds, path='imported'):
+    """Return annex keys of the committed files below `path` by relpath."""
+    return {
+        r['file'][len(path) + 1:]: r['key']
+        for r in ds.repo.call_annex_records(['find', '--anything', path])}
+
+
+_CONTENT = {'a.txt': 'a', 'b.txt': 'b', 'dir/c.txt': 'c',
+            'dir/skip.txt': 'skip', 'dir/sub/d.txt': 'd'}
+
+
+@with_tempfile(mkdir=True)
+def test_import_metadata_only(path=None):
+    uri = _create_dtool_dataset(path, 'source', _CONTENT)
+    ds = Dataset(opj(path, 'ds')).create()
+    res = ds.import_dtool(uri=uri, path='imported', metadata_only=True,
+                          result_renderer='disabled')
+    assert_equal(_summary(res)['added'], 5)
+    files = _files(ds)
+    assert_equal(sorted(files), sorted(_CONTENT))
+    # keys from the manifest, no content transferred
+    assert_true(files['a.txt'].startswith('MD5E-s1--'))
+    assert_false(ds.repo.file_has_content('imported/a.txt'))
+    assert_false(ds.repo.dirty)
+    ds.repo.get('imported/a.txt')
+    assert_equal((ds.pathobj / 'imported' / 'a.txt').read_text(), 'a')
+
+
+@with_tempfile(mkdir=True)
+def test_import_update(path=None):
+    first = _create_dtool_dataset(
+        path, 'first', {'a.txt': 'a', 'b.txt': 'b', 'c.txt': 'c'})
+    second = _create_dtool_dataset(
+        path, 'second', {'a.txt': 'a', 'b.txt': 'B', 'd.txt': 'd'})
+    ds = Dataset(opj(path, 'ds')).create()
+    ds.import_dtool(uri=first, path='imported', metadata_only=True,
+                    result_renderer='disabled')
+    key_a = _files(ds)['a.txt']
+
+    res = ds.import_dtool(uri=second, path='imported', metadata_only=True,
+                          result_renderer='disabled')
+    summary = _summary(res)
+    assert_equal((summary['added'], summary['updated'], summary['removed'],
+                  summary['unchanged']), (1, 1, 1, 1))
+    files = _files(ds)
+    assert_equal(sorted(files), ['a.txt', 'b.txt', 'd.txt'])
+    assert_equal(files['a.txt'], key_a)
+    assert_false((ds.pathobj / 'imported' / 'c.txt').is_symlink())
+    # the unchanged item is available from both dtool datasets
+    urls = ds.repo.whereis('imported/a.txt', output='full')
+    assert_equal(
+        len([url for remote in urls.values() for url in remote['urls']]), 2)
+    # the state is committed with the items
+    assert_false(ds.repo.dirty)
+    assert_in('.datalad/dtool/.gitattributes',
+              ds.repo.call_git(['ls-files', '.datalad/dtool']))
+
+    # nothing to do for an import that is up to date
+    res = ds.import_dtool(uri=second, path='imported', metadata_only=True,
+                          result_renderer='disabled')
+    assert_equal(_summary(res)['status'], 'notneeded')
+
+
+@with_tempfile(mkdir=True)
+def test_import_chunked_resumed(path=None):
+    uri = _create_dtool_dataset(path, 'source', _CONTENT)
+    ds = Dataset(opj(path, 'ds')).create()
+    import_module = importlib.import_module('datalad_dtool.import')
+    register = import_module.KeyRegistrar.__call__
+    calls = []
+
+    def interrupted(self, *args, **kwargs):
+        calls.append(1)
+        if len(calls) == 3:
+            raise RuntimeError('interrupted')
+        return register(self, *args, **kwargs)
+
+    head = ds.repo.get_hexsha()
+    import_module.KeyRegistrar.__call__ = interrupted
+    try:
+        assert_raises(RuntimeError, ds.import_dtool, uri=uri,
+                      path='imported', metadata_only=True, chunk_items=2,
+                      result_renderer='disabled')
+    finally:
+        import_module.KeyRegistrar.__call__ = register
+    # the first chunk was saved
+    assert_equal(ds.repo.get_hexsha('HEAD~1'), head)
+    assert_equal(len(_files(ds)), 2)
+
+    res = ds.import_dtool(uri=uri, path='imported', metadata_only=True,
+                          chunk_items=2, result_renderer='disabled')
+    summary = _summary(res)
+    assert_equal((summary['added'], summary['resumed']), (3, 2))
+    assert_equal(sorted(_files(ds)), sorted(_CONTENT))
+    # one more chunk and the rest
+    assert_equal(ds.repo.get_hexsha('HEAD~3'), head)
+    assert_false(ds.repo.dirty)
+
+
+@with_tempfile(mkdir=True)
+def test_import_include_exclude(path=None):
+    uri = _create_dtool_dataset(path, 'source', _CONTENT)
+    ds = Dataset(opj(path, 'ds')).create()
+    ds.import_dtool(uri=uri, path='imported', metadata_only=True,
+                    include=['dir/**'], exclude=['dir/skip*'],
+                    result_renderer='disabled')
+    assert_equal(sorted(_files(ds)), ['dir/c.txt', 'dir/sub/d.txt'])
+
+    # items no longer selected are removed
+    ds.import_dtool(uri=uri, path='imported', metadata_only=True,
+                    include=['dir/sub'], result_renderer='disabled')
+    assert_equal(sorted(_files(ds)), ['dir/sub/d.txt'])
+    assert_false(ds.repo.dirty)
+
+
+@with_tempfile(mkdir=True)
+def test_import_tree_only(path=None):
+    first = _create_dtool_dataset(path, 'first', {'a.txt': 'a', 'b.txt': 'b'})
+    second = _create_dtool_dataset(
+        path, 'second', {'a.txt': 'a', 'b.txt': 'B', 'dir/c.txt': 'c'})
+    ds = Dataset(opj(path, 'ds')).create()
+    head = ds.repo.get_hexsha()
+    res = ds.import_dtool(uri=first, path='imported', tree_only=True,
+                          result_renderer='disabled')
+    assert_result_count(res, 1, action='save', status='ok')
+    # a single commit, without saving through DataLad
+    assert_equal(ds.repo.get_hexsha('HEAD~1'), head)
+    assert_equal(sorted(_files(ds)), ['a.txt', 'b.txt'])
+    assert_true((ds.pathobj / 'imported' / 'a.txt').is_symlink())
+    assert_false(ds.repo.dirty)
+
+    ds.import_dtool(uri=second, path='imported', tree_only=True,
+                    result_renderer='disabled')
+    assert_equal(ds.repo.get_hexsha('HEAD~2'), head)
+    assert_equal(sorted(_files(ds)), ['a.txt', 'b.txt', 'dir/c.txt'])
+    assert_false(ds.repo.dirty)
+    ds.repo.get('imported/b.txt')
+    assert_equal((ds.pathobj / 'imported' / 'b.txt').read_text(), 'B')
+
+
+@with_tempfile(mkdir=True)
+def test_import_dry_run(path=None):
+    uri = _create_dtool_dataset(path, 'source', _CONTENT)
+    ds = Dataset(opj(path, 'ds')).create()
+    (ds.pathobj / 'imported').mkdir()
+    (ds.pathobj / 'imported' / 'b.txt').write_text('in git')
+    ds.save()
+    head = ds.repo.get_hexsha()
+
+    # collisions do not fail the dry run
+    res = ds.import_dtool(uri=uri, path='imported', dry_run=True,
+                          result_renderer='disabled')
+    assert_result_count(res, 1, status='ok', collision=True,
+                        path=str(ds.pathobj / 'imported' / 'b.txt'))
+    summary = _summary(res)
+    assert_equal((summary['added'], summary['items'], summary['collisions']),
+                 (5, 5, 1))
+    assert_equal(summary['bytes'], sum(map(len, _CONTENT.values())))
+    # nothing changed
+    assert_equal(ds.repo.get_hexsha(), head)
+    assert_equal(RemoteRegistry(ds.repo).names(), set())
+    assert_false(ds.repo.dirty)
@@ -0,0 +1,124 @@
+"""Test the record of imported dtool items"""
+
+import os
+from pathlib import Path
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_is_none,
+    assert_raises,
+    assert_true,
+    with_tempfile,
+)
+
+from datalad_dtool.import_state import (
+    StateWriter,
+    diff_items,
+    iter_state_items,
+    partial_state_path,
+    read_state,
+    state_path,
+)
+
+
+def _props(file_hash, relpath):
+    return {'hash': file_hash, 'relpath': relpath}
+
+
+def test_diff_items():
+    old = [('a', _props('h1', 'x')), ('b', _props('h2', 'y')),
+           ('d', _props('h4', 'w'))]
+    new = [('b', _props('h2', 'y')), ('c', _props('h3', 'z')),
+           ('d', _props('h5', 'w'))]
+    assert_equal(list(diff_items(old, new)), [
+        ('a', _props('h1', 'x'), None),
+        ('b', _props('h2', 'y'), _props('h2', 'y')),
+        ('c', None, _props('h3', 'z')),
+        ('d', _props('h4', 'w'), _props('h5', 'w')),
+    ])
+    assert_equal(list(diff_items([], new[:1])), [('b', None, new[0][1])])
+    assert_equal(list(diff_items(old[:1], [])), [('a', old[0][1], None)])
+
+
+@with_tempfile(mkdir=True)
+def test_state_roundtrip(path=None):
+    ds_pathobj = Path(path)
+    state_file = state_path(ds_pathobj, ds_pathobj / 'imported')
+    assert_equal(state_file.parent, ds_pathobj / '.datalad' / 'dtool')
+    assert_equal(read_state(state_file), (None, None))
+    assert_equal(list(iter_state_items(state_file)), [])
+    partial = partial_state_path(str(ds_pathobj / '.git'), state_file)
+
+    state = StateWriter(str(state_file), partial, 'uuid1', 'file:///ds')
+    assert_is_none(state.open())
+    assert_false(state.resumed)
+    state.write('a', 'h1', 'dir/file with\ttab')
+    state.write('b', 'h2', 'file')
+    state.commit()
+    assert_equal(read_state(state_file), ('uuid1', 'file:///ds'))
+    assert_equal(list(iter_state_items(state_file)), [
+        ('a', _props('h1', 'dir/file with\ttab')),
+        ('b', _props('h2', 'file'))])
+    assert_false(os.path.exists(partial))
+
+    # discarded updates leave the recorded state in place
+    state = StateWriter(str(state_file), partial, 'uuid2', 'file:///ds2')
+    state.open()
+    state.write('c', 'h3', 'other')
+    state.discard()
+    assert_equal(read_state(state_file), ('uuid1', 'file:///ds'))
+    assert_equal(os.listdir(os.path.dirname(partial)), [])
+
+
+@with_tempfile(mkdir=True)
+def test_state_content_missing(path=None):
+    ds_pathobj = Path(path)
+    state_file = state_path(ds_pathobj, ds_pathobj)
+    # annexed state whose content is not present
+    state_file.parent.mkdir(parents=True)
+    state_file.symlink_to('../../.git/annex/objects/missing')
+    assert_raises(ValueError, read_state, state_file)
+    assert_raises(ValueError, list, iter_state_items(state_file))
+
+
+@with_tempfile(mkdir=True)
+def test_state_resume(path=None):
+    ds_pathobj = Path(path)
+    state_file = state_path(ds_pathobj, ds_pathobj)
+    partial = partial_state_path(str(ds_pathobj / '.git'), state_file)
+
+    state = StateWriter(str(state_file), partial, 'uuid1', 'file:///ds')
+    state.open()
+    state.write('a', 'h1', 'x')
+    state.checkpoint()
+    state.write('b', 'h2', 'y')
+    # interrupted, rows after the checkpoint are dropped on resume
+    state._f.close()
+
+    resumed = StateWriter(str(state_file), partial, 'uuid1', 'file:///ds')
+    assert_equal(resumed.open(), 'a')
+    assert_true(resumed.resumed)
+    resumed.write('c', 'h3', 'z')
+    resumed.checkpoint()
+    resumed._f.close()
+    assert_equal(list(iter_state_items(partial)), [
+        ('a', _props('h1', 'x')), ('c', _props('h3', 'z'))])
+
+    # partial state of another dataset is not resumed
+    other = StateWriter(str(state_file), partial, 'uuid2', 'file:///ds')
+    assert_is_none(other.open())
+    assert_false(other.resumed)
+    other.write('d', 'h4', 'w')
+    other.commit()
+    assert_equal(list(iter_state_items(state_file)), [('d', _props('h4', 'w'))])
+
+    # fresh start when not resuming
+    state = StateWriter(str(state_file), partial, 'uuid1', 'file:///ds')
+    state.open()
+    state.write('a', 'h1', 'x')
+    state.checkpoint()
+    state._f.close()
+    state = StateWriter(str(state_file), partial, 'uuid1', 'file:///ds')
+    assert_is_none(state.open(resume=False))
+    assert_false(state.resumed)
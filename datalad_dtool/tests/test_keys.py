@@ -0,0 +1,81 @@
+"""Test parsing of git-annex keys"""
+
+import hashlib
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_is_none,
+    assert_raises,
+)
+
+from datalad_dtool.keys import (
+    format_key,
+    key_extension,
+    key_file,
+    key_hashdir,
+    key_object_path,
+    parse_key,
+)
+
+
+def test_parse_key():
+    key = parse_key('MD5E-s12-m1700000000--d41d8cd98f00b204e9800998ecf8427e.tar.gz')
+    assert_equal(key.backend, 'MD5E')
+    assert_equal(key.size, 12)
+    assert_equal(key.mtime, 1700000000)
+    assert_equal(key.name, 'd41d8cd98f00b204e9800998ecf8427e.tar.gz')
+    assert_equal(key.hash, 'd41d8cd98f00b204e9800998ecf8427e')
+    assert_is_none(key.chunk_size)
+
+    key = parse_key('SHA256-s100-S10-C3--0123')
+    assert_equal((key.backend, key.size, key.chunk_size, key.chunk_number),
+                 ('SHA256', 100, 10, 3))
+    # no extension stripped from keys of backends without E
+    assert_equal(parse_key('MD5--ab.cd').hash, 'ab.cd')
+    assert_is_none(parse_key('MD5--ab').size)
+
+
+def test_parse_invalid_key():
+    for key in ('MD5E', 'MD5E--', '--0123', 'MD5E-x1--0123', 'MD5E-sx--0123'):
+        assert_raises(ValueError, parse_key, key)
+
+
+def test_format_key():
+    assert_equal(format_key('MD5E', '0123.txt', size=12), 'MD5E-s12--0123.txt')
+    assert_equal(format_key('MD5', '0123'), 'MD5--0123')
+    assert_equal(parse_key(format_key('MD5E', '0123.txt', size=0)).size, 0)
+
+
+def test_key_extension():
+    for relpath, extension in (
+            ('dir/file.tar.gz', '.tar.gz'),
+            ('dir.d/file', ''),
+            ('file.1.2.3', '.2.3'),
+            # too long extensions end the extension
+            ('file.a.verylong.gz', '.gz'),
+            # extensions of other characters are skipped
+            ('file.a-b.gz', '.gz'),
+            ('.bashrc', ''),
+            ('.hidden.txt', '.txt'),
+            ('file.', '')):
+        assert_equal(key_extension(relpath), extension)
+    assert_equal(key_extension('file.jpeg', maxlen=3), '')
+
+
+def test_key_object_path():
+    # as laid out by git-annex
+    assert_equal(
+        key_object_path('MD5E-s13--fc2fb139c72a8606580ce5c98f7a688f.txt'),
+        'PQ/x9/MD5E-s13--fc2fb139c72a8606580ce5c98f7a688f.txt/'
+        'MD5E-s13--fc2fb139c72a8606580ce5c98f7a688f.txt')
+    assert_equal(
+        key_hashdir('SHA256E-s0--'
+                    'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'),
+        'pX/ZJ/')
+    # tuned repositories
+    key = 'MD5E-s13--fc2fb139c72a8606580ce5c98f7a688f.txt'
+    digest = hashlib.md5(key.encode()).hexdigest()
+    assert_equal(key_hashdir(key, lower=True),
+                 f'{digest[:3]}/{digest[3:6]}/')
+    assert_equal(key_hashdir(key, levels=1), 'PQ/')
+    assert_equal(key_file('URL--http&c//a%b&c'), 'URL--http&ac%%a&sb&ac')
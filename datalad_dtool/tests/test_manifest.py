@@ -0,0 +1,218 @@
+"""Test lookup tables over dtool manifests"""
+
+import os
+from os.path import join as opj
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_in,
+    assert_is_none,
+    assert_raises,
+    assert_true,
+    with_tempfile,
+)
+from datalad.utils import (
+    chpwd,
+    md5sum,
+)
+
+from dtoolcore import (
+    DataSet,
+    DataSetCreator,
+    ProtoDataSet,
+    create_proto_dataset,
+)
+
+from datalad_dtool.manifest import (
+    ManifestIndex,
+    PersistentManifestIndex,
+    freeze,
+    generate_manifest,
+    item_content_abspath,
+    iter_manifest_items,
+    iter_sorted_manifest_items,
+    manifest_hash_function,
+)
+
+_manifest = {
+    'dtoolcore_version': '3.18.2',
+    'hash_function': 'md5sum_hexdigest',
+    'items': {
+        'a1': {'hash': 'h1', 'relpath': 'file_up',
+               'size_in_bytes': 12, 'utc_timestamp': 1.0},
+        'b2': {'hash': 'h2', 'relpath': 'dir/file1_down',
+               'size_in_bytes': 3, 'utc_timestamp': 1.0},
+        'c3': {'hash': 'h2', 'relpath': 'dir/file2_down',
+               'size_in_bytes': 3, 'utc_timestamp': 1.0},
+    },
+}
+
+
+def test_manifest_index():
+    index = ManifestIndex.from_manifest(_manifest)
+    assert_equal(len(index), 3)
+    assert_equal(index.hash_function, 'md5sum_hexdigest')
+    assert_in('a1', index)
+    assert_false('nothere' in index)
+    assert_equal(index.item_properties('b2')['relpath'], 'dir/file1_down')
+    assert_raises(KeyError, index.item_properties, 'nothere')
+    # duplicate content maps onto all items
+    assert_equal(sorted(index.uuids_for_hash('h2')), ['b2', 'c3'])
+    assert_equal(index.uuids_for_hash('nothere'), [])
+    assert_equal(index.uuid_for_relpath('dir/file2_down'), 'c3')
+    assert_is_none(index.uuid_for_relpath('dir'))
+    assert_true(index.has_size(3))
+    assert_false(index.has_size(4))
+
+    index.remove('b2')
+    index.remove('nothere')
+    assert_equal(index.uuids_for_hash('h2'), ['c3'])
+    assert_is_none(index.uuid_for_relpath('dir/file1_down'))
+    assert_true(index.has_size(3))
+    index.remove('c3')
+    assert_equal(index.uuids_for_hash('h2'), [])
+    assert_false(index.has_size(3))
+    assert_equal(len(index), 1)
+
+
+@with_tempfile(mkdir=True)
+def test_iter_manifest_items(path=None):
+    with DataSetCreator(name='frozen', base_uri=path) as creator:
+        uri = creator.uri
+        handle = creator.prepare_staging_abspath_promise('file_up')
+        with open(handle, 'w') as f:
+            f.write('some_content')
+
+    dtool_dataset = DataSet.from_uri(uri)
+    assert_equal(manifest_hash_function(dtool_dataset), 'md5sum_hexdigest')
+    items = dict(iter_manifest_items(dtool_dataset))
+    assert_equal(items, dtool_dataset.generate_manifest()['items'])
+
+    # frozen datasets are not rehashed, the stored manifest is authoritative
+    (uuid, props), = items.items()
+    fpath = item_content_abspath(dtool_dataset, uuid, props['relpath'])
+    assert_equal(fpath, dtool_dataset.item_content_abspath(uuid))
+    with open(fpath, 'w') as f:
+        f.write('modified')
+    assert_equal(dict(iter_manifest_items(DataSet.from_uri(uri))), items)
+
+    index = ManifestIndex.from_dataset(dtool_dataset)
+    assert_equal(index.uuid_for_relpath('file_up'), uuid)
+    assert_equal(index.uuids_for_hash(props['hash']), [uuid])
+
+
+@with_tempfile(mkdir=True)
+def test_iter_sorted_manifest_items(path=None):
+    with DataSetCreator(name='frozen', base_uri=path) as creator:
+        uri = creator.uri
+        for relpath in ('a', 'b', 'c', 'd'):
+            with open(creator.prepare_staging_abspath_promise(relpath), 'w') as f:
+                f.write(relpath)
+    dtool_dataset = DataSet.from_uri(uri)
+    expected = sorted(dtool_dataset._manifest['items'].items())
+    assert_equal(list(iter_sorted_manifest_items(dtool_dataset)), expected)
+    # unsorted manifests are sorted
+    dtool_dataset._manifest['items'] = dict(reversed(expected))
+    assert_equal(list(iter_sorted_manifest_items(dtool_dataset)), expected)
+
+
+@with_tempfile(mkdir=True)
+def test_iter_manifest_items_proto(path=None):
+    proto_dataset = create_proto_dataset(name='proto', base_uri=path)
+    with open(opj(path, 'content'), 'w') as f:
+        f.write('one')
+    proto_dataset.put_item(opj(path, 'content'), 'dir/file1_down')
+    proto_dataset = ProtoDataSet.from_uri(proto_dataset.uri)
+
+    assert_equal(manifest_hash_function(proto_dataset), 'md5sum_hexdigest')
+    (uuid, props), = iter_manifest_items(proto_dataset)
+    assert_equal(props['relpath'], 'dir/file1_down')
+    assert_equal(props['hash'], md5sum(opj(path, 'content')))
+
+
+@with_tempfile(mkdir=True)
+def test_generate_manifest_known_items(path=None):
+    proto_dataset = create_proto_dataset(name='proto', base_uri=path)
+    for relpath, content in (('known', 'one'), ('dir/unknown', 'two')):
+        with open(opj(path, 'content'), 'w') as f:
+            f.write(content)
+        proto_dataset.put_item(opj(path, 'content'), relpath)
+    expected = proto_dataset.generate_manifest()
+
+    # a hash the content does not have shows it is not hashed again
+    freeze(proto_dataset, {'known': ('h1', 3)})
+    dataset = DataSet.from_uri(proto_dataset.uri)
+    assert_true(dataset._admin_metadata['frozen_at'] > 0)
+    manifest = dataset._manifest
+    assert_equal(manifest['hash_function'], expected['hash_function'])
+    assert_equal(manifest['items'].keys(), expected['items'].keys())
+    for identifier, props in manifest['items'].items():
+        if props['relpath'] == 'known':
+            assert_equal(props['hash'], 'h1')
+            assert_equal(props['size_in_bytes'], 3)
+        else:
+            assert_equal(props['hash'],
+                         expected['items'][identifier]['hash'])
+
+
+@with_tempfile(mkdir=True)
+def test_generate_manifest_processes(path=None):
+    proto_dataset = create_proto_dataset(name='proto', base_uri=path)
+    for i in range(4):
+        with open(opj(path, 'content'), 'w') as f:
+            f.write(str(i))
+        proto_dataset.put_item(opj(path, 'content'), f'item{i}')
+    expected = proto_dataset.generate_manifest()['items']
+    os.environ['DTOOL_NUM_PROCESSES'] = '2'
+    try:
+        manifest = generate_manifest(proto_dataset, {'item0': ('h0', 1)})
+    finally:
+        del os.environ['DTOOL_NUM_PROCESSES']
+    assert_equal(manifest['items'].keys(), expected.keys())
+    for identifier, props in manifest['items'].items():
+        assert_equal(props['hash'], 'h0' if props['relpath'] == 'item0'
+                     else expected[identifier]['hash'])
+
+
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_persistent_manifest_index(path=None, cache_dir=None):
+    with DataSetCreator(name='frozen', base_uri=path) as creator:
+        uri = creator.uri
+        for relpath, content in (('file_up', 'some_content'),
+                                 ('dir/file1_down', 'one'),
+                                 ('dir/file2_down', 'one')):
+            with open(creator.prepare_staging_abspath_promise(relpath), 'w') as f:
+                f.write(content)
+    dtool_dataset = DataSet.from_uri(uri)
+    expected = ManifestIndex.from_dataset(dtool_dataset)
+
+    index = PersistentManifestIndex.from_dataset(dtool_dataset, cache_dir)
+    assert_equal(os.listdir(cache_dir), [f'{dtool_dataset.uuid}.sqlite'])
+    assert_equal(len(index), 3)
+    assert_equal(index.hash_function, expected.hash_function)
+    for relpath in ('file_up', 'dir/file1_down', 'dir/file2_down'):
+        uuid = index.uuid_for_relpath(relpath)
+        assert_in(uuid, index)
+        props = index.item_properties(uuid)
+        assert_equal(props, expected.item_properties(uuid))
+        assert_equal(sorted(index.uuids_for_hash(props['hash'])),
+                     sorted(expected.uuids_for_hash(props['hash'])))
+    assert_is_none(index.uuid_for_relpath('dir'))
+    assert_raises(KeyError, index.item_properties, 'nothere')
+    assert_true(index.has_size(12))
+    assert_false(index.has_size(4))
+    assert_equal(list(index.iter_after(index.uuid_for_relpath('dir/file1_down'))),
+                 list(expected.iter_after(index.uuid_for_relpath('dir/file1_down'))))
+
+    # reopened from cache, not rebuilt
+    mtime = os.stat(index.path).st_mtime_ns
+    reopened = PersistentManifestIndex.from_dataset(dtool_dataset, cache_dir)
+    assert_equal(os.stat(reopened.path).st_mtime_ns, mtime)
+    assert_equal(len(reopened), 3)
+
+    # the special remote gets a cache directory relative to the repository
+    with chpwd(cache_dir):
+        relative = PersistentManifestIndex.from_dataset(dtool_dataset, '.')
+        assert_equal(len(relative), 3)
@@ -0,0 +1,49 @@
+"""Test git-annex metadata from dtool overlays and annotations"""
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    with_tempfile,
+)
+
+from dtoolcore import DataSet, DataSetCreator
+
+from datalad_dtool.metadata import (
+    AnnexMetadataWriter,
+    field_name,
+    field_values,
+)
+
+
+def test_fields():
+    assert_equal(field_name('is_read1'), 'is_read1')
+    assert_equal(field_name('sample id/2'), 'sample_id_2')
+    assert_equal(field_values(None), [])
+    assert_equal(field_values(''), [])
+    assert_equal(field_values(True), ['true'])
+    assert_equal(field_values(3), ['3'])
+    assert_equal(field_values(['a', None, 2]), ['a', '2'])
+    assert_equal(field_values({'b': 1, 'a': 2}), ['{"a": 2, "b": 1}'])
+
+
+@with_tempfile(mkdir=True)
+def test_metadata_writer_fields(path=None):
+    with DataSetCreator(name='ds', base_uri=path) as creator:
+        uri = creator.uri
+        for relpath in ('a.txt', 'b.txt'):
+            with open(creator.prepare_staging_abspath_promise(relpath), 'w') as f:
+                f.write(relpath)
+        creator.put_annotation('project', 'demo')
+        creator.put_annotation('kind', 'overridden')
+    dtool_dataset = DataSet.from_uri(uri)
+    ids = {dtool_dataset.item_properties(i)['relpath']: i
+           for i in dtool_dataset.identifiers}
+    dtool_dataset.put_overlay('kind', {ids['a.txt']: 'raw', ids['b.txt']: None})
+    dtool_dataset.put_overlay('is_read', {ids['a.txt']: True, ids['b.txt']: False})
+
+    writer = AnnexMetadataWriter(None, DataSet.from_uri(uri))
+    assert_equal(writer.fields(ids['a.txt']),
+                 {'project': ['demo'], 'kind': ['raw'], 'is_read': ['true']})
+    # overlays without value leave the annotation in place
+    assert_equal(writer.fields(ids['b.txt']),
+                 {'project': ['demo'], 'kind': ['overridden'],
+                  'is_read': ['false']})
@@ -0,0 +1,67 @@
+"""Test the projected cost of dtool imports"""
+
+from datalad.tests.utils_pytest import assert_equal
+
+from datalad_dtool.plan import ImportPlan
+
+
+def _entry(file_hash, relpath, size=10):
+    return {'hash': file_hash, 'relpath': relpath, 'size_in_bytes': size}
+
+
+def test_import_plan():
+    plan = ImportPlan('imported', existing={'imported/b.txt', 'other'})
+    plan.add(None, _entry('h1', 'a.txt'))
+    # same content in another directory, another symlink blob
+    plan.add(None, _entry('h1', 'sub/a.txt'))
+    plan.add(None, _entry('h1', 'sub/c.txt'))
+    plan.add(None, _entry('h2', 'b.txt', size=5))
+    plan.add(_entry('h3', 'd.txt'), _entry('h3', 'd.txt'))
+    plan.add(_entry('h4', 'e.txt'), None)
+    plan.finish('.datalad/dtool/import-x.tsv')
+
+    assert_equal(plan.counts, {'added': 4, 'updated': 0, 'removed': 1,
+                               'unchanged': 1})
+    assert_equal(plan.n_items, 4)
+    assert_equal(plan.n_bytes, 35)
+    assert_equal(plan.n_duplicate_hashes, 1)
+    assert_equal(plan.n_duplicate_items, 2)
+    assert_equal(plan.collisions, ['imported/b.txt'])
+    # 3 symlink blobs and the state, trees of '', imported, imported/sub,
+    # .datalad and .datalad/dtool, one commit
+    assert_equal((plan.n_blobs, plan.n_trees, plan.n_commits), (4, 5, 1))
+    assert_equal(plan.n_git_objects, 10)
+
+
+def test_import_plan_collisions():
+    plan = ImportPlan('', existing={'raw', 'data/x/y.txt'})
+    for relpath in ('raw/a.txt', 'data/x', 'data/z.txt'):
+        plan.add(None, _entry('h', relpath))
+    assert_equal(plan.collisions, ['raw/a.txt', 'data/x'])
+    # files of the previous import at the same path do not collide
+    plan.add(_entry('h0', 'raw'), _entry('h', 'raw'))
+    assert_equal(len(plan.collisions), 2)
+
+
+def test_import_plan_chunks():
+    plan = ImportPlan('', chunk_items=2)
+    for i in range(5):
+        plan.add(None, _entry(f'h{i}', f'd{i}/f'))
+    plan.finish('.datalad/dtool/import-x.tsv')
+    # two full chunks and the final commit
+    assert_equal(plan.n_commits, 3)
+    assert_equal(plan.n_trees, 3 + 3 + 4)
+
+
+def test_import_plan_unchanged():
+    plan = ImportPlan('')
+    plan.add(_entry('h', 'a.txt'), _entry('h', 'a.txt'))
+    plan.finish('.datalad/dtool/import-x.tsv')
+    # nothing to commit
+    assert_equal((plan.n_blobs, plan.n_trees, plan.n_commits), (0, 0, 0))
+
+    # the state records another dtool dataset
+    plan = ImportPlan('')
+    plan.add(_entry('h', 'a.txt'), _entry('h', 'a.txt'))
+    plan.finish('.datalad/dtool/import-x.tsv', state_changed=True)
+    assert_equal((plan.n_blobs, plan.n_trees, plan.n_commits), (1, 3, 1))
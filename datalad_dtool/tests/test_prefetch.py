@@ -0,0 +1,151 @@
+"""Test background prefetching of dtool item content"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_in,
+    with_tempfile,
+)
+from dtoolcore import DataSet, DataSetCreator
+
+from datalad_dtool.manifest import ManifestIndex
+from datalad_dtool.pool import ItemFetcher
+from datalad_dtool.prefetch import Prefetcher
+
+
+def _index(n_items, size=10):
+    return ManifestIndex('md5sum_hexdigest', (
+        (f'uuid{i}', {'hash': f'h{i}', 'relpath': f'file{i:02d}',
+                      'size_in_bytes': size, 'utc_timestamp': 0.0})
+        for i in range(n_items)))
+
+
+def test_iter_after():
+    index = _index(5)
+    assert_equal(list(index.iter_after('uuid2')),
+                 [('uuid3', 10), ('uuid4', 10)])
+    assert_equal(list(index.iter_after('uuid4')), [])
+
+
+def test_prefetcher():
+    index = _index(20)
+    fetched = []
+    lock = threading.Lock()
+
+    def fetch(uuid):
+        with lock:
+            fetched.append(uuid)
+        return f'/cache/{uuid}'
+
+    prefetcher = Prefetcher(fetch, index.iter_after, jobs=2, budget=30)
+    assert_equal(prefetcher.get('uuid0'), '/cache/uuid0')
+    # budget allows for three items ahead of the request
+    assert_equal(sorted(prefetcher._pending), ['uuid1', 'uuid2', 'uuid3'])
+    assert_equal(prefetcher.get('uuid1'), '/cache/uuid1')
+    assert_equal(prefetcher.get('uuid2'), '/cache/uuid2')
+    prefetcher._pending['uuid4'][0].result()
+    assert_in('uuid4', fetched)
+    # sequential requests did not fetch anything twice
+    assert_equal(len(fetched), len(set(fetched)))
+
+    # mispredicted items are dropped from the budget
+    assert_equal(prefetcher.get('uuid10'), '/cache/uuid10')
+    assert_false(set(prefetcher._pending) & {'uuid3', 'uuid4', 'uuid5'})
+    assert_equal(sorted(prefetcher._pending), ['uuid11', 'uuid12', 'uuid13'])
+    prefetcher.close()
+
+
+def test_prefetcher_discard_running():
+    index = _index(20)
+    started = threading.Event()
+    release = threading.Event()
+
+    def fetch(uuid):
+        if uuid == 'uuid0':
+            # the request is served before anything is prefetched
+            assert_equal(prefetcher._pending, {})
+        if uuid == 'uuid1':
+            started.set()
+            release.wait(10)
+        return f'/cache/{uuid}'
+
+    prefetcher = Prefetcher(fetch, index.iter_after, jobs=1, budget=20)
+    prefetcher.get('uuid0')
+    started.wait(10)
+    # uuid1 is being downloaded and cannot be cancelled, its bytes stay
+    # counted and leave room for one item only
+    prefetcher.get('uuid10')
+    assert_equal(sorted(prefetcher._pending), ['uuid11'])
+    assert_equal(prefetcher._pending_bytes, 20)
+
+    release.set()
+    prefetcher._pending['uuid11'][0].result()
+    prefetcher.get('uuid11')
+    assert_equal(sorted(prefetcher._pending), ['uuid12', 'uuid13'])
+    assert_equal(prefetcher._pending_bytes, 20)
+    prefetcher.close()
+
+
+def test_prefetcher_discarded_request():
+    index = _index(20)
+    release = threading.Event()
+    fetched = []
+
+    def fetch(uuid):
+        fetched.append(uuid)
+        if uuid == 'uuid1':
+            release.wait(10)
+        return f'/cache/{uuid}'
+
+    prefetcher = Prefetcher(fetch, index.iter_after, jobs=1, budget=20)
+    prefetcher.get('uuid0')
+    prefetcher.get('uuid10')
+    # the discarded download of uuid1 is still running, a request for it
+    # waits for it instead of downloading it a second time
+    threading.Timer(0.2, release.set).start()
+    assert_equal(prefetcher.get('uuid1'), '/cache/uuid1')
+    assert_equal(fetched.count('uuid1'), 1)
+    assert_equal(prefetcher._discarded, {})
+    prefetcher.close()
+
+
+def test_prefetcher_failed():
+    index = _index(5)
+    failed = []
+
+    def fetch(uuid):
+        if uuid == 'uuid1' and not failed:
+            failed.append(uuid)
+            raise OSError('connection reset')
+        return f'/cache/{uuid}'
+
+    prefetcher = Prefetcher(fetch, index.iter_after, jobs=1, budget=20)
+    prefetcher.get('uuid0')
+    wait([prefetcher._pending['uuid1'][0]])
+    # fetched again on request
+    assert_equal(prefetcher.get('uuid1'), '/cache/uuid1')
+    assert_equal(failed, ['uuid1'])
+    prefetcher.close()
+
+
+@with_tempfile(mkdir=True)
+def test_item_fetcher(path=None):
+    with DataSetCreator(name='frozen', base_uri=path) as creator:
+        uri = creator.uri
+        with open(creator.prepare_staging_abspath_promise('a.txt'), 'w') as f:
+            f.write('a')
+    dataset = DataSet.from_uri(uri)
+    uuid, = dataset.identifiers
+    fetcher = ItemFetcher(dataset)
+    expected = dataset.item_content_abspath(uuid)
+    assert_equal(fetcher(uuid), expected)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(
+            lambda _: (fetcher(uuid), fetcher._local.dataset), range(4)))
+    assert_equal({path for path, _ in results}, {expected})
+    # prefetch threads do not share the dataset of the creating thread
+    assert_false(any(opened is dataset for _, opened in results))
@@ -0,0 +1,97 @@
+"""Test the registry of dtool special remotes"""
+
+from datalad.support.annexrepo import AnnexRepo
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_is_none,
+    assert_not_equal,
+    with_tempfile,
+)
+
+from datalad_dtool.remotes import RemoteRegistry, remote_name
+
+
+class FakeRepo:
+    """Stand-in for the AnnexRepo queried by the registry"""
+
+    def __init__(self, dot_git, special_remotes):
+        self.dot_git = dot_git
+        self.special_remotes = special_remotes
+        self.remote_log = 'a' * 40
+        self.listed = 0
+
+    def call_git_oneline(self, args, read_only=False):
+        return self.remote_log
+
+    def get_special_remotes(self):
+        self.listed += 1
+        return self.special_remotes
+
+
+def test_remote_name():
+    assert_equal(remote_name('1a1f9fad'), 'dtool-1a1f9fad')
+    # stable across processes
+    assert_equal(remote_name('1a1f9fad', 's3://bucket/1a1f9fad'),
+                 remote_name('1a1f9fad', 's3://bucket/1a1f9fad'))
+    assert_not_equal(remote_name('1a1f9fad', 's3://bucket/1a1f9fad'),
+                     remote_name('1a1f9fad', 'file:///copy/1a1f9fad'))
+
+
+@with_tempfile(mkdir=True)
+def test_remote_registry(path=None):
+    repo = FakeRepo(path, {
+        'u1': {'name': 'dtool-a', 'externaltype': 'dtool', 'uri': 'file:///a'},
+        'u2': {'name': 'web', 'type': 'web'},
+        'u3': {'name': 'dtool-b', 'externaltype': 'dtool', 'uri': 'file:///b'},
+    })
+    registry = RemoteRegistry(repo)
+    assert_equal(registry.lookup('file:///a'), 'dtool-a')
+    assert_is_none(registry.lookup('file:///c'))
+    assert_equal(registry.names(), {'dtool-a', 'dtool-b'})
+    assert_equal(repo.listed, 1)
+
+    # cached until the remote log changes
+    registry.add('file:///c', 'dtool-c')
+    assert_equal(RemoteRegistry(repo).lookup('file:///c'), 'dtool-c')
+    assert_equal(repo.listed, 1)
+
+    repo.remote_log = 'b' * 40
+    repo.special_remotes['u4'] = {
+        'name': 'dtool', 'externaltype': 'dtool', 'multi': 'yes'}
+    registry = RemoteRegistry(repo)
+    # a multi remote serves all URIs without a remote of their own
+    assert_equal(registry.lookup('file:///b'), 'dtool-b')
+    assert_equal(registry.lookup('file:///d'), 'dtool')
+    assert_equal(repo.listed, 2)
+
+
+@with_tempfile(mkdir=True)
+def test_remote_registry_annex(path=None):
+    repo = AnnexRepo(path, create=True)
+    listed = []
+    get_special_remotes = repo.get_special_remotes
+
+    def count_listing():
+        listed.append(1)
+        return get_special_remotes()
+
+    repo.get_special_remotes = count_listing
+    repo.init_remote('dtool-a', ['type=external', 'externaltype=dtool',
+                                 'encryption=none', 'autoenable=true',
+                                 'uri=file:///a'])
+    assert_equal(RemoteRegistry(repo).lookup('file:///a'), 'dtool-a')
+    assert_equal(len(listed), 1)
+
+    # registering URLs moves the git-annex branch, not the remote log
+    (repo.pathobj / 'f').write_text('content')
+    repo.add('f')
+    repo.commit('add f')
+    repo.call_annex(['registerurl', repo.get_file_annexinfo('f')['key'],
+                     'https://example.com/f'])
+    assert_equal(RemoteRegistry(repo).lookup('file:///a'), 'dtool-a')
+    assert_equal(len(listed), 1)
+
+    repo.init_remote('dtool-b', ['type=external', 'externaltype=dtool',
+                                 'encryption=none', 'uri=file:///b'])
+    assert_equal(RemoteRegistry(repo).lookup('file:///b'), 'dtool-b')
+    assert_equal(len(listed), 2)
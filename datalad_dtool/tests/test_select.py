@@ -0,0 +1,47 @@
+"""Test selection of dtool items by relpath patterns"""
+
+from datalad.tests.utils_pytest import assert_equal
+
+from datalad_dtool.select import PathSelector
+
+_relpaths = [
+    'README',
+    'raw/2023-12/run1/data.h5',
+    'raw/2024-01/run1/data.h5',
+    'raw/2024-01/run1/log.txt',
+    'raw/2024-02/data.h5',
+    'processed/2024-01/data.h5',
+]
+
+
+def _select(*args, **kwargs):
+    selector = PathSelector(*args, **kwargs)
+    return [i for i, relpath in enumerate(_relpaths) if selector(relpath)]
+
+
+def test_path_selector():
+    def match(pattern):
+        selector = PathSelector(include=[pattern])
+        return sorted(p for p in _relpaths if selector(p))
+
+    assert_equal(match('README'), ['README'])
+    assert_equal(match('nothere'), [])
+    # directories select their subtree
+    assert_equal(match('raw/2024-01'), _relpaths[2:4])
+    assert_equal(match('./raw/2024-01/'), _relpaths[2:4])
+    assert_equal(match('raw/2024-*/**/*.h5'),
+                 ['raw/2024-01/run1/data.h5', 'raw/2024-02/data.h5'])
+    assert_equal(match('**/data.h5'),
+                 sorted(p for p in _relpaths if p.endswith('data.h5')))
+    assert_equal(match('raw/**'), sorted(_relpaths[1:5]))
+    assert_equal(match('*/2024-0[2-9]'), ['raw/2024-02/data.h5'])
+    assert_equal(match('*/2024-0[!1]'),
+                 ['raw/2024-02/data.h5'])
+    assert_equal(match('*'), sorted(_relpaths))
+    # wildcards do not span directories
+    assert_equal(match('raw*h5'), [])
+    assert_equal(match('raw?2024-01'), [])
+
+    assert_equal(_select(), list(range(6)))
+    assert_equal(_select(include=['raw'], exclude=['**/*.txt']), [1, 2, 4])
+    assert_equal(_select(exclude=['raw', 'processed']), [0])
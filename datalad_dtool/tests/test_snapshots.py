@@ -0,0 +1,61 @@
+"""Test finding previous dtool snapshots of a DataLad dataset"""
+
+import os
+
+from dtoolcore import DataSetCreator
+
+from datalad.support.gitrepo import GitRepo
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_is_none,
+    with_tempfile,
+)
+
+from datalad_dtool.snapshots import changed_paths, find_previous_snapshot
+
+
+def _commit(repo, path, content):
+    with open(os.path.join(repo.path, path), 'w') as f:
+        f.write(content)
+    repo.add(path)
+    repo.commit(f'write {path}')
+    return repo.get_hexsha()
+
+
+def _snapshot(base_uri, name, uuid, commit):
+    with DataSetCreator(name, base_uri) as creator:
+        creator.put_annotation('datalad-uuid', uuid)
+        creator.put_annotation('datalad-commit', commit)
+    return creator.uri
+
+
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_find_previous_snapshot(path=None, base_uri=None):
+    repo = GitRepo(path, create=True)
+    first = _commit(repo, 'a.txt', 'a')
+    second = _commit(repo, 'b.txt', 'b')
+    # an export of another dataset and of a commit off the history
+    _snapshot(base_uri, 'other', 'other-uuid', second)
+    repo.checkout('side', options=['-b'])
+    side = _commit(repo, 'c.txt', 'c')
+    repo.checkout('-')
+    third = _commit(repo, 'a.txt', 'changed')
+    _snapshot(base_uri, 'side', 'uuid', side)
+
+    assert_equal(find_previous_snapshot(repo, base_uri, 'uuid', third),
+                 (None, None))
+
+    first_uri = _snapshot(base_uri, 'first', 'uuid', first)
+    dataset, commit = find_previous_snapshot(repo, base_uri, 'uuid', third)
+    assert_equal((dataset.uri, commit), (first_uri, first))
+
+    second_uri = _snapshot(base_uri, 'second', 'uuid', second)
+    dataset, commit = find_previous_snapshot(repo, base_uri, 'uuid', third)
+    assert_equal((dataset.uri, commit), (second_uri, second))
+    dataset, commit = find_previous_snapshot(repo, base_uri, 'uuid', first)
+    assert_equal((dataset.uri, commit), (first_uri, first))
+
+    assert_equal(changed_paths(repo, first, third), {'a.txt', 'b.txt'})
+    assert_equal(changed_paths(repo, second, second), set())
+    assert_is_none(find_previous_snapshot(repo, base_uri, 'none', third)[0])
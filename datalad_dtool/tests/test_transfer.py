@@ -0,0 +1,99 @@
+"""Test local file transfer between DataLad and dtool datasets"""
+
+import os
+from os.path import join as opj
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_in,
+    with_tempfile,
+)
+
+from datalad_dtool import transfer
+from datalad_dtool.transfer import (
+    RateLimitedProgress,
+    copy_file,
+    link_file,
+)
+
+
+def _check_copy(path, content, **kwargs):
+    src = opj(path, 'src')
+    dst = opj(path, 'dst')
+    with open(src, 'wb') as f:
+        f.write(content)
+    mode = copy_file(src, dst, **kwargs)
+    with open(dst, 'rb') as f:
+        assert_equal(f.read(), content)
+    return mode
+
+
+@with_tempfile(mkdir=True)
+def test_copy_file(path=None):
+    for content in (b'', b'some_content', b'x' * (3 * 2 ** 20 + 17)):
+        assert_in(_check_copy(path, content),
+                  ('reflink', 'copy_file_range', 'sendfile', 'buffered'))
+
+
+def test_copy_file_fallback(tmp_path, monkeypatch):
+    def unsupported(fsrc, fdst, size, bufsize, progress):
+        # leave partial content behind, must not end up in the copy
+        fdst.write(b'garbage')
+        raise OSError("not supported")
+
+    monkeypatch.setattr(transfer, '_ZERO_COPY_MODES',
+                        [('reflink', unsupported)])
+    assert_equal(_check_copy(str(tmp_path), b'some_content'), 'buffered')
+
+
+def test_copy_file_short(tmp_path, monkeypatch):
+    # the syscalls copying nothing before the end of the file
+    monkeypatch.setattr(os, 'copy_file_range',
+                        lambda *args: 0, raising=False)
+    monkeypatch.setattr(os, 'sendfile', lambda *args: 0, raising=False)
+    monkeypatch.setattr(transfer, '_ZERO_COPY_MODES',
+                        transfer._ZERO_COPY_MODES[1:])
+    reports = []
+    assert_equal(_check_copy(str(tmp_path), b'some_content',
+                             progress=RateLimitedProgress(
+                                 reports.append, interval=0)),
+                 'buffered')
+    assert_equal(reports[-1], len(b'some_content'))
+
+
+def test_copy_file_progress(tmp_path, monkeypatch):
+    content = b'x' * 1000
+    for modes in ([], transfer._ZERO_COPY_MODES[1:]):
+        monkeypatch.setattr(transfer, '_ZERO_COPY_MODES', modes)
+        reports = []
+        _check_copy(str(tmp_path), content, bufsize=100,
+                    progress=RateLimitedProgress(reports.append, interval=0))
+        # every chunk and the final size without rate limit
+        assert_equal(reports, list(range(100, 1001, 100)) + [len(content)])
+
+    reports = []
+    _check_copy(str(tmp_path), content, bufsize=100,
+                progress=RateLimitedProgress(reports.append, interval=3600))
+    assert_equal(reports, [len(content)])
+
+
+def test_link_file(tmp_path, monkeypatch):
+    src = tmp_path / 'src'
+    src.write_bytes(b'some_content')
+    for mode in ('hardlink', 'symlink'):
+        dst = tmp_path / mode
+        assert_equal(link_file(str(src), str(dst), mode=mode), mode)
+        assert_equal(dst.read_bytes(), b'some_content')
+    assert_equal(os.stat(src).st_nlink, 2)
+    assert_equal(os.readlink(tmp_path / 'symlink'), str(src))
+
+    # links fall back to copies
+    def cross_device(src, dst):
+        raise OSError(18, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, 'link', cross_device)
+    dst = tmp_path / 'copy'
+    assert_in(link_file(str(src), str(dst), mode='hardlink'),
+              ('reflink', 'copy_file_range', 'sendfile', 'buffered'))
+    assert_equal(dst.read_bytes(), b'some_content')
+    assert_equal(os.stat(src).st_nlink, 2)
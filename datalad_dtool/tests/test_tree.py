@@ -0,0 +1,95 @@
+"""Test writing commits of annex symlinks without the worktree"""
+
+import os
+
+from datalad.support.gitrepo import GitRepo
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_not_in,
+    with_tempfile,
+)
+
+from datalad_dtool.tree import TreeWriter, annex_link_target
+
+KEY = 'MD5E-s13--fc2fb139c72a8606580ce5c98f7a688f.txt'
+
+
+def test_annex_link_target():
+    assert_equal(
+        annex_link_target('imported/test_file.txt', KEY),
+        f'../.git/annex/objects/PQ/x9/{KEY}/{KEY}')
+    assert_equal(annex_link_target('a.txt', KEY),
+                 f'.git/annex/objects/PQ/x9/{KEY}/{KEY}')
+
+
+def _tree(repo):
+    return dict(
+        line.split('\t', 1)[::-1] for line in repo.call_git_items_(
+            ['ls-tree', '-r', 'HEAD', '--format=%(objectmode)\t%(path)']))
+
+
+@with_tempfile(mkdir=True)
+def test_tree_writer(path=None):
+    repo = GitRepo(path, create=True)
+    # no commit to start from
+    tree = TreeWriter(repo, 'first')
+    tree.annex_link(repo.pathobj / 'imported' / 'a.txt', KEY)
+    tree.annex_link(repo.pathobj / 'imported' / 'b c.txt', KEY)
+    first = tree.close()
+    tree.update_worktree(first)
+    assert_equal(_tree(repo), {'imported/a.txt': '120000',
+                               'imported/b c.txt': '120000'})
+    assert_equal(os.readlink(repo.pathobj / 'imported' / 'a.txt'),
+                 annex_link_target('imported/a.txt', KEY))
+
+    source = repo.pathobj.parent / (repo.pathobj.name + '.state')
+    source.write_text('state\n')
+    tree = TreeWriter(repo, 'second')
+    tree.remove(repo.pathobj / 'imported' / 'a.txt')
+    tree.add_file(repo.pathobj / 'state.tsv', str(source))
+    tree.add_content(repo.pathobj / '.gitattributes', b'* -text\n')
+    second = tree.close()
+    assert_equal(repo.get_hexsha('HEAD~1'), first)
+    tree.update_worktree(second)
+    assert_not_in('imported/a.txt', _tree(repo))
+    assert_false((repo.pathobj / 'imported' / 'a.txt').is_symlink())
+    assert_equal((repo.pathobj / 'state.tsv').read_text(), 'state\n')
+    assert_equal((repo.pathobj / '.gitattributes').read_text(), '* -text\n')
+    assert_false(repo.dirty)
+
+    # state rewritten in place with the same content, as a committed
+    # import does, does not block the next update
+    state = repo.pathobj / 'state.tsv'
+    state.unlink()
+    source.rename(state)
+    os.utime(state, (0, 0))
+    source.write_text('state\nmore\n')
+    tree = TreeWriter(repo, 'third')
+    tree.remove(repo.pathobj / 'imported' / 'b c.txt')
+    tree.add_file(state, str(source))
+    third = tree.close()
+    tree.update_worktree(third)
+    assert_equal(_tree(repo), {'state.tsv': '100644',
+                               '.gitattributes': '100644'})
+    assert_equal(state.read_text(), 'state\nmore\n')
+    assert_false(repo.dirty)
+    source.unlink()
+
+    # aborted commits leave the branch alone
+    tree = TreeWriter(repo, 'aborted')
+    tree.annex_link(repo.pathobj / 'aborted.txt', KEY)
+    tree.abort()
+    assert_equal(repo.get_hexsha(), third)
+
+
+
+@with_tempfile(mkdir=True)
+def test_tree_writer_tuned(path=None):
+    repo = GitRepo(path, create=True)
+    repo.config.set('annex.tune.objecthashlower', 'true', scope='local')
+    tree = TreeWriter(repo, 'tuned')
+    tree.annex_link(repo.pathobj / 'a.txt', KEY)
+    tree.update_worktree(tree.close())
+    assert_equal(os.readlink(repo.pathobj / 'a.txt'),
+                 annex_link_target('a.txt', KEY, lower=True))
@@ -0,0 +1,38 @@
+"""Wall clock time spent per phase of the dtool special remote"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseTimer:
+    """Accumulate the time spent in named phases, e.g. opening a dataset.
+
+    Use as ``with timer('open'): ...``.
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def __call__(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.totals[phase] += elapsed
+            self.counts[phase] += 1
+            logger.debug("Phase %s took %.3fs", phase, elapsed)
+
+    def summary(self):
+        """Return a one-line summary of the time spent per phase."""
+        return ', '.join(
+            f"{phase} {total:.3f}s ({self.counts[phase]}x)"
+            for phase, total in self.totals.items())
@@ -0,0 +1,161 @@
+"""Local file transfer between DataLad and dtool datasets"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# _IOW(0x94, 9, int) from linux/fs.h, clone all extents of a file
+FICLONE = 0x40049409
+
+#: default size of the chunks content is copied in between progress reports
+DEFAULT_BUFFER_SIZE = 8 * 2 ** 20
+
+
+class RateLimitedProgress:
+    """Forward the number of bytes transferred to `report`, at most every
+    `interval` seconds, so that progress messages do not slow the transfer."""
+
+    def __init__(self, report, interval=0.5):
+        self.report = report
+        self.interval = interval
+        self._last = time.monotonic()
+
+    def __call__(self, nbytes, final=False):
+        now = time.monotonic()
+        if final or now - self._last >= self.interval:
+            self._last = now
+            self.report(nbytes)
+
+
+def _reflink(fsrc, fdst, size, bufsize, progress):
+    if fcntl is None:
+        raise OSError("reflinks not supported on this platform")
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _check_copied(offset, size):
+    # a syscall copying nothing before the end, e.g. as the source shrank,
+    # must fail over to the next copy mode instead of truncating the copy
+    if offset != size:
+        raise OSError(f"Copied {offset} of {size} bytes")
+
+
+def _copy_file_range(fsrc, fdst, size, bufsize, progress):
+    offset = 0
+    while offset < size:
+        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                               min(bufsize, size - offset), offset, offset)
+        if n == 0:
+            break
+        offset += n
+        progress(offset)
+    _check_copied(offset, size)
+
+
+def _sendfile(fsrc, fdst, size, bufsize, progress):
+    offset = 0
+    while offset < size:
+        n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset,
+                        min(bufsize, size - offset))
+        if n == 0:
+            break
+        offset += n
+        progress(offset)
+    _check_copied(offset, size)
+
+
+def _buffered(fsrc, fdst, bufsize, progress):
+    buf = memoryview(bytearray(bufsize))
+    offset = 0
+    while True:
+        n = fsrc.readinto(buf)
+        if not n:
+            break
+        fdst.write(buf[:n])
+        offset += n
+        progress(offset)
+
+
+# in order of preference, from sharing extents on copy-on-write filesystems
+# to in-kernel copies
+_ZERO_COPY_MODES = [
+    ('reflink', _reflink),
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _sendfile),
+]
+
+
+def copy_file(src, dst, bufsize=DEFAULT_BUFFER_SIZE, progress=None):
+    """Copy content of file `src` to `dst` without passing it through user space.
+
+    Tries a reflink (FICLONE ioctl on btrfs, XFS, ...), ``os.copy_file_range``
+    and ``os.sendfile`` in turn and falls back to a buffered copy if none of
+    them is supported for the pair of files. Content is copied in chunks of
+    `bufsize` bytes, `progress` is called as ``progress(nbytes)`` with the
+    number of bytes copied so far after each chunk and as
+    ``progress(size, final=True)`` once done, see
+    :class:`RateLimitedProgress`.
+
+    :returns: name of the copy mode used
+    """
+    if progress is None:
+        progress = _no_progress
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        for mode, copy in _ZERO_COPY_MODES:
+            try:
+                copy(fsrc, fdst, size, bufsize, progress)
+                break
+            except (OSError, AttributeError) as exc:
+                # AttributeError: os function missing on this platform
+                logger.debug("Copy mode %s failed for %s: %s", mode, src, exc)
+                fdst.seek(0)
+                fdst.truncate()
+        else:
+            mode = 'buffered'
+            _buffered(fsrc, fdst, bufsize, progress)
+    progress(size, final=True)
+    return mode
+
+
+def _no_progress(nbytes, final=False):
+    pass
+
+
+#: ways to put the content of a file elsewhere on local disk, see link_file
+LINK_MODES = ('copy', 'reflink', 'hardlink', 'symlink')
+
+
+def link_file(src, dst, mode='reflink'):
+    """Make content of file `src` available at `dst` by `mode`.
+
+    ``hardlink`` and ``symlink`` link `dst` to `src`, so that both share the
+    same content, which must therefore never be modified in place. Where
+    links are not possible, e.g. across filesystems, and for ``reflink`` and
+    ``copy``, content is copied with :func:`copy_file`, sharing extents where
+    supported.
+
+    :returns: name of the link or copy mode used
+    """
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return mode
+        except OSError as exc:
+            logger.debug("Failed to hardlink %s: %s", src, exc)
+    elif mode == 'symlink':
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return mode
+        except (OSError, NotImplementedError) as exc:
+            logger.debug("Failed to symlink %s: %s", src, exc)
+    return copy_file(src, dst)
@@ -0,0 +1,160 @@
+"""Commits of annex symlinks written without the worktree"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+from datalad.support.exceptions import CommandError
+
+from datalad_dtool.keys import key_object_path
+
+logger = logging.getLogger(__name__)
+
+
+def annex_link_target(relpath, key, lower=False, levels=2):
+    """Return target of the annex symlink at `relpath` within the repository
+    to the content of `key`, as created by git-annex for locked files.
+
+    `lower` and `levels` select the hash directories of tuned repositories,
+    see :func:`~datalad_dtool.keys.key_hashdir`.
+    """
+    depth = relpath.count('/')
+    return '../' * depth + '.git/annex/objects/' + \
+        key_object_path(key, lower=lower, levels=levels)
+
+
+def _quote(path):
+    # fast-import takes paths to the end of the line, C-style quoted if
+    # they contain a line feed or start with a double quote
+    if '\n' not in path and not path.startswith('"'):
+        return path
+    return '"{}"'.format(
+        path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+
+class TreeWriter:
+    """Write files into a new commit of the current branch of `repo`.
+
+    Files are added to or removed from the tree of the branch head as they
+    come in, streamed to a single ``git fast-import`` process that writes
+    blobs, trees and the commit, and moves the branch on once
+    :meth:`close` is called. Neither the worktree nor the index are touched
+    in the meantime, see :meth:`update_worktree`.
+
+    :param repo: :class:`GitRepo` to commit to
+    :param message: commit message
+    """
+
+    def __init__(self, repo, message):
+        self.repo = repo
+        self.branch = repo.get_active_branch()
+        if self.branch is None:
+            raise ValueError(f"No branch checked out in {repo}")
+        self.parent = repo.get_hexsha()
+        self.n_changes = 0
+        # hash directories of the annex objects as tuned on init
+        self._hash_options = {
+            'lower': repo.config.getbool(
+                'annex', 'tune.objecthashlower', default=False),
+            'levels': 1 if repo.config.getbool(
+                'annex', 'tune.objecthash1', default=False) else 2,
+        }
+        ident = repo.call_git_oneline(['var', 'GIT_COMMITTER_IDENT'])
+        # --done: a stream cut short, e.g. by a crash, commits nothing
+        self._cmd = ['git', 'fast-import', '--quiet', '--done',
+                     '--date-format=raw']
+        # not a pipe, which would block fast-import once full as it is
+        # only read on close
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(
+            self._cmd, cwd=repo.path,
+            stdin=subprocess.PIPE, stderr=self._stderr)
+        message = message.encode('utf-8')
+        self._write(f'commit refs/heads/{self.branch}\n'
+                    f'committer {ident}\n'
+                    f'data {len(message)}\n'.encode('utf-8'))
+        self._write(message + b'\n')
+        if self.parent is not None:
+            self._write(f'from {self.parent}\n'.encode('utf-8'))
+
+    def _write(self, data):
+        self._proc.stdin.write(data)
+
+    def _relpath(self, pathobj):
+        return pathobj.relative_to(self.repo.pathobj).as_posix()
+
+    def symlink(self, pathobj, target):
+        """Add symlink at `pathobj` pointing to `target`."""
+        target = target.encode('utf-8')
+        self._write(f'M 120000 inline {_quote(self._relpath(pathobj))}\n'
+                    f'data {len(target)}\n'.encode('utf-8') + target + b'\n')
+        self.n_changes += 1
+
+    def annex_link(self, pathobj, key):
+        """Add annex symlink at `pathobj` to the content of `key`."""
+        self.symlink(pathobj, annex_link_target(
+            self._relpath(pathobj), key, **self._hash_options))
+
+    def add_file(self, pathobj, source):
+        """Add regular file at `pathobj` with the content of file `source`."""
+        size = os.path.getsize(source)
+        self._write(f'M 100644 inline {_quote(self._relpath(pathobj))}\n'
+                    f'data {size}\n'.encode('utf-8'))
+        with open(source, 'rb') as f:
+            shutil.copyfileobj(f, self._proc.stdin)
+        self._write(b'\n')
+        self.n_changes += 1
+
+    def add_content(self, pathobj, data):
+        """Add regular file at `pathobj` with content `data`, as bytes."""
+        self._write(f'M 100644 inline {_quote(self._relpath(pathobj))}\n'
+                    f'data {len(data)}\n'.encode('utf-8') + data + b'\n')
+        self.n_changes += 1
+
+    def remove(self, pathobj):
+        """Remove file at `pathobj`."""
+        self._write(f'D {_quote(self._relpath(pathobj))}\n'.encode('utf-8'))
+        self.n_changes += 1
+
+    def close(self):
+        """Write the commit and move the branch on to it.
+
+        :returns: hexsha of the new commit
+        :raises: CommandError if ``git fast-import`` failed
+        """
+        self._write(b'done\n')
+        self._proc.communicate()
+        self._stderr.seek(0)
+        stderr = self._stderr.read()
+        self._stderr.close()
+        if self._proc.returncode:
+            raise CommandError(
+                cmd=' '.join(self._cmd), code=self._proc.returncode,
+                stderr=stderr.decode('utf-8', errors='replace'))
+        commit = self.repo.get_hexsha(f'refs/heads/{self.branch}')
+        logger.debug("Committed %d changes to %s as %s",
+                     self.n_changes, self.branch, commit)
+        return commit
+
+    def abort(self):
+        """Discard everything written, leave the branch as it is."""
+        self._proc.kill()
+        self._proc.communicate()
+        self._stderr.close()
+
+    def update_worktree(self, commit):
+        """Bring index and worktree from the parent up to `commit`.
+
+        Files that changed are checked out by git, files already in the
+        worktree are left alone. The checkout fails instead of overwriting
+        local modifications of files that changed. The index is refreshed
+        first, so that files rewritten with the same content, such as the
+        import state, do not count as modified.
+        """
+        trees = [commit] if self.parent is None else [self.parent, commit]
+        self.repo.call_git(['update-index', '-q', '--refresh'])
+        self.repo.call_git(['read-tree', '-m', '-u'] + trees)